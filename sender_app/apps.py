@@ -1,4 +1,23 @@
 from django.apps import AppConfig
+from django.conf import settings
+
+
+def start_background_workers():
+    """
+    Start the in-process background threads this configuration asks for.
+    Called by the ASGI application (whatsapp_sender/asgi.py), so only a process
+    that actually serves requests runs them, however it was launched; management
+    commands and test runners never import that module. Safe to call twice.
+    """
+    # Work left over by the previous process (pending outbox rows, rows stuck
+    # 'sending', unfinished chat deletions) resumes at boot instead of waiting
+    # for the next new message or delete request.
+    if settings.OUTBOUND_DISPATCH_IN_PROCESS:
+        from .outbound import get_dispatcher
+        get_dispatcher().start()
+    if settings.CHAT_DELETE_IN_PROCESS:
+        from .deletion import start_watch
+        start_watch()
 
 
 class SenderAppConfig(AppConfig):
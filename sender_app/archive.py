@@ -0,0 +1,174 @@
+import gzip
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import ChatMessage, MessageArchive
+
+meta_api_logger = logging.getLogger('meta_api_logger')
+
+# --- Cold message archive ---
+# `manage.py archive_messages` moves ChatMessage rows older than
+# MESSAGE_ARCHIVE_AFTER_DAYS out of the table, oldest id first, in chunks of
+# MESSAGE_ARCHIVE_CHUNK_SIZE. Each chunk becomes one gzip JSONL file per
+# contact (MESSAGE_ARCHIVE_ROOT/<YYYY-MM>/<sender>/<first_id>-<last_id>.jsonl.gz)
+# plus a MessageArchive row, and the rows are deleted in the same transaction.
+# Archiving goes by id, so for every contact the archived ids are all lower than
+# the live ones: get_chat_history_json continues into the archive when a page
+# runs past the oldest live message. Inbox rows (Conversation) are untouched;
+# archived messages no longer show up in search.
+
+ARCHIVE_FIELDS = ('id', 'sender_id', 'timestamp', 'message_type', 'message_text', 'media_url', 'thumbnail_url', 'is_from_user', 'wamid')
+HISTORY_FIELDS = ('id', 'timestamp', 'message_type', 'message_text', 'media_url', 'thumbnail_url', 'is_from_user')
+
+
+def archive_cutoff_id(older_than_days=None):
+    """Highest id older than the retention window (everything up to it gets archived), or None."""
+    days = settings.MESSAGE_ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    cutoff = timezone.now() - timedelta(days=days)
+    return ChatMessage.objects.filter(timestamp__lt=cutoff).aggregate(max_id=Max('id'))['max_id']
+
+
+def _write_archive_file(relative_path, messages):
+    full_path = os.path.join(settings.MESSAGE_ARCHIVE_ROOT, relative_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(full_path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as f:
+            for message in messages:
+                f.write(json.dumps(message, cls=DjangoJSONEncoder, ensure_ascii=False).encode('utf-8') + b'\n')
+        os.replace(tmp_path, full_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return full_path
+
+
+def archive_chunk(max_id, chunk_size=None):
+    """Archive the oldest `chunk_size` messages with id <= max_id. Returns the number of messages archived."""
+    chunk_size = chunk_size or settings.MESSAGE_ARCHIVE_CHUNK_SIZE
+    rows = list(ChatMessage.objects.filter(id__lte=max_id).order_by('id').values(*ARCHIVE_FIELDS)[:chunk_size])
+    if not rows:
+        return 0
+
+    by_sender = {}
+    for row in rows:
+        by_sender.setdefault(row['sender_id'], []).append(row)
+
+    written = []
+    try:
+        with transaction.atomic():
+            for sender_id, messages in by_sender.items():
+                first, last = messages[0], messages[-1]
+                relative_path = f"{first['timestamp']:%Y-%m}/{sender_id}/{first['id']}-{last['id']}.jsonl.gz"
+                written.append(_write_archive_file(relative_path, messages))
+                MessageArchive.objects.create(
+                    sender_id=sender_id,
+                    first_id=first['id'],
+                    last_id=last['id'],
+                    first_timestamp=first['timestamp'],
+                    last_timestamp=last['timestamp'],
+                    message_count=len(messages),
+                    path=relative_path,
+                )
+            # new rows only ever get higher ids, so the range is exactly the rows read above
+            ChatMessage.objects.filter(id__gte=rows[0]['id'], id__lte=rows[-1]['id']).delete()
+    except BaseException:
+        for path in written:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        raise
+
+    meta_api_logger.info(f"Archived {len(rows)} messages #{rows[0]['id']}-{rows[-1]['id']} of {len(by_sender)} contacts")
+    return len(rows)
+
+
+# --- reading ---
+
+_cache = OrderedDict()  # full_path -> (messages, size), least recently used first
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+
+
+def _load_archive(full_path):
+    """
+    Parsed messages of one archive file. Files never change, so they are kept in an LRU
+    bounded by MESSAGE_ARCHIVE_CACHE_BYTES of decoded JSON; a file larger than that is not cached.
+    """
+    global _cache_bytes
+    with _cache_lock:
+        cached = _cache.get(full_path)
+        if cached is not None:
+            _cache.move_to_end(full_path)
+            return cached[0]
+
+    messages, size = [], 0
+    with gzip.open(full_path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                messages.append(json.loads(line))
+                size += len(line)
+    messages = tuple(messages)
+
+    max_bytes = settings.MESSAGE_ARCHIVE_CACHE_BYTES
+    if size <= max_bytes:
+        with _cache_lock:
+            if full_path not in _cache:
+                _cache[full_path] = (messages, size)
+                _cache_bytes += size
+            while _cache_bytes > max_bytes:
+                _, (_, evicted) = _cache.popitem(last=False)
+                _cache_bytes -= evicted
+    return messages
+
+
+def read_archive(archive):
+    """Messages of one MessageArchive (history fields), oldest first."""
+    try:
+        messages = _load_archive(os.path.join(settings.MESSAGE_ARCHIVE_ROOT, archive.path))
+    except (OSError, ValueError) as e:
+        meta_api_logger.error(f"Cannot read message archive {archive.path}: {e}")
+        return []
+    return [{field: message.get(field) for field in HISTORY_FIELDS} for message in messages]
+
+
+def archived_messages_before(sender_id, before, limit):
+    """Up to `limit` archived messages of a contact with id < before (any if None), newest first."""
+    archives = MessageArchive.objects.filter(sender_id=sender_id)
+    if before is not None:
+        archives = archives.filter(first_id__lt=before)
+    result = []
+    for archive in archives.order_by('-last_id').iterator():
+        for message in reversed(read_archive(archive)):
+            if before is None or message['id'] < before:
+                result.append(message)
+                if len(result) >= limit:
+                    return result
+    return result
+
+
+def archived_messages_after(sender_id, after, limit):
+    """Up to `limit` archived messages of a contact with id > after, oldest first."""
+    result = []
+    for archive in MessageArchive.objects.filter(sender_id=sender_id, last_id__gt=after).order_by('first_id').iterator():
+        for message in read_archive(archive):
+            if message['id'] > after:
+                result.append(message)
+                if len(result) >= limit:
+                    return result
+    return result
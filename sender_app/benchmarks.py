@@ -0,0 +1,242 @@
+import asyncio
+import contextlib
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from channels.layers import InMemoryChannelLayer
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+# --- Helpers shared by the load test / benchmark management commands ---
+# Benchmarks never touch the real database: they run against a throwaway test
+# database (same as `manage.py test`) with an in-memory channel layer that can
+# simulate Redis latency. FakeGraphAPI stands in for graph.facebook.com so
+# outbound sends and media downloads can be measured offline.
+
+
+class LatencyInMemoryChannelLayer(InMemoryChannelLayer):
+    """In-memory layer that sleeps `latency` seconds per call, to stand in for a Redis round trip."""
+
+    def __init__(self, latency=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+
+    async def group_add(self, group, channel):
+        await asyncio.sleep(self.latency)
+        return await super().group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        await asyncio.sleep(self.latency)
+        return await super().group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        await asyncio.sleep(self.latency)
+        return await super().group_send(group, message)
+
+
+def channel_layers(latency_ms=0):
+    return {"default": {
+        "BACKEND": "sender_app.benchmarks.LatencyInMemoryChannelLayer",
+        "CONFIG": {"latency": latency_ms / 1000},
+    }}
+
+
+def authenticated_scope(application):
+    """ASGI wrapper giving every connection a logged-in session, for consumers mounted without AuthMiddlewareStack."""
+    async def app(scope, receive, send):
+        return await application(dict(scope, session={'is_authenticated': True}), receive, send)
+    return app
+
+
+@contextlib.contextmanager
+def isolated_database(keep=False, layer_latency_ms=0, threaded=False):
+    """
+    threaded=True: on SQLite, use a temporary file instead of the shared
+    in-memory test database, which fails ("table is locked") as soon as
+    worker threads (outbound dispatcher, media pool) write concurrently.
+    MEDIA_ROOT points at a temporary directory too, so downloaded media and
+    thumbnails never land in the real one.
+    """
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    old_test_name = test_settings.get('NAME')
+    tmp_dir = None
+    if threaded and connection.vendor == 'sqlite' and not old_test_name:
+        tmp_dir = tempfile.mkdtemp(prefix='bench-db-')
+        test_settings['NAME'] = os.path.join(tmp_dir, 'bench.sqlite3')
+    media_root = tempfile.mkdtemp(prefix='bench-media-')
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=keep)
+    try:
+        with override_settings(CHANNEL_LAYERS=channel_layers(layer_latency_ms), MEDIA_ROOT=media_root,
+                               OUTBOUND_DISPATCH_IN_PROCESS=False, CHAT_DELETE_IN_PROCESS=False):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keep)
+        teardown_test_environment()
+        shutil.rmtree(media_root, ignore_errors=True)
+        if tmp_dir:
+            test_settings['NAME'] = old_test_name
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples_ms):
+    """p50/p95/p99/mean/max of a list of millisecond samples, rounded for printing."""
+    return {
+        'count': len(samples_ms),
+        'p50': round(percentile(samples_ms, 50), 2),
+        'p95': round(percentile(samples_ms, 95), 2),
+        'p99': round(percentile(samples_ms, 99), 2),
+        'mean': round(statistics.fmean(samples_ms), 2) if samples_ms else 0.0,
+        'max': round(max(samples_ms), 2) if samples_ms else 0.0,
+    }
+
+
+# --- Local Graph API stand-in ---
+
+class _FakeGraphHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like graph.facebook.com
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body, content_type='application/json'):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _simulate(self):
+        """Apply the configured latency; True if this call should fail with a 5xx."""
+        api = self.server.api
+        if api.latency:
+            time.sleep(api.latency * random.uniform(1 - api.jitter, 1 + api.jitter))
+        failed = random.random() < api.error_rate
+        api.count('responses_503' if failed else 'responses_ok')
+        return failed
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        api = self.server.api
+        api.count('messages')
+        if self._simulate():
+            return self._reply(503, {'error': {'message': 'Service temporarily unavailable', 'code': 2}})
+        if not re.search(r'/messages$', self.path):
+            return self._reply(404, {'error': {'message': 'Unknown path'}})
+        try:
+            to = json.loads(body).get('to')
+        except ValueError:
+            return self._reply(400, {'error': {'message': 'Invalid JSON'}})
+        return self._reply(200, {
+            'messaging_product': 'whatsapp',
+            'contacts': [{'input': to, 'wa_id': to}],
+            'messages': [{'id': f"wamid.fake.{api.next_id()}"}],
+        })
+
+    def do_GET(self):
+        api = self.server.api
+        if self.path.startswith('/files/'):
+            # the media bytes (what lookaside.fbsbx.com serves)
+            api.count('media_downloads')
+            if self._simulate():
+                return self._reply(503, b'', 'text/plain')
+            media_type = 'image/jpeg' if self.path.endswith('.jpg') else 'audio/ogg'
+            return self._reply(200, api.media_body, media_type)
+        # /<version>/<media-id>: metadata with a download url
+        api.count('media_metadata')
+        if self._simulate():
+            return self._reply(503, {'error': {'message': 'Service temporarily unavailable', 'code': 2}})
+        media_id = self.path.rstrip('/').rsplit('/', 1)[-1]
+        extension = 'jpg' if media_id.startswith('img') else 'ogg'
+        return self._reply(200, {
+            'id': media_id,
+            'url': f"{api.base_url}/files/{media_id}.{extension}",
+            'mime_type': 'image/jpeg' if extension == 'jpg' else 'audio/ogg',
+            'file_size': len(api.media_body),
+        })
+
+
+class FakeGraphAPI:
+    """
+    Threaded HTTP server answering the Cloud API calls this app makes:
+      POST /<version>/<phone-id>/messages -> {"messages": [{"id": "wamid.fake.N"}]}
+      GET  /<version>/<media-id>          -> media metadata pointing at /files/<media-id>.<ext>
+      GET  /files/<name>                  -> `media_bytes` bytes of media
+    Every call waits `latency_ms` (+/- jitter) and fails with 503 at `error_rate`.
+    """
+
+    def __init__(self, latency_ms=0, error_rate=0.0, jitter=0.2, media_bytes=20000):
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.jitter = jitter
+        self.media_body = os.urandom(media_bytes)  # one body: deduplicated after the first download
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._ids = 0
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def next_id(self):
+        with self._lock:
+            self._ids += 1
+            return self._ids
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeGraphHandler)
+        self._server.daemon_threads = True
+        self._server.api = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-graph-api', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+@contextlib.contextmanager
+def fake_graph_api(latency_ms=0, error_rate=0.0, media_bytes=20000):
+    """Run a FakeGraphAPI and point GRAPH_API_BASE_URL (and a fresh shared client) at it; MEDIA_ROOT goes to a temp dir."""
+    from sender_app import graph_api
+
+    api = FakeGraphAPI(latency_ms=latency_ms, error_rate=error_rate, media_bytes=media_bytes).start()
+    media_root = tempfile.mkdtemp(prefix='bench-media-')
+    old_client = graph_api._client
+    graph_api._client = None
+    try:
+        with override_settings(GRAPH_API_BASE_URL=api.base_url, MEDIA_ROOT=media_root,
+                               WHATSAPP_ACCESS_TOKEN='bench-token', WHATSAPP_PHONE_NUMBER_ID='100000000000000'):
+            yield api
+    finally:
+        graph_api._client = old_client
+        api.stop()
+        shutil.rmtree(media_root, ignore_errors=True)
@@ -0,0 +1,95 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# --- Cache for the inbox list and per-conversation metadata ---
+# Uses the default Django cache (local memory, or Redis when REDIS_URL is set).
+# Inbox pages are keyed by a version token: any write to a conversation replaces
+# the token, which retires every cached page at once. Conversation metadata is
+# keyed by a per-contact token the same way, so a reader that loaded the row
+# before a write committed stores it under a token nobody asks for again
+# (deleting the key would let that reader put the stale row back). Tokens are
+# time.time_ns() values, never a counter, so a version key culled from the
+# cache cannot come back as a number that older (still cached) entries were
+# stored under. The cached readers and the invalidation calls live in
+# sender_app.conversations, which every ChatMessage write path goes through.
+
+INBOX_VERSION_KEY = 'inbox:version'
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def _count(namespace, hit):
+    with _stats_lock:
+        counters = _stats.setdefault(namespace, {'hits': 0, 'misses': 0})
+        counters['hits' if hit else 'misses'] += 1
+
+
+def count_lookup(namespace, hit):
+    """Count a hit/miss of a cache kept elsewhere (e.g. sender_app.recent) in cache_stats()."""
+    _count(namespace, hit)
+
+
+def cache_stats():
+    """Hit/miss counters per namespace for this process."""
+    with _stats_lock:
+        return {namespace: dict(values) for namespace, values in _stats.items()}
+
+
+def get_or_set(namespace, key, producer, timeout=None):
+    """Cached value for `key`, or producer() stored under it. None results are not cached."""
+    value = cache.get(key)
+    if value is not None:
+        _count(namespace, True)
+        return value
+    _count(namespace, False)
+    value = producer()
+    if value is not None:
+        cache.set(key, value, timeout=settings.INBOX_CACHE_TTL if timeout is None else timeout)
+    return value
+
+
+def _new_version():
+    return time.time_ns()
+
+
+def _version(key, timeout=None):
+    version = cache.get(key)
+    if version is None:
+        version = _new_version()
+        if not cache.add(key, version, timeout=timeout):
+            version = cache.get(key, version)  # another process seeded it first
+    return version
+
+
+def inbox_version():
+    return _version(INBOX_VERSION_KEY)
+
+
+def conversation_version_key(sender_id):
+    return f"conversation:{sender_id}:version"
+
+
+def conversation_version(sender_id):
+    # expiring early only costs a miss: a re-seeded version is new too
+    return _version(conversation_version_key(sender_id), timeout=settings.INBOX_CACHE_TTL)
+
+
+def inbox_key(limit, cursor):
+    return f"inbox:v{inbox_version()}:{limit}:{cursor or ''}"
+
+
+def conversation_key(sender_id):
+    return f"conversation:{sender_id}:v{conversation_version(sender_id)}"
+
+
+def invalidate_inbox():
+    cache.set(INBOX_VERSION_KEY, _new_version(), timeout=None)
+
+
+def invalidate_conversation(sender_id):
+    cache.set(conversation_version_key(sender_id), _new_version(), timeout=settings.INBOX_CACHE_TTL)
+    invalidate_inbox()
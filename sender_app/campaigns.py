@@ -0,0 +1,236 @@
+import logging
+import re
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from .conversations import record_message
+from .graph_api import get_client
+from .models import Campaign, CampaignRecipient, ChatMessage
+from .outbound import SendPool, send_template_message
+
+meta_api_logger = logging.getLogger('meta_api_logger')
+
+# --- Template campaigns ---
+# A campaign is one template sent to many numbers. Every number is a
+# CampaignRecipient row, so progress survives restarts: the runner claims
+# pending rows with a conditional UPDATE, sends them on a bounded worker pool
+# behind a token bucket per business phone number, and records the outcome per
+# row. The bucket runs at CAMPAIGN_RATE_PER_SECOND, the share of the number's
+# Cloud API throughput that the outbox dispatcher (OUTBOUND_RATE_PER_SECOND)
+# leaves free. Rows left in 'sending' by a crashed runner go back to 'pending' once
+# their lease (CAMPAIGN_LEASE_SECONDS) expires.
+
+THROUGHPUT_WINDOW_SECONDS = 60
+
+
+def parse_numbers(raw):
+    """
+    Phone numbers from an upload (newline/comma/semicolon separated, e.g. a one-column CSV).
+    Returns (numbers, invalid): digits only, de-duplicated, upload order kept.
+    """
+    numbers, invalid, seen = [], [], set()
+    for token in re.split(r'[\s,;]+', raw or ''):
+        if not token:
+            continue
+        number = re.sub(r'[\s()+\-.]', '', token)
+        if not number.isdigit() or not 7 <= len(number) <= 15:
+            invalid.append(token)
+            continue
+        if number not in seen:
+            seen.add(number)
+            numbers.append(number)
+    return numbers, invalid
+
+
+def create_campaign(name, template_name, numbers, language_code='ru_RU'):
+    with transaction.atomic():
+        campaign = Campaign.objects.create(
+            name=name, template_name=template_name, language_code=language_code, total_recipients=len(numbers),
+        )
+        CampaignRecipient.objects.bulk_create(
+            [CampaignRecipient(campaign=campaign, phone_number=number) for number in numbers],
+            batch_size=1000,
+        )
+    meta_api_logger.info(f"Campaign {campaign.pk} '{name}' created: template {template_name}, {len(numbers)} recipients")
+    return campaign
+
+
+def set_campaign_status(campaign, status):
+    """Pause or resume; in-flight sends of a paused campaign still finish."""
+    if campaign.status == Campaign.STATUS_COMPLETED:
+        return campaign
+    Campaign.objects.filter(pk=campaign.pk).exclude(status=Campaign.STATUS_COMPLETED).update(status=status)
+    campaign.refresh_from_db()
+    return campaign
+
+
+def campaign_progress(campaign):
+    counts = {status: 0 for status, _ in CampaignRecipient.STATUS_CHOICES}
+    for row in campaign.recipients.values('status').annotate(n=Count('id')):
+        counts[row['status']] = row['n']
+
+    now = timezone.now()
+    recent = campaign.recipients.filter(sent_at__gte=now - timedelta(seconds=THROUGHPUT_WINDOW_SECONDS)).count()
+    current_rate = recent / THROUGHPUT_WINDOW_SECONDS
+    average_rate = None
+    if campaign.started_at:
+        elapsed = ((campaign.finished_at or now) - campaign.started_at).total_seconds()
+        average_rate = counts[CampaignRecipient.STATUS_SENT] / elapsed if elapsed > 0 else None
+    remaining = counts[CampaignRecipient.STATUS_PENDING] + counts[CampaignRecipient.STATUS_SENDING]
+
+    return {
+        'id': campaign.pk,
+        'name': campaign.name,
+        'template_name': campaign.template_name,
+        'language_code': campaign.language_code,
+        'status': campaign.status,
+        'total': campaign.total_recipients,
+        'counts': counts,
+        'done_percent': round(100 * (campaign.total_recipients - remaining) / campaign.total_recipients, 1) if campaign.total_recipients else 100.0,
+        'messages_per_second': round(current_rate, 2),
+        'average_messages_per_second': round(average_rate, 2) if average_rate is not None else None,
+        'eta_seconds': round(remaining / current_rate) if current_rate and campaign.status == Campaign.STATUS_RUNNING else None,
+        'created_at': campaign.created_at.isoformat(),
+        'started_at': campaign.started_at.isoformat() if campaign.started_at else None,
+        'finished_at': campaign.finished_at.isoformat() if campaign.finished_at else None,
+    }
+
+
+class CampaignRunner(SendPool):
+    """outbound.SendPool claiming CampaignRecipient rows; requeues stale leases and completes finished campaigns."""
+    label = 'Campaign runner'
+    thread_prefix = 'campaign'
+    housekeeping_interval = 30
+
+    def __init__(self, workers=None, rate=None, batch_size=200, poll_interval=2.0):
+        super().__init__(
+            workers or settings.CAMPAIGN_WORKERS, rate or settings.CAMPAIGN_RATE_PER_SECOND, batch_size, poll_interval,
+        )
+        self.max_attempts = settings.CAMPAIGN_MAX_ATTEMPTS
+        self.lease_seconds = settings.CAMPAIGN_LEASE_SECONDS
+
+    def run_until_idle(self):
+        """Run until running campaigns have nothing pending (incl. retries in backoff), then stop (`run_campaigns --once`)."""
+        self.start()
+        while not self._stop.is_set():
+            time.sleep(self.poll_interval)
+            if not CampaignRecipient.objects.filter(
+                campaign__status=Campaign.STATUS_RUNNING,
+                status__in=[CampaignRecipient.STATUS_PENDING, CampaignRecipient.STATUS_SENDING],
+            ).exists():
+                break
+        self.stop()
+        self.complete_finished()
+
+    # --- feeder ---
+    def housekeeping(self):
+        self.requeue_stale()
+        self.complete_finished()
+
+    def _due(self):
+        return (
+            CampaignRecipient.objects
+            .filter(campaign__status=Campaign.STATUS_RUNNING, status=CampaignRecipient.STATUS_PENDING)
+            .exclude(next_attempt_at__gt=timezone.now())
+        )
+
+    def _claim_and_submit(self):
+        candidates = list(self._due().order_by('id').values_list('id', 'campaign_id')[:self.batch_size])
+        claimed = 0
+        started = set()
+        for recipient_id, campaign_id in candidates:
+            if not self._slots.acquire(timeout=self.poll_interval):
+                break  # pool is busy; pick the rest up on the next pass
+            updated = CampaignRecipient.objects.filter(pk=recipient_id, status=CampaignRecipient.STATUS_PENDING).update(
+                status=CampaignRecipient.STATUS_SENDING, locked_at=timezone.now(),
+            )
+            if not updated:
+                self._slots.release()
+                continue
+            if campaign_id not in started:
+                started.add(campaign_id)
+                Campaign.objects.filter(pk=campaign_id, started_at__isnull=True).update(started_at=timezone.now())
+            self._executor.submit(self._send, recipient_id)
+            claimed += 1
+        return claimed
+
+    def requeue_stale(self):
+        cutoff = timezone.now() - timedelta(seconds=self.lease_seconds)
+        count = CampaignRecipient.objects.filter(
+            status=CampaignRecipient.STATUS_SENDING, locked_at__lt=cutoff
+        ).update(status=CampaignRecipient.STATUS_PENDING, locked_at=None)
+        if count:
+            meta_api_logger.warning(f"Requeued {count} stale campaign sends (lease > {self.lease_seconds}s)")
+        return count
+
+    def complete_finished(self):
+        for campaign in Campaign.objects.filter(status=Campaign.STATUS_RUNNING):
+            if not campaign.recipients.filter(
+                status__in=[CampaignRecipient.STATUS_PENDING, CampaignRecipient.STATUS_SENDING]
+            ).exists():
+                Campaign.objects.filter(pk=campaign.pk, status=Campaign.STATUS_RUNNING).update(
+                    status=Campaign.STATUS_COMPLETED, finished_at=timezone.now(),
+                )
+                meta_api_logger.info(f"Campaign {campaign.pk} '{campaign.name}' completed")
+
+    # --- workers ---
+    def _mark_sent(self, recipient_id, attempts, wamid):
+        """Record a delivered send first: a row left 'sending' would be sent again once its lease expires."""
+        for attempt in range(3):
+            try:
+                close_old_connections()
+                CampaignRecipient.objects.filter(pk=recipient_id).update(
+                    status=CampaignRecipient.STATUS_SENT, attempts=attempts, sent_at=timezone.now(),
+                    locked_at=None, response_message_id=wamid, last_error=None,
+                )
+                return
+            except Exception as e:
+                if attempt == 2:
+                    raise
+                meta_api_logger.warning(f"Could not mark campaign recipient {recipient_id} sent, retrying: {e}")
+                time.sleep(0.5 * (attempt + 1))
+
+    def _send(self, recipient_id):
+        try:
+            close_old_connections()
+            recipient = CampaignRecipient.objects.select_related('campaign').get(pk=recipient_id)
+            campaign = recipient.campaign
+            self._bucket(get_client().phone_number_id).acquire()
+            recipient.attempts += 1
+            result = send_template_message(recipient.phone_number, campaign.template_name, campaign.language_code)
+            if result['success']:
+                wamid = (result['data'].get('messages') or [{}])[0].get('id')
+                self._mark_sent(recipient_id, recipient.attempts, wamid)
+                try:
+                    # same trace in the chat history as start_new_chat_view leaves
+                    chat_message = ChatMessage.objects.create(
+                        sender_id=recipient.phone_number,
+                        message_text=f"Started chat with template: '{campaign.template_name}' (campaign '{campaign.name}')",
+                        is_from_user=False,
+                        message_type='system',
+                    )
+                    record_message(chat_message)
+                except Exception as e:
+                    # the template is out; only the history entry is missing
+                    meta_api_logger.exception(f"Campaign {campaign.pk}: sent to {recipient.phone_number} but could not record it in the chat: {e}")
+            elif result.get('retryable') and recipient.attempts < self.max_attempts:
+                delay = min(2 ** recipient.attempts, 300)
+                meta_api_logger.warning(f"Campaign {campaign.pk} send to {recipient.phone_number} failed (attempt {recipient.attempts}), retry in {delay}s: {result['error']}")
+                CampaignRecipient.objects.filter(pk=recipient_id).update(
+                    status=CampaignRecipient.STATUS_PENDING, attempts=recipient.attempts, locked_at=None,
+                    next_attempt_at=timezone.now() + timedelta(seconds=delay), last_error=result['error'],
+                )
+            else:
+                meta_api_logger.error(f"Campaign {campaign.pk} send to {recipient.phone_number} failed permanently: {result['error']}")
+                CampaignRecipient.objects.filter(pk=recipient_id).update(
+                    status=CampaignRecipient.STATUS_FAILED, attempts=recipient.attempts, locked_at=None, last_error=result['error'],
+                )
+        except Exception as e:
+            meta_api_logger.exception(f"Error sending campaign recipient {recipient_id}: {e}")
+        finally:
+            self._release_slot()
@@ -0,0 +1,70 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+meta_api_logger = logging.getLogger('meta_api_logger')
+
+# --- Webhook traffic capture ---
+# With WEBHOOK_CAPTURE_PATH set, webhook_view appends every POST body to a
+# JSONL file before processing it, one line per request:
+#   {"ts": <unix time of arrival>, "body": "<raw body, exactly as received>"}
+# `manage.py replay_webhooks <file>` sends a capture back to a server with the
+# original spacing (or faster). Bodies contain customer messages: treat capture
+# files like the database, and turn capture off once the incident is recorded.
+
+_lock = threading.Lock()
+_file = None  # O_APPEND file descriptor
+_file_path = None
+_full = False
+
+
+def capture_enabled():
+    return bool(settings.WEBHOOK_CAPTURE_PATH) and not _full
+
+
+def capture_webhook(raw_body, received_at=None):
+    """Append one webhook body to the capture file. Never raises: capture must not break ingestion."""
+    global _file, _file_path, _full
+    if not capture_enabled():
+        return False
+    if isinstance(raw_body, (bytes, bytearray)):
+        raw_body = bytes(raw_body).decode('utf-8', errors='replace')
+    line = json.dumps({'ts': received_at or time.time(), 'body': raw_body}, ensure_ascii=False) + '\n'
+    data = line.encode('utf-8')
+    try:
+        with _lock:
+            path = settings.WEBHOOK_CAPTURE_PATH
+            if _file is None or _file_path != path:
+                if _file is not None:
+                    os.close(_file)
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                _file = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                _file_path = path
+            if os.fstat(_file).st_size + len(data) > settings.WEBHOOK_CAPTURE_MAX_BYTES:
+                _full = True
+                meta_api_logger.warning(f"Webhook capture stopped: {path} reached WEBHOOK_CAPTURE_MAX_BYTES")
+                return False
+            # one O_APPEND write per line, so lines stay whole when several processes capture to one file
+            os.write(_file, data)
+        return True
+    except OSError as e:
+        meta_api_logger.error(f"Webhook capture to {settings.WEBHOOK_CAPTURE_PATH} failed: {e}")
+        return False
+
+
+def read_capture(path, limit=None):
+    """Captured requests as [(ts, body)], in arrival order; malformed lines are skipped."""
+    records = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                records.append((float(entry['ts']), entry['body']))
+            except (ValueError, KeyError, TypeError):
+                continue
+    records.sort(key=lambda record: record[0])
+    return records[:limit] if limit else records
@@ -1,128 +1,409 @@
+import asyncio
 import json
-import os
-import requests
 import logging
-import threading
-from channels.generic.websocket import WebsocketConsumer
-from asgiref.sync import async_to_sync
-from .models import ChatMessage
+import re
+import time
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from .models import ChatMessage, MessageArchive
+from . import metrics
+from .archive import HISTORY_FIELDS
+from .conversations import INBOX_GROUP, cached_conversation, mark_read, record_message
+from .logs import truncate_text
+from .media import AUDIO_EXTENSIONS, IMAGE_EXTENSIONS
+from .outbound import build_media_payload, build_text_payload, enqueue_outbound
+from .recent import recent_page
 
 meta_api_logger = logging.getLogger('meta_api_logger')
 
-class ChatConsumer(WebsocketConsumer):
-    def connect(self):
-        self.phone_number = self.scope['url_route']['kwargs']['phone_number']
-        self.room_group_name = f'chat_{self.phone_number}'
-        async_to_sync(self.channel_layer.group_add)(self.room_group_name, self.channel_name)
-        self.accept()
-        meta_api_logger.info(f"WebSocket connected for {self.phone_number}")
+# server-side length guard (avoid huge payloads)
+MAX_LEN = 8000  # adjust if needed
 
-    def disconnect(self, close_code):
-        meta_api_logger.info(f"WebSocket disconnected for {self.phone_number}")
-        async_to_sync(self.channel_layer.group_discard)(self.room_group_name, self.channel_name)
+SENDER_ID_RE = re.compile(r'\d{1,32}')
 
-    def receive(self, text_data):
-        """
-        Receive payload from client websocket. We:
-         - parse safely
-         - persist the message to DB immediately
-         - broadcast to group so UI updates quickly
-         - offload the external WhatsApp API call to a background thread
-        """
+
+@database_sync_to_async
+def save_system_note(phone_number, text):
+    chat_message = ChatMessage.objects.create(sender_id=phone_number, message_text=text, is_from_user=False, message_type='system')
+    record_message(chat_message)
+    return chat_message
+
+
+@database_sync_to_async
+def save_outgoing_message(phone_number, message, is_media_url):
+    """Persist the operator's message and queue it in the outbox."""
+    if is_media_url:
+        message_type = 'image' if any(message.lower().endswith(ext) for ext in IMAGE_EXTENSIONS) else 'audio'
+        chat_message = ChatMessage.objects.create(sender_id=phone_number, media_url=message, is_from_user=False, message_type=message_type)
+        payload = build_media_payload(phone_number, message, message_type)
+    else:
+        chat_message = ChatMessage.objects.create(sender_id=phone_number, message_text=message, is_from_user=False, message_type='text')
+        payload = build_text_payload(phone_number, message)
+
+    record_message(chat_message)
+
+    # The Cloud API call happens in the outbound dispatcher (rate limited, retried, ordered per recipient)
+    enqueue_outbound(phone_number, payload, chat_message=chat_message)
+    return chat_message
+
+
+@database_sync_to_async
+def is_authenticated(scope):
+    """Same gate as custom_login_required: the OTP login sets session['is_authenticated']."""
+    session = scope.get('session')
+    return bool(session and session.get('is_authenticated'))
+
+
+@database_sync_to_async
+def load_missed_messages(phone_number, last_id, limit):
+    """
+    Messages of a contact with id > last_id, oldest first: (messages, has_more),
+    or None when some of them are archived (the client should reload instead).
+    Like opening the chat through the history API, this marks it read.
+    """
+    conversation = cached_conversation(phone_number)
+    if conversation and conversation['unread_count']:
+        mark_read(phone_number)
+    cached = recent_page(phone_number, limit, after=last_id)
+    if cached is not None:
+        return cached
+    if MessageArchive.objects.filter(sender_id=phone_number, last_id__gt=last_id).exists():
+        return None
+    page = list(ChatMessage.objects.filter(sender_id=phone_number, id__gt=last_id).order_by('id').values(*HISTORY_FIELDS)[:limit + 1])
+    return page[:limit], len(page) > limit
+
+
+def message_frame(message):
+    """Client frame of a history row (same shape as a live chat_message)."""
+    return {
+        'id': message['id'],
+        'message': message['media_url'] or message['message_text'] or '',
+        'is_from_user': message['is_from_user'],
+        'thumbnail_url': message['thumbnail_url'],
+    }
+
+
+def _merge_inbox(pending, frame):
+    """Fold a newer inbox frame into one still waiting in the outbox: latest row per conversation wins."""
+    rows = {row['sender_id']: row for row in pending['conversations']}
+    deleted = [sender_id for sender_id in pending['deleted'] if sender_id not in {row['sender_id'] for row in frame['conversations']}]
+    for sender_id in frame['deleted']:
+        rows.pop(sender_id, None)
+        if sender_id not in deleted:
+            deleted.append(sender_id)
+    rows.update((row['sender_id'], row) for row in frame['conversations'])
+    pending['conversations'] = list(rows.values())
+    pending['deleted'] = deleted
+
+
+class ChatEventsConsumer(AsyncWebsocketConsumer):
+    """
+    What both chat sockets share: sending operator messages into a chat,
+    the resume protocol and relaying chat_<sender_id> group events.
+
+    Resume protocol: every message frame carries the message id. A client that
+    already shows a chat up to some id asks for the rest right after joining its
+    group; the consumer replays the messages after it (one indexed range read,
+    or none from the recent-messages buffer) and then answers
+    {"type": "resumed", "sender_id": ..., "last_id": <newest id>}. Past
+    WS_RESUME_MAX_MESSAGES (or into the archive) it answers
+    {"type": "resync_required", "sender_id": ...} and the client reloads the
+    latest history page instead.
+
+    The group is joined before the replay is read, so nothing falls in between:
+    a message committed later is also broadcast, and live events that arrive
+    during the replay are handled after it (the consumer handles one event at a
+    time). Ids already replayed are not sent twice.
+
+    Outgoing events go through a small per-connection outbox (queue_frame) so a
+    burst never turns into a backlog. The first event after a quiet period is sent
+    right away; events arriving within WS_COALESCE_WINDOW_MS of the last send
+    (or while a send is still in progress) go out together as one
+    {"type": "batch", "frames": [...]} frame. Inbox updates in the outbox are
+    merged. If a client falls more than WS_SEND_BUFFER_FRAMES frames behind, its
+    buffered message frames are dropped and it gets one
+    {"type": "resync_required", "sender_id": ...} per affected chat instead.
+    Sending happens in a task of its own, so a slow socket never stops the
+    consumer from draining its channel layer inbox.
+    """
+
+    accepted = False  # connect() passed the session check
+    replayed_ids = None  # sender_id -> ids sent by the last resume()
+    _outbox = None  # frames waiting for the flush task
+    _flush_task = None
+    _last_flush = 0.0
+    _resyncing = frozenset()  # chats told to resync since the last flush: drop their messages
+
+    # --- Outgoing frames: coalescing and backpressure ---
+
+    def queue_frame(self, frame):
+        if self._outbox is None:
+            self._outbox = []
+        sender_id = frame.get('sender_id')
+        if 'id' in frame and sender_id in self._resyncing:
+            metrics.ws_dropped_events.inc()
+            return  # the client reloads this chat anyway
+        if frame.get('type') == 'inbox':
+            pending = next((queued for queued in self._outbox if queued.get('type') == 'inbox'), None)
+            if pending is not None:
+                _merge_inbox(pending, frame)
+                metrics.ws_coalesced_events.inc()
+                return
+        self._outbox.append(frame)
+        if len(self._outbox) > settings.WS_SEND_BUFFER_FRAMES:
+            self._collapse_outbox()
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_outbox())
+
+    def _collapse_outbox(self):
+        """The client fell behind: replace the buffered frames with resync_required per chat (and the inbox rows)."""
+        frames, inbox, senders = self._outbox, None, []
+        for frame in frames:
+            if frame.get('type') == 'inbox':
+                inbox = frame
+            elif frame.get('sender_id') and frame['sender_id'] not in senders:
+                senders.append(frame['sender_id'])
+        self._outbox = [{'type': 'resync_required', 'sender_id': sender_id} for sender_id in senders]
+        if inbox is not None:
+            self._outbox.append(inbox)
+        self._resyncing = set(senders)
+        metrics.ws_dropped_events.inc(len(frames) - len(self._outbox))
+        metrics.ws_resync_required.inc(len(senders))
+        meta_api_logger.warning(f"WebSocket client {self.channel_name} fell {len(frames)} frames behind, asking it to resync {senders}")
+
+    async def _flush_outbox(self):
+        window = settings.WS_COALESCE_WINDOW_MS / 1000
         try:
-            text_data_json = json.loads(text_data)
-            message = text_data_json.get('message', '')
+            while self._outbox:
+                delay = self._last_flush + window - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                frames, self._outbox, self._resyncing = self._outbox, [], frozenset()
+                self._last_flush = time.monotonic()
+                if len(frames) == 1:
+                    metrics.ws_frames_sent.inc(kind='single')
+                    await self.send(text_data=json.dumps(frames[0]))
+                else:
+                    metrics.ws_frames_sent.inc(kind='batch')
+                    metrics.ws_coalesced_events.inc(len(frames) - 1)
+                    await self.send(text_data=json.dumps({'type': 'batch', 'frames': frames}))
         except Exception as e:
-            meta_api_logger.error(f"WebSocket parse error for {self.phone_number}: {e} - raw: {text_data}")
-            return
+            # socket gone: whatever is left has nowhere to go
+            meta_api_logger.info(f"WebSocket flush for {self.channel_name} stopped: {e}")
+            self._outbox = []
+        finally:
+            self._flush_task = None
+
+    def discard_outbox(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        self._outbox = []
+
+    async def broadcast(self, phone_number, event):
+        started = time.monotonic()
+        await self.channel_layer.group_send(f'chat_{phone_number}', event)
+        metrics.group_send_seconds.observe(time.monotonic() - started, source='consumer')
 
+    async def send_operator_message(self, phone_number, message):
+        """
+        Persist the operator's message immediately (and queue it in the outbox),
+        then broadcast it to the chat's group so every open UI updates quickly.
+        """
         if message is None:
             return
+        metrics.ws_messages_received.inc()
 
-        # server-side length guard (avoid huge payloads)
-        MAX_LEN = 8000  # adjust if needed
         if isinstance(message, str) and len(message) > MAX_LEN:
-            meta_api_logger.warning(f"Message too long from {self.phone_number}: {len(message)} chars")
+            meta_api_logger.warning(f"Message too long from {phone_number}: {len(message)} chars")
             # Save truncated system note and notify client
-            ChatMessage.objects.create(sender_id=self.phone_number,
-                                       message_text='[Message truncated: too long]',
-                                       is_from_user=False,
-                                       message_type='system')
-            async_to_sync(self.channel_layer.group_send)(
-                self.room_group_name,
-                {'type': 'chat_message', 'message': '[Message truncated: too long]', 'is_from_user': False, 'sender_id': self.phone_number}
+            note = await save_system_note(phone_number, '[Message truncated: too long]')
+            await self.broadcast(
+                phone_number, {'type': 'chat_message', 'id': note.pk, 'message': '[Message truncated: too long]', 'is_from_user': False, 'sender_id': phone_number}
             )
             return
 
         # Determine if it's a media link or text
         is_media_url = False
         if isinstance(message, str):
-            is_media_url = any(message.lower().endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.ogg', '.amr', '.wav', '.m4a'])
+            is_media_url = any(message.lower().endswith(ext) for ext in IMAGE_EXTENSIONS + AUDIO_EXTENSIONS)
 
         # Persist immediately
-        if is_media_url:
-            message_type = 'image' if any(message.lower().endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp']) else 'audio'
-            ChatMessage.objects.create(sender_id=self.phone_number, media_url=message, is_from_user=False, message_type=message_type)
-        else:
-            ChatMessage.objects.create(sender_id=self.phone_number, message_text=message, is_from_user=False, message_type='text')
+        chat_message = await save_outgoing_message(phone_number, message, is_media_url)
 
         # Broadcast to all connected clients in the group (fast UI update)
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name,
-            {'type': 'chat_message', 'message': message, 'is_from_user': False, 'sender_id': self.phone_number}
+        await self.broadcast(
+            phone_number, {'type': 'chat_message', 'id': chat_message.pk, 'message': message, 'is_from_user': False, 'sender_id': phone_number}
         )
 
-        # Offload external API calls to a thread to avoid blocking the consumer
-        threading.Thread(target=self._send_outbound, args=(self.phone_number, message, is_media_url), daemon=True).start()
+    async def resume(self, phone_number, last_id):
+        """Replay the messages of a chat after the client's last seen id, then go live."""
+        try:
+            last_id = int(last_id)
+        except (TypeError, ValueError):
+            await self.send(text_data=json.dumps({'type': 'resync_required', 'sender_id': phone_number}))
+            return
+        result = await load_missed_messages(phone_number, last_id, settings.WS_RESUME_MAX_MESSAGES)
+        if result is None or result[1]:
+            metrics.ws_resumes.inc(result='resync')
+            meta_api_logger.info(f"WebSocket resume for {phone_number} from #{last_id}: too far behind, resync")
+            await self.send(text_data=json.dumps({'type': 'resync_required', 'sender_id': phone_number}))
+            return
+        missed = result[0]
+        if self.replayed_ids is None:
+            self.replayed_ids = {}
+        self.replayed_ids[phone_number] = {message['id'] for message in missed}
+        metrics.ws_resumes.inc(result='replayed')
+        metrics.ws_replayed_messages.inc(len(missed))
+        newest = missed[-1]['id'] if missed else last_id
+        meta_api_logger.info(f"WebSocket resume for {phone_number} from #{last_id}: replayed {len(missed)}")
+        # one frame for the whole replay; it bypasses the outbox (the client asked for it)
+        resumed = {'type': 'resumed', 'sender_id': phone_number, 'last_id': newest, 'replayed': len(missed)}
+        frames = [dict(message_frame(message), sender_id=phone_number) for message in missed] + [resumed]
+        await self.send(text_data=json.dumps({'type': 'batch', 'frames': frames} if missed else resumed))
 
-    def chat_message(self, event):
+    async def chat_message(self, event):
+        if self.replayed_ids and event.get('id') in self.replayed_ids.get(event['sender_id'], ()):
+            return  # already sent by resume()
         # send to client
-        self.send(text_data=json.dumps({
+        self.queue_frame({
+            'id': event.get('id'),
             'message': event['message'],
             'is_from_user': event['is_from_user'],
             'sender_id': event['sender_id']
-        }))
+        })
 
-    # background worker
-    def _send_outbound(self, phone_number, message, is_media_url):
-        """
-        Called in a background thread. Sends message to WhatsApp Cloud API.
-        """
+    async def chat_message_batch(self, event):
+        # several messages of one webhook payload, fanned out in one group_send
+        # (and usually sent to the client as one batch frame)
+        for message in event['messages']:
+            await self.chat_message(message)
+
+
+class ChatConsumer(ChatEventsConsumer):
+    """
+    One socket per open chat (ws/chat/<phone>/), for logged-in sessions only. Fully async: a connection
+    costs no executor thread, only DB writes hop to the database executor.
+    Resumes with {"action": "resume", "last_id": <id>}. The chat UI uses
+    InboxConsumer instead; this route stays for single-chat clients.
+    """
+
+    async def connect(self):
+        self.phone_number = self.scope['url_route']['kwargs']['phone_number']
+        self.room_group_name = f'chat_{self.phone_number}'
+        if not await is_authenticated(self.scope):
+            meta_api_logger.warning(f"Rejected unauthenticated WebSocket for {self.phone_number}")
+            await self.close()
+            return
+        self.accepted = True
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.accept()
+        metrics.ws_connections.inc(consumer='chat')
+        meta_api_logger.info(f"WebSocket connected for {self.phone_number}")
+
+    async def disconnect(self, close_code):
+        if not self.accepted:
+            return
+        meta_api_logger.info(f"WebSocket disconnected for {self.phone_number}")
+        metrics.ws_connections.dec(consumer='chat')
+        self.discard_outbox()
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            if is_media_url:
-                message_type = 'image' if any(message.lower().endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp']) else 'audio'
-                self.send_media_to_whatsapp(phone_number, message, message_type)
-            else:
-                self.send_text_to_whatsapp(phone_number, message)
+            text_data_json = json.loads(text_data)
+            if text_data_json.get('action') == 'resume':
+                await self.resume(self.phone_number, text_data_json.get('last_id'))
+                return
+            message = text_data_json.get('message', '')
         except Exception as e:
-            meta_api_logger.error(f"Error sending outbound message for {phone_number}: {e}")
+            meta_api_logger.error(f"WebSocket parse error for {self.phone_number}: {e} - raw: {truncate_text(text_data, 1000)}")
+            return
+        await self.send_operator_message(self.phone_number, message)
 
-    # Keep _send_request and the two helpers, but add error handling
-    def _send_request(self, payload):
-        access_token = os.environ.get('WHATSAPP_ACCESS_TOKEN')
-        phone_number_id = os.environ.get('WHATSAPP_PHONE_NUMBER_ID')
-        version = os.environ.get('WHATSAPP_API_VERSION', 'v20.0')
-        url = f"https://graph.facebook.com/{version}/{phone_number_id}/messages"
-        headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
 
-        meta_api_logger.info(f"--- META API SEND --- URL: {url} | Payload-size: {len(json.dumps(payload))}")
+class InboxConsumer(ChatEventsConsumer):
+    """
+    One socket per agent (ws/inbox/), logged-in sessions only, multiplexing any number of chats:
+      {"action": "subscribe", "sender_id": ..., "last_id": <id, optional>}  join chat_<sender_id> (and resume)
+      {"action": "unsubscribe", "sender_id": ...}
+      {"action": "resume", "sender_id": ..., "last_id": <id>}
+      {"action": "send", "sender_id": ..., "message": ...}
+    Message frames carry their sender_id. Every inbox socket is also in the
+    `inbox` group and gets {"type": "inbox", "conversations": [...], "deleted": [...]}
+    when conversations change (conversations.publish_inbox).
+    At most WS_MAX_SUBSCRIPTIONS chats per socket.
+    """
+
+    async def connect(self):
+        self.subscriptions = set()
+        if not await is_authenticated(self.scope):
+            meta_api_logger.warning("Rejected unauthenticated inbox WebSocket")
+            await self.close()
+            return
+        self.accepted = True
+        await self.channel_layer.group_add(INBOX_GROUP, self.channel_name)
+        await self.accept()
+        metrics.ws_connections.inc(consumer='inbox')
+        meta_api_logger.info("Inbox WebSocket connected")
+
+    async def disconnect(self, close_code):
+        if not self.accepted:
+            return
+        meta_api_logger.info(f"Inbox WebSocket disconnected ({len(self.subscriptions)} subscriptions)")
+        metrics.ws_connections.dec(consumer='inbox')
+        self.discard_outbox()
+        metrics.ws_subscriptions.dec(len(self.subscriptions))
+        await self.channel_layer.group_discard(INBOX_GROUP, self.channel_name)
+        for phone_number in self.subscriptions:
+            await self.channel_layer.group_discard(f'chat_{phone_number}', self.channel_name)
+
+    async def send_error(self, error, **fields):
+        await self.send(text_data=json.dumps({'type': 'error', 'error': error, **fields}))
+
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            response = requests.post(url, headers=headers, json=payload, timeout=15)
-            meta_api_logger.info(f"--- META API RESPONSE --- Status: {response.status_code} | Body: {response.text}")
-        except requests.exceptions.RequestException as e:
-            meta_api_logger.error(f"--- CRITICAL ERROR --- The API call failed: {e}")
-
-    def send_text_to_whatsapp(self, phone_number, message):
-        payload = {"messaging_product": "whatsapp", "to": phone_number, "text": {"body": message}}
-        self._send_request(payload)
-
-    def send_media_to_whatsapp(self, phone_number, media_url, media_type):
-        payload = {
-            "messaging_product": "whatsapp",
-            "to": phone_number,
-            "type": media_type,
-            media_type: {"link": media_url}
-        }
-        self._send_request(payload)
-
-    
\ No newline at end of file
+            data = json.loads(text_data)
+            action = data.get('action')
+            phone_number = str(data.get('sender_id') or '')
+        except Exception as e:
+            meta_api_logger.error(f"Inbox WebSocket parse error: {e} - raw: {truncate_text(text_data, 1000)}")
+            return
+        # group names are chat_<sender_id>: digits only, like the ws/chat/ route
+        if not SENDER_ID_RE.fullmatch(phone_number):
+            await self.send_error('invalid sender_id', action=action)
+            return
+
+        if action == 'subscribe':
+            if phone_number not in self.subscriptions:
+                if len(self.subscriptions) >= settings.WS_MAX_SUBSCRIPTIONS:
+                    await self.send_error('too many subscriptions', action=action, sender_id=phone_number)
+                    return
+                await self.channel_layer.group_add(f'chat_{phone_number}', self.channel_name)
+                self.subscriptions.add(phone_number)
+                metrics.ws_subscriptions.inc()
+            if data.get('last_id') is not None:
+                await self.resume(phone_number, data['last_id'])
+        elif action == 'unsubscribe':
+            if phone_number in self.subscriptions:
+                await self.channel_layer.group_discard(f'chat_{phone_number}', self.channel_name)
+                self.subscriptions.discard(phone_number)
+                metrics.ws_subscriptions.dec()
+            if self.replayed_ids:
+                self.replayed_ids.pop(phone_number, None)
+        elif action == 'resume':
+            if phone_number not in self.subscriptions:
+                await self.send_error('not subscribed', action=action, sender_id=phone_number)
+                return
+            await self.resume(phone_number, data.get('last_id'))
+        elif action == 'send':
+            await self.send_operator_message(phone_number, data.get('message', ''))
+        else:
+            await self.send_error('unknown action', action=action)
+
+    async def inbox_update(self, event):
+        self.queue_frame({
+            'type': 'inbox',
+            'conversations': event.get('conversations', []),
+            'deleted': event.get('deleted', []),
+        })
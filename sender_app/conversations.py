@@ -0,0 +1,187 @@
+import base64
+import logging
+from datetime import datetime
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+
+from . import caching, recent
+from .models import ChatMessage, Conversation
+
+meta_api_logger = logging.getLogger('meta_api_logger')
+
+# --- Inbox: denormalized Conversation rows ---
+# Every code path that writes a ChatMessage calls record_message() right after,
+# so the contact list is a single indexed read instead of a GROUP BY over all messages.
+# The same functions invalidate the inbox cache (sender_app.caching) and feed
+# the recent-messages buffers (sender_app.recent), and push the changed rows to
+# the agents' inbox sockets (publish_inbox).
+
+PREVIEW_LEN = 100
+INBOX_GROUP = 'inbox'  # channel layer group of every InboxConsumer
+
+
+def message_preview(message):
+    if message.message_text:
+        return str(message.message_text)[:PREVIEW_LEN]
+    if message.media_url:
+        return f"[{message.message_type}]"
+    return ''
+
+
+def record_message(message):
+    """Fold one freshly saved ChatMessage into its Conversation row."""
+    record_messages([message])
+
+
+def record_messages(messages):
+    """
+    Fold a batch of freshly saved ChatMessages (e.g. one webhook payload) into
+    their Conversation rows: one UPDATE (or INSERT) per sender, not per message.
+    Cache invalidation waits for the surrounding transaction to commit.
+    """
+    by_sender = {}
+    for message in messages:
+        by_sender.setdefault(message.sender_id, []).append(message)
+
+    for sender_id, batch in by_sender.items():
+        last = batch[-1]
+        unread = sum(1 for m in batch if m.is_from_user)
+        values = {
+            'last_message_at': last.timestamp,
+            'last_message_preview': message_preview(last),
+            'last_message_is_from_user': last.is_from_user,
+            'message_count': F('message_count') + len(batch),
+        }
+        if unread:
+            values['unread_count'] = F('unread_count') + unread
+
+        if not Conversation.objects.filter(sender_id=sender_id).update(**values):
+            try:
+                with transaction.atomic():
+                    Conversation.objects.create(
+                        sender_id=sender_id,
+                        last_message_at=last.timestamp,
+                        last_message_preview=values['last_message_preview'],
+                        last_message_is_from_user=last.is_from_user,
+                        message_count=len(batch),
+                        unread_count=unread,
+                    )
+            except IntegrityError:
+                # another worker created it first
+                Conversation.objects.filter(sender_id=sender_id).update(**values)
+        transaction.on_commit(lambda sender_id=sender_id: caching.invalidate_conversation(sender_id))
+    transaction.on_commit(lambda: recent.append_messages(messages))
+    transaction.on_commit(lambda: publish_inbox(list(by_sender)))
+
+
+def mark_read(sender_id):
+    if Conversation.objects.filter(sender_id=sender_id, unread_count__gt=0).update(unread_count=0):
+        caching.invalidate_conversation(sender_id)
+        publish_inbox([sender_id])
+
+
+def delete_conversation(sender_id):
+    Conversation.objects.filter(sender_id=sender_id).delete()
+    caching.invalidate_conversation(sender_id)
+    recent.forget(sender_id)
+    publish_inbox(deleted=[sender_id])
+
+
+def publish_inbox(sender_ids=(), deleted=()):
+    """
+    Send the current rows of these conversations (new ones included) and the
+    deleted sender ids to every inbox socket, in one group_send. Call after
+    commit; the rows come from the conversation cache. Never raises.
+    """
+    if not settings.WS_INBOX_EVENTS:
+        return
+    try:
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        conversations = [conversation for conversation in map(cached_conversation, sender_ids) if conversation]
+        async_to_sync(channel_layer.group_send)(
+            INBOX_GROUP, {'type': 'inbox_update', 'conversations': conversations, 'deleted': list(deleted)}
+        )
+    except Exception as e:
+        meta_api_logger.warning(f"Inbox update for {list(sender_ids) + list(deleted)} failed: {e}")
+
+
+def rebuild_conversation(sender_id):
+    """Recompute one row from ChatMessage (backfill / repair)."""
+    messages = ChatMessage.objects.filter(sender_id=sender_id)
+    last = messages.order_by('-timestamp', '-id').first()
+    if last is None:
+        delete_conversation(sender_id)
+        return None
+    conversation, _ = Conversation.objects.update_or_create(
+        sender_id=sender_id,
+        defaults={
+            'last_message_at': last.timestamp,
+            'last_message_preview': message_preview(last),
+            'last_message_is_from_user': last.is_from_user,
+            'message_count': messages.count(),
+        },
+    )
+    caching.invalidate_conversation(sender_id)
+    return conversation
+
+
+# --- keyset pagination ---
+def encode_cursor(conversation):
+    raw = f"{conversation.last_message_at.isoformat()}|{conversation.pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, pk = raw.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def inbox_page(limit, cursor=None):
+    """
+    One page of conversations, most recent activity first.
+    Returns (conversations, next_cursor); next_cursor is None on the last page.
+    """
+    queryset = Conversation.objects.order_by('-last_message_at', '-id')
+    if cursor:
+        last_message_at, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(last_message_at__lt=last_message_at) | Q(last_message_at=last_message_at, id__lt=pk))
+    rows = list(queryset[:limit + 1])
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def serialize_conversation(conversation):
+    return {
+        'sender_id': conversation.sender_id,
+        'last_message_at': conversation.last_message_at.isoformat(),
+        'last_message_preview': conversation.last_message_preview,
+        'last_message_is_from_user': conversation.last_message_is_from_user,
+        'message_count': conversation.message_count,
+        'unread_count': conversation.unread_count,
+    }
+
+
+# --- cached readers ---
+def cached_inbox_page(limit, cursor=None):
+    """inbox_page() as ([serialized conversation], next_cursor), from cache when fresh."""
+    def load():
+        conversations, next_cursor = inbox_page(limit, cursor)
+        return [serialize_conversation(c) for c in conversations], next_cursor
+    return caching.get_or_set('inbox', caching.inbox_key(limit, cursor), load)
+
+
+def cached_conversation(sender_id):
+    def load():
+        conversation = Conversation.objects.filter(sender_id=sender_id).first()
+        return serialize_conversation(conversation) if conversation else None
+    return caching.get_or_set('conversation', caching.conversation_key(sender_id), load)
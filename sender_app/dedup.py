@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+# --- Recently seen WhatsApp message ids (wamid) ---
+# Meta redelivers webhooks when we are slow to answer. This in-process LRU
+# drops redeliveries before any media download or DB query; the unique index
+# on ChatMessage.wamid is the real guarantee across processes/restarts.
+#
+# A wamid is "reserved" while its webhook is being processed (so two workers
+# handling the same redelivery don't both download the media) and only moves
+# into the LRU once its row is committed. A failed attempt releases it, so a
+# retry is not mistaken for a duplicate. A delivery that arrives while the
+# wamid is still in flight is not acked as a duplicate either (the first
+# attempt may yet fail): process_webhook_payload raises DuplicateInFlight so
+# the webhook gets a non-2xx answer and Meta delivers it again later.
+
+
+class DuplicateInFlight(Exception):
+    def __init__(self, wamids):
+        self.wamids = wamids
+        super().__init__(f"{len(wamids)} message(s) still being processed by another worker: {', '.join(wamids[:5])}")
+
+
+class RecentIdSet:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._recent = OrderedDict()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, wamid):
+        with self._lock:
+            return wamid in self._recent or wamid in self._in_flight
+
+    def __len__(self):
+        with self._lock:
+            return len(self._recent)
+
+    def reserve(self, wamid):
+        """True if the caller should process `wamid`; False if it is a known duplicate or in flight."""
+        with self._lock:
+            if wamid in self._recent:
+                self._recent.move_to_end(wamid)
+                return False
+            if wamid in self._in_flight:
+                return False
+            self._in_flight.add(wamid)
+            return True
+
+    def in_flight(self, wamid):
+        with self._lock:
+            return wamid in self._in_flight
+
+    def commit(self, wamid):
+        with self._lock:
+            self._in_flight.discard(wamid)
+            self._recent[wamid] = True
+            self._recent.move_to_end(wamid)
+            while len(self._recent) > self.capacity:
+                self._recent.popitem(last=False)
+
+    def release(self, wamid):
+        with self._lock:
+            self._in_flight.discard(wamid)
+
+
+_recent_ids = None
+_recent_ids_lock = threading.Lock()
+
+
+def recent_ids():
+    global _recent_ids
+    with _recent_ids_lock:
+        if _recent_ids is None:
+            _recent_ids = RecentIdSet(settings.WEBHOOK_DEDUP_CACHE_SIZE)
+        return _recent_ids
@@ -0,0 +1,188 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Max
+from django.utils import timezone
+
+from .archive import read_archive
+from .conversations import delete_conversation, rebuild_conversation
+from .media import release_media
+from .models import ChatDeletion, ChatMessage, MessageArchive
+from .recent import forget as forget_recent
+
+meta_api_logger = logging.getLogger('meta_api_logger')
+
+# --- Background chat deletion ---
+# DELETE /api/delete_chat/<phone>/ only records a ChatDeletion job (and drops
+# the inbox row) and answers 202. The job deletes the contact's messages in
+# chunks of CHAT_DELETE_CHUNK_SIZE, one short transaction each, releases the
+# media blob references they held, removes the contact's archive files and
+# finally rebuilds the inbox row from whatever arrived after the request.
+# Jobs run on a single background thread of the web process
+# (CHAT_DELETE_IN_PROCESS) or in `manage.py process_deletions`; a job whose
+# runner died goes back to pending once its lease expires. In-process, a watch
+# thread started at boot (sender_app.apps) picks up jobs left by a previous
+# process and checks for expired leases every CHAT_DELETE_LEASE_SECONDS.
+
+_executor = None
+_executor_lock = threading.Lock()
+_watch_started = False
+
+
+def get_deletion_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # one thread: deletions are background work, never a burst of parallel bulk deletes
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-deletion')
+        return _executor
+
+
+def request_deletion(sender_id):
+    """Queue the deletion of a contact's history. Returns the job, or None if there is nothing to delete."""
+    max_id = max(
+        ChatMessage.objects.filter(sender_id=sender_id).aggregate(max_id=Max('id'))['max_id'] or 0,
+        MessageArchive.objects.filter(sender_id=sender_id).aggregate(max_id=Max('last_id'))['max_id'] or 0,
+    )
+    if not max_id:
+        return None
+    with transaction.atomic():
+        job = ChatDeletion.objects.select_for_update().filter(sender_id=sender_id, status=ChatDeletion.STATUS_PENDING).first()
+        if job is not None:
+            job.max_message_id = max(job.max_message_id, max_id)
+            job.save(update_fields=['max_message_id'])
+        else:
+            job = ChatDeletion.objects.create(sender_id=sender_id, max_message_id=max_id)
+        delete_conversation(sender_id)
+        if settings.CHAT_DELETE_IN_PROCESS:
+            transaction.on_commit(lambda: get_deletion_executor().submit(_run_pending_job))
+    meta_api_logger.info(f"Deletion {job.pk} of chat {sender_id} queued (messages up to #{max_id})")
+    return job
+
+
+def deletion_status(job):
+    return {
+        'id': job.pk,
+        'sender_id': job.sender_id,
+        'status': job.status,
+        'deleted_messages': job.deleted_messages,
+        'deleted_archives': job.deleted_archives,
+        'requested_at': job.requested_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'error': job.last_error,
+    }
+
+
+def requeue_stale():
+    cutoff = timezone.now() - timedelta(seconds=settings.CHAT_DELETE_LEASE_SECONDS)
+    count = ChatDeletion.objects.filter(status=ChatDeletion.STATUS_RUNNING, locked_at__lt=cutoff).update(
+        status=ChatDeletion.STATUS_PENDING, locked_at=None,
+    )
+    if count:
+        meta_api_logger.warning(f"Requeued {count} stale chat deletions (lease > {settings.CHAT_DELETE_LEASE_SECONDS}s)")
+    return count
+
+
+def run_pending():
+    """Run every job pending right now, each once. Returns the number of jobs run."""
+    requeue_stale()
+    job_ids = list(ChatDeletion.objects.filter(status=ChatDeletion.STATUS_PENDING).order_by('id').values_list('id', flat=True))
+    return sum(1 for job_id in job_ids if run_deletion(job_id))
+
+
+def start_watch():
+    """Run leftover jobs now, and again every lease period (stale 'running' jobs). Once per process."""
+    global _watch_started
+    with _executor_lock:
+        if _watch_started:
+            return
+        _watch_started = True
+
+    def watch():
+        while True:
+            get_deletion_executor().submit(_run_pending_job)
+            time.sleep(settings.CHAT_DELETE_LEASE_SECONDS)
+
+    threading.Thread(target=watch, name='chat-deletion-watch', daemon=True).start()
+
+
+def _run_pending_job():
+    close_old_connections()
+    try:
+        run_pending()
+    except Exception as e:
+        meta_api_logger.exception(f"Chat deletion runner error: {e}")
+    finally:
+        close_old_connections()
+
+
+def run_deletion(job_id):
+    """Claim one pending job and run it to the end. Returns False if another runner has it."""
+    claimed = ChatDeletion.objects.filter(pk=job_id, status=ChatDeletion.STATUS_PENDING).update(
+        status=ChatDeletion.STATUS_RUNNING, locked_at=timezone.now(), attempts=F('attempts') + 1,
+    )
+    if not claimed:
+        return False
+    job = ChatDeletion.objects.get(pk=job_id)
+    started = time.monotonic()
+    try:
+        _delete_messages(job)
+        _delete_archives(job)
+        rebuild_conversation(job.sender_id)
+        forget_recent(job.sender_id)  # a history load during the job may have cached doomed rows
+    except Exception as e:
+        retry = job.attempts < settings.CHAT_DELETE_MAX_ATTEMPTS
+        meta_api_logger.exception(f"Deletion {job.pk} of chat {job.sender_id} failed (attempt {job.attempts}): {e}")
+        ChatDeletion.objects.filter(pk=job.pk).update(
+            status=ChatDeletion.STATUS_PENDING if retry else ChatDeletion.STATUS_FAILED,
+            locked_at=None, last_error=str(e)[:2000],
+        )
+        return True
+
+    ChatDeletion.objects.filter(pk=job.pk).update(
+        status=ChatDeletion.STATUS_DONE, locked_at=None, finished_at=timezone.now(), last_error=None,
+    )
+    job.refresh_from_db()
+    meta_api_logger.info(
+        f"Deletion {job.pk} of chat {job.sender_id} done in {time.monotonic() - started:.1f}s: "
+        f"{job.deleted_messages} messages, {job.deleted_archives} archive files"
+    )
+    return True
+
+
+def _delete_messages(job):
+    messages = ChatMessage.objects.filter(sender_id=job.sender_id, id__lte=job.max_message_id)
+    while True:
+        rows = list(messages.order_by('id').values_list('id', 'media_url')[:settings.CHAT_DELETE_CHUNK_SIZE])
+        if not rows:
+            return
+        with transaction.atomic():
+            # the contact's rows in this id range are exactly the chunk read above
+            messages.filter(id__gte=rows[0][0], id__lte=rows[-1][0]).delete()
+            release_media(media_url for _, media_url in rows if media_url)
+            ChatDeletion.objects.filter(pk=job.pk).update(
+                deleted_messages=F('deleted_messages') + len(rows), locked_at=timezone.now(),
+            )
+        if settings.CHAT_DELETE_PAUSE_SECONDS:
+            time.sleep(settings.CHAT_DELETE_PAUSE_SECONDS)
+
+
+def _delete_archives(job):
+    for archive in MessageArchive.objects.filter(sender_id=job.sender_id, last_id__lte=job.max_message_id).order_by('id'):
+        media_urls = [message['media_url'] for message in read_archive(archive) if message['media_url']]
+        with transaction.atomic():
+            archive.delete()
+            release_media(media_urls)
+            ChatDeletion.objects.filter(pk=job.pk).update(
+                deleted_archives=F('deleted_archives') + 1, locked_at=timezone.now(),
+            )
+        try:
+            os.remove(os.path.join(settings.MESSAGE_ARCHIVE_ROOT, archive.path))
+        except FileNotFoundError:
+            pass
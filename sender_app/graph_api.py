@@ -0,0 +1,143 @@
+import logging
+import random
+import threading
+import time
+
+import requests
+import urllib3
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+
+meta_api_logger = logging.getLogger('meta_api_logger')
+
+# --- Shared Graph API client ---
+# One requests.Session per process, so calls to graph.facebook.com reuse
+# keep-alive connections instead of paying a TCP+TLS handshake per message.
+# Everything that talks to Meta goes through get_client(). Every attempt's
+# latency and status is exported as graph_api_request_duration_seconds /
+# graph_api_responses_total (sender_app.metrics, /metrics).
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# A POST (sending a message) is only retried when Meta surely didn't act on it: 429,
+# or the connection never opened. After a read timeout or a 5xx the message may
+# already be out, so neither this client nor the outbox / campaign runner sends it
+# again (see resend_is_safe): the row fails with "outcome unknown" for an operator
+# to check, rather than the customer possibly getting it twice.
+POST_RETRY_STATUSES = (429,)
+
+
+def request_not_sent(error):
+    """True if the request never reached the server (connect timeout, connection refused)."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+    return False
+
+
+def resend_is_safe(status=None, error=None):
+    """True if a failed send (HTTP `status`, or `error` raised by requests) cannot have reached the customer."""
+    if error is not None:
+        return request_not_sent(error)
+    return status in POST_RETRY_STATUSES
+
+
+class GraphAPIClient:
+    def __init__(self, access_token, phone_number_id, version='v20.0', base_url='https://graph.facebook.com',
+                 timeout=15, max_retries=2, backoff_base=0.5, backoff_max=8.0, pool_size=20):
+        self.phone_number_id = phone_number_id
+        self.version = version
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.auth_headers = {"Authorization": f"Bearer {access_token}"}
+
+        self.session = requests.Session()
+        # retries are done by _request (with jitter + Retry-After), not by urllib3
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    # --- urls ---
+    def url(self, path):
+        return f"{self.base_url}/{self.version}/{path.lstrip('/')}"
+
+    @property
+    def messages_url(self):
+        return self.url(f"{self.phone_number_id}/messages")
+
+    # --- public calls ---
+    def send_message(self, payload, timeout=None):
+        return self._request('POST', self.messages_url, endpoint='messages', json=payload, timeout=timeout)
+
+    def get_media_metadata(self, media_id, timeout=None):
+        return self._request('GET', self.url(media_id), endpoint='media_metadata', timeout=timeout)
+
+    def download(self, url, timeout=20, authorize=True):
+        """GET a media url with stream=True. Use as a context manager and read via iter_content()."""
+        return self._request('GET', url, endpoint='media_download', timeout=timeout, stream=True, authorize=authorize)
+
+    # --- internals ---
+    def _request(self, method, url, endpoint, timeout=None, authorize=True, **kwargs):
+        headers = dict(self.auth_headers) if authorize else {}
+        timeout = timeout or self.timeout
+        idempotent = method != 'POST'
+        retry_statuses = RETRY_STATUSES if idempotent else POST_RETRY_STATUSES
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, headers=headers, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self._record(endpoint, 'error', time.monotonic() - started)
+                if attempt >= self.max_retries or not (idempotent or request_not_sent(e)):
+                    raise
+                delay = self._backoff(attempt)
+                meta_api_logger.warning(f"Graph API {endpoint} network error ({e}), retry {attempt + 1} in {delay:.2f}s")
+            else:
+                elapsed = time.monotonic() - started
+                response.graph_elapsed_ms = round(elapsed * 1000, 1)
+                self._record(endpoint, response.status_code, elapsed)
+                if response.status_code not in retry_statuses or attempt >= self.max_retries:
+                    return response
+                delay = self._backoff(attempt, response.headers.get('Retry-After'))
+                meta_api_logger.warning(f"Graph API {endpoint} returned {response.status_code}, retry {attempt + 1} in {delay:.2f}s")
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        # full jitter: uniform(0, base * 2^attempt)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _record(self, endpoint, status, elapsed):
+        metrics.graph_api_request_seconds.observe(elapsed, endpoint=endpoint)
+        metrics.graph_api_responses.inc(endpoint=endpoint, status=status)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Process-wide client configured from settings (created on first use)."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = GraphAPIClient(
+                access_token=settings.WHATSAPP_ACCESS_TOKEN,
+                phone_number_id=settings.WHATSAPP_PHONE_NUMBER_ID,
+                version=settings.WHATSAPP_API_VERSION,
+                base_url=settings.GRAPH_API_BASE_URL,
+                timeout=settings.GRAPH_API_TIMEOUT,
+                max_retries=settings.GRAPH_API_MAX_RETRIES,
+                pool_size=settings.GRAPH_API_POOL_SIZE,
+            )
+        return _client
@@ -0,0 +1,105 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, F, Min
+from django.utils import timezone
+
+from .models import WebhookEvent
+
+meta_api_logger = logging.getLogger('meta_api_logger')
+
+# --- Durable webhook journal ---
+# webhook_view (queue mode) only calls enqueue_webhook() and returns 200.
+# `manage.py process_webhooks` claims events, processes them and marks them done.
+# An event is only marked done AFTER processing, so a crash mid-way means the
+# lease expires and the event is processed again (at-least-once).
+
+
+def enqueue_webhook(raw_body):
+    if isinstance(raw_body, bytes):
+        raw_body = raw_body.decode('utf-8')
+    return WebhookEvent.objects.create(body=raw_body)
+
+
+def claim_events(limit):
+    """
+    Claim up to `limit` due events for this worker.
+    Each claim is a conditional UPDATE on status, so concurrent workers
+    (threads or processes, any DB backend) never get the same event.
+    """
+    now = timezone.now()
+    candidates = (
+        WebhookEvent.objects
+        .filter(status=WebhookEvent.STATUS_PENDING)
+        .exclude(available_at__gt=now)
+        .order_by('id')
+        .values_list('id', flat=True)[:limit]
+    )
+    claimed = []
+    for event_id in list(candidates):
+        updated = WebhookEvent.objects.filter(pk=event_id, status=WebhookEvent.STATUS_PENDING).update(
+            status=WebhookEvent.STATUS_PROCESSING,
+            locked_at=now,
+            attempts=F('attempts') + 1,
+        )
+        if updated:
+            claimed.append(event_id)
+    return list(WebhookEvent.objects.filter(pk__in=claimed).order_by('id'))
+
+
+def mark_done(event):
+    WebhookEvent.objects.filter(pk=event.pk).update(
+        status=WebhookEvent.STATUS_DONE,
+        processed_at=timezone.now(),
+        locked_at=None,
+        last_error=None,
+    )
+
+
+def mark_failed(event, error):
+    """
+    Put the event back with exponential backoff, or park it as failed
+    once it has used up WEBHOOK_QUEUE_MAX_ATTEMPTS.
+    """
+    if event.attempts >= settings.WEBHOOK_QUEUE_MAX_ATTEMPTS:
+        status = WebhookEvent.STATUS_FAILED
+        available_at = None
+        meta_api_logger.error(f"Webhook event {event.pk} failed permanently after {event.attempts} attempts: {error}")
+    else:
+        status = WebhookEvent.STATUS_PENDING
+        available_at = timezone.now() + timedelta(seconds=min(2 ** event.attempts, 300))
+        meta_api_logger.warning(f"Webhook event {event.pk} failed (attempt {event.attempts}), retrying: {error}")
+    WebhookEvent.objects.filter(pk=event.pk).update(
+        status=status,
+        available_at=available_at,
+        locked_at=None,
+        last_error=str(error)[:2000],
+    )
+
+
+def requeue_stale(lease_seconds):
+    """Give back events whose worker died while holding them."""
+    cutoff = timezone.now() - timedelta(seconds=lease_seconds)
+    count = WebhookEvent.objects.filter(
+        status=WebhookEvent.STATUS_PROCESSING, locked_at__lt=cutoff
+    ).update(status=WebhookEvent.STATUS_PENDING, locked_at=None)
+    if count:
+        meta_api_logger.warning(f"Requeued {count} stale webhook events (lease > {lease_seconds}s)")
+    return count
+
+
+def purge_done(older_than_hours):
+    cutoff = timezone.now() - timedelta(hours=older_than_hours)
+    deleted, _ = WebhookEvent.objects.filter(status=WebhookEvent.STATUS_DONE, processed_at__lt=cutoff).delete()
+    return deleted
+
+
+def queue_depth():
+    """Counts per status plus the age of the oldest pending event."""
+    counts = {status: 0 for status, _ in WebhookEvent.STATUS_CHOICES}
+    for row in WebhookEvent.objects.values('status').annotate(n=Count('id')):
+        counts[row['status']] = row['n']
+    oldest = WebhookEvent.objects.filter(status=WebhookEvent.STATUS_PENDING).aggregate(oldest=Min('received_at'))['oldest']
+    counts['oldest_pending_age_seconds'] = round((timezone.now() - oldest).total_seconds(), 1) if oldest else 0
+    return counts
@@ -0,0 +1,164 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# --- Logging helpers for meta_api_logger (wired up in settings.LOGGING) ---
+# BackgroundRotatingFileHandler: the calling thread only puts the record on a
+#   bounded in-memory queue; a QueueListener thread formats and writes it to a
+#   size-rotated file. A full queue drops the record (and counts it) instead of
+#   blocking a request or consumer, before its message (and any LazyJson
+#   argument) is rendered.
+# JsonLinesFormatter: one JSON object per line; `extra={...}` fields
+#   (sender, wamid, latency_ms, status, ...) become top-level keys.
+# SamplingFilter: keeps a fraction of records tagged with extra={'event': name}.
+# LazyJson / truncate_json / truncate_text: payloads for log lines, serialized
+#   only if the record survives filtering and never past the length limit.
+#
+# Rotation is per process: with several worker processes writing the same
+# file, give each its own LOG_FILE (or log to stdout) to avoid rotation races.
+
+TRUNCATED_MARK = '…[truncated]'
+
+# attributes every LogRecord has; anything else came from `extra=`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+def truncate_json(value, limit):
+    """json.dumps(value) cut at `limit` chars, encoding no more of `value` than that."""
+    parts = []
+    size = 0
+    for chunk in json.JSONEncoder(ensure_ascii=False, default=str).iterencode(value):
+        parts.append(chunk)
+        size += len(chunk)
+        if size > limit:
+            return ''.join(parts)[:limit] + TRUNCATED_MARK
+    return ''.join(parts)
+
+
+def truncate_text(value, limit):
+    """First `limit` chars of a str (or bytes, decoded after slicing)."""
+    if value is None:
+        return ''
+    if isinstance(value, (bytes, bytearray)):
+        text = bytes(value[:limit * 4]).decode('utf-8', errors='replace')
+        return text[:limit] + TRUNCATED_MARK if len(value) > limit else text
+    return value[:limit] + TRUNCATED_MARK if len(value) > limit else value
+
+
+class LazyJson:
+    """Log argument that runs truncate_json only when the message is actually formatted."""
+
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        from django.conf import settings
+        return truncate_json(self.value, self.limit or settings.LOG_PAYLOAD_MAX_CHARS)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep records with extra={'event': name} at the rate configured for `name`
+    (e.g. {'webhook_received': 0.1}); records without an event, or at WARNING
+    and above, always pass.
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = rates or {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, 'event', None))
+        return rate is None or random.random() < rate
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and key not in entry:
+                entry[key] = str(value) if isinstance(value, LazyJson) else value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class BackgroundRotatingFileHandler(QueueHandler):
+    """QueueHandler feeding a RotatingFileHandler on a QueueListener thread (see the section comment)."""
+
+    def __init__(self, filename, maxBytes=0, backupCount=0, queue_size=10000, encoding='utf-8'):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.file_handler = RotatingFileHandler(filename, maxBytes=maxBytes, backupCount=backupCount, encoding=encoding, delay=True)
+        self.dropped = 0
+        self._unreported = 0
+        self._dropped_lock = threading.Lock()
+        self.listener = QueueListener(self.queue, self.file_handler, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def setFormatter(self, fmt):
+        # formatting happens on the listener thread, in the file handler
+        self.file_handler.setFormatter(fmt)
+
+    def emit(self, record):
+        # checked before prepare(): a record that is going to be dropped is not rendered
+        if self.queue.full():
+            self._drop()
+            return
+        super().emit(record)
+
+    def _drop(self):
+        with self._dropped_lock:
+            self.dropped += 1
+            self._unreported += 1
+
+    def prepare(self, record):
+        # Resolve the message now (args may change later); keep exc_info for the
+        # formatter. No copy/format here: the queue never leaves this process.
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # filled up by another thread since emit() checked
+            self._drop()
+            return
+        if self._unreported:
+            with self._dropped_lock:
+                count, self._unreported = self._unreported, 0
+            if count:
+                notice = logging.LogRecord(record.name, logging.WARNING, __file__, 0, f"Log queue full: dropped {count} records", None, None)
+                try:
+                    self.queue.put_nowait(notice)
+                except queue.Full:
+                    with self._dropped_lock:
+                        self._unreported += count
+
+    def close(self):
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()  # drains what is queued
+            self.file_handler.close()
+        super().close()
@@ -0,0 +1,43 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from sender_app.archive import archive_chunk, archive_cutoff_id
+from sender_app.models import ChatMessage
+
+
+class Command(BaseCommand):
+    help = (
+        "Move chat messages older than MESSAGE_ARCHIVE_AFTER_DAYS into gzip JSONL archive files "
+        "(MESSAGE_ARCHIVE_ROOT), one transaction per chunk. Chat history still reads them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=None, help="Override MESSAGE_ARCHIVE_AFTER_DAYS.")
+        parser.add_argument('--chunk-size', type=int, default=None, help="Override MESSAGE_ARCHIVE_CHUNK_SIZE.")
+        parser.add_argument('--max-chunks', type=int, default=None, help="Stop after this many chunks (spread a big backlog over several runs).")
+        parser.add_argument('--pause', type=float, default=0.0, help="Seconds to sleep between chunks, to go easy on the database.")
+        parser.add_argument('--dry-run', action='store_true', help="Only report how many messages would be archived.")
+
+    def handle(self, *args, **options):
+        days = settings.MESSAGE_ARCHIVE_AFTER_DAYS if options['older_than_days'] is None else options['older_than_days']
+        max_id = archive_cutoff_id(days)
+        if max_id is None:
+            self.stdout.write(f"Nothing older than {days} days.")
+            return
+        if options['dry_run']:
+            count = ChatMessage.objects.filter(id__lte=max_id).count()
+            self.stdout.write(f"Would archive {count} messages (ids <= {max_id}, older than {days} days).")
+            return
+
+        total = chunks = 0
+        while options['max_chunks'] is None or chunks < options['max_chunks']:
+            archived = archive_chunk(max_id, options['chunk_size'])
+            if not archived:
+                break
+            total += archived
+            chunks += 1
+            if options['pause']:
+                time.sleep(options['pause'])
+        self.stdout.write(f"Archived {total} messages in {chunks} chunks (ids <= {max_id}, older than {days} days).")
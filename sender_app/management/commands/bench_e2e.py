@@ -0,0 +1,286 @@
+import asyncio
+import json
+import random
+import time
+from itertools import count
+from uuid import uuid4
+
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from sender_app.benchmarks import fake_graph_api, isolated_database, summarize
+
+# phase -> latency series whose p95 is compared against --baseline
+BASELINE_KEYS = {
+    'ingest': 'request_ms',
+    'fanout': 'delivery_ms',
+    'history': 'latency_ms',
+    'search': 'latency_ms',
+    'outbound': 'enqueue_to_sent_ms',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "End-to-end benchmark against a local Graph API stand-in: webhook ingest (with media "
+        "downloads), websocket fan-out to N ChatConsumer clients, history load, search and "
+        "outbound sends through the dispatcher. Reports throughput and p50/p95/p99 per phase. "
+        "Runs offline on a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--senders', type=int, default=50, help="Distinct contacts.")
+        parser.add_argument('--clients', type=int, default=100, help="Websocket clients, spread over the contacts.")
+        parser.add_argument('--payloads', type=int, default=300, help="Webhook POSTs in the ingest phase.")
+        parser.add_argument('--batch', type=int, default=5, help="Messages per webhook payload.")
+        parser.add_argument('--media-every', type=int, default=10, help="Every Nth incoming message is audio (0 = text only).")
+        parser.add_argument('--requests', type=int, default=300, help="Requests in the history and search phases.")
+        parser.add_argument('--outbound', type=int, default=300, help="Operator messages in the outbound phase.")
+        parser.add_argument('--outbound-workers', type=int, default=8)
+        parser.add_argument('--graph-latency-ms', type=float, default=50.0, help="Latency of every fake Graph API call.")
+        parser.add_argument('--graph-error-rate', type=float, default=0.0, help="Share of fake Graph API calls answered with 503.")
+        parser.add_argument('--layer-latency-ms', type=float, default=1.0, help="Simulated channel layer (Redis) round trip.")
+        parser.add_argument('--timeout', type=float, default=120.0, help="Max seconds to wait for deliveries / the outbox to drain.")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', help="Also write the JSON report to this file.")
+        parser.add_argument('--baseline', help="Report from an earlier run: fail if a phase's p95 regressed past --max-regression.")
+        parser.add_argument('--max-regression', type=float, default=25.0, help="Allowed p95 increase over the baseline, in percent.")
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        self.options = options
+        self.senders = [str(15550000000 + i) for i in range(options['senders'])]
+        self.seq = count(1)
+
+        with isolated_database(layer_latency_ms=options['layer_latency_ms'], threaded=True):
+            with fake_graph_api(options['graph_latency_ms'], options['graph_error_rate']) as api:
+                self.http = Client()
+                session = self.http.session
+                session['is_authenticated'] = True
+                session.save()
+                report = asyncio.run(self._run())
+                report['graph_api_calls'] = dict(sorted(api.counts.items()))
+
+        report['config'] = {key: options[key] for key in (
+            'senders', 'clients', 'payloads', 'batch', 'media_every', 'requests', 'outbound',
+            'outbound_workers', 'graph_latency_ms', 'graph_error_rate', 'layer_latency_ms',
+        )}
+        text = json.dumps(report, indent=2)
+        self.stdout.write(text)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(text + '\n')
+        if options['baseline']:
+            self._compare(report, options['baseline'], options['max_regression'])
+
+    # --- phases ---
+    async def _run(self):
+        from whatsapp_sender.asgi import application
+
+        report = {}
+        self.sent_at = {}       # seq -> perf_counter when the message entered the app
+        self.deliveries = []    # ms from webhook POST / operator send to each client frame
+        self.echoes = []        # ms from operator send to each frame on the contact's sockets
+        self.frames = 0         # websocket frames received (a batch frame carries several messages)
+
+        # --- websocket clients ---
+        # sockets need the logged-in session too
+        cookie = [(b'cookie', f"{settings.SESSION_COOKIE_NAME}={self.http.session.session_key}".encode())]
+        clients = [(self.senders[i % len(self.senders)], WebsocketCommunicator(application, f"/ws/chat/{self.senders[i % len(self.senders)]}/", headers=cookie))
+                   for i in range(self.options['clients'])]
+        started = time.perf_counter()
+        results = await asyncio.gather(*(c.connect(timeout=self.options['timeout']) for _, c in clients), return_exceptions=True)
+        connect_seconds = time.perf_counter() - started
+        clients = [(sender, c) for (sender, c), r in zip(clients, results) if not isinstance(r, BaseException) and r[0]]
+        readers = [asyncio.ensure_future(self._read(c)) for _, c in clients]
+        report['websocket'] = {
+            'connections_requested': self.options['clients'],
+            'connections_open': len(clients),
+            'connect_seconds': round(connect_seconds, 3),
+        }
+
+        subscribers = {}
+        for sender, _ in clients:
+            subscribers[sender] = subscribers.get(sender, 0) + 1
+        self.subscribers = subscribers
+
+        warm_up = self._payload(1, media=False)  # connections, caches
+        await sync_to_async(self._post_webhook)(warm_up)
+        await self._wait_for(lambda: len(self.deliveries) >= subscribers.get(warm_up['entry'][0]['changes'][0]['value']['messages'][0]['from'], 0))
+
+        # --- webhook ingest + fan-out ---
+        self.deliveries.clear()
+        self.frames = 0
+        fanout_expected = 0
+        request_ms, messages, statuses = [], 0, {}
+        started = time.perf_counter()
+        for _ in range(self.options['payloads']):
+            payload = self._payload(self.options['batch'])
+            for message in payload['entry'][0]['changes'][0]['value']['messages']:
+                messages += 1
+                if message['type'] == 'text':
+                    fanout_expected += subscribers.get(message['from'], 0)
+            status, elapsed_ms = await sync_to_async(self._post_webhook)(payload)
+            statuses[status] = statuses.get(status, 0) + 1
+            request_ms.append(elapsed_ms)
+        ingest_seconds = time.perf_counter() - started
+        await self._wait_for(lambda: len(self.deliveries) >= fanout_expected)
+        report['ingest'] = {
+            'payloads': len(request_ms),
+            'messages': messages,
+            'statuses': statuses,
+            'seconds': round(ingest_seconds, 3),
+            'messages_per_second': round(messages / ingest_seconds, 1) if ingest_seconds else 0,
+            'request_ms': summarize(request_ms),
+        }
+        report['fanout'] = {
+            'messages_expected': fanout_expected,
+            'messages_received': len(self.deliveries),
+            'frames_received': self.frames,
+            'delivery_ms': summarize(self.deliveries),
+        }
+
+        # --- history / search ---
+        report['history'] = await self._http_phase(lambda: f"/api/chat/{random.choice(self.senders)}/")
+        terms = ['benchmark', 'message', random.choice(self.senders)[-4:], 'nothing-matches-this']
+        report['search'] = await self._http_phase(lambda: f"/api/search_chats/?q={random.choice(terms)}")
+
+        # --- outbound: operator sends over the socket, the dispatcher delivers to the fake Graph API ---
+        report['outbound'] = await self._outbound_phase(clients)
+
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        await asyncio.gather(*(c.disconnect() for _, c in clients), return_exceptions=True)
+        return report
+
+    async def _http_phase(self, make_path):
+        latencies, statuses = [], {}
+        started = time.perf_counter()
+        for _ in range(self.options['requests']):
+            status, elapsed_ms = await sync_to_async(self._get)(make_path())
+            statuses[status] = statuses.get(status, 0) + 1
+            latencies.append(elapsed_ms)
+        seconds = time.perf_counter() - started
+        return {
+            'requests': len(latencies),
+            'statuses': statuses,
+            'requests_per_second': round(len(latencies) / seconds, 1) if seconds else 0,
+            'latency_ms': summarize(latencies),
+        }
+
+    async def _outbound_phase(self, clients):
+        from sender_app.models import OutboundMessage
+        from sender_app.outbound import OutboundDispatcher
+
+        dispatcher = OutboundDispatcher(workers=self.options['outbound_workers'], rate=10000, poll_interval=0.2)
+        await sync_to_async(dispatcher.start)()
+        self.echoes.clear()
+        echoes_expected = 0
+        first_id = await sync_to_async(lambda: (OutboundMessage.objects.order_by('-id').values_list('id', flat=True).first() or 0))()
+        started = time.perf_counter()
+        try:
+            for i in range(self.options['outbound']):
+                sender, communicator = clients[i % len(clients)]
+                seq = next(self.seq)
+                echoes_expected += self.subscribers[sender]
+                self.sent_at[seq] = time.perf_counter()
+                await communicator.send_to(text_data=json.dumps({'message': f"operator reply #{seq}"}))
+            pending = OutboundMessage.objects.filter(id__gt=first_id).exclude(status__in=[OutboundMessage.STATUS_SENT, OutboundMessage.STATUS_FAILED])
+            created = OutboundMessage.objects.filter(id__gt=first_id)
+            await self._wait_for(lambda: len(self.echoes) >= echoes_expected)
+            await self._wait_for_sync(lambda: created.count() >= self.options['outbound'] and not pending.exists())
+        finally:
+            await sync_to_async(dispatcher.stop)()
+        seconds = time.perf_counter() - started
+
+        rows = await sync_to_async(lambda: list(created.values_list('status', 'created_at', 'sent_at', 'attempts')))()
+        sent = [(created_at, sent_at) for status, created_at, sent_at, _ in rows if status == OutboundMessage.STATUS_SENT]
+        return {
+            'messages': self.options['outbound'],
+            'sent': len(sent),
+            'failed': sum(1 for status, *_ in rows if status == OutboundMessage.STATUS_FAILED),
+            'unsent': sum(1 for status, *_ in rows if status not in (OutboundMessage.STATUS_SENT, OutboundMessage.STATUS_FAILED)),
+            'retries': sum(max(0, attempts - 1) for *_, attempts in rows),
+            'seconds': round(seconds, 3),
+            'messages_per_second': round(len(sent) / seconds, 1) if seconds else 0,
+            'ws_messages_expected': echoes_expected,
+            'ws_messages_received': len(self.echoes),
+            'ws_delivery_ms': summarize(self.echoes),
+            'enqueue_to_sent_ms': summarize([(sent_at - created_at).total_seconds() * 1000 for created_at, sent_at in sent]),
+        }
+
+    # --- helpers ---
+    def _payload(self, n_messages, media=True):
+        messages = []
+        for _ in range(n_messages):
+            seq = next(self.seq)
+            message = {'id': f"wamid.bench.{uuid4().hex}", 'from': random.choice(self.senders), 'timestamp': str(int(time.time()))}
+            if media and self.options['media_every'] and seq % self.options['media_every'] == 0:
+                message.update(type='audio', audio={'id': f"aud{seq}", 'mime_type': 'audio/ogg'})
+            else:
+                message.update(type='text', text={'body': f"benchmark message #{seq}"})
+            messages.append(message)
+        return {'entry': [{'changes': [{'value': {'messages': messages}}]}]}
+
+    def _post_webhook(self, payload):
+        body = json.dumps(payload)
+        started = time.perf_counter()
+        for message in payload['entry'][0]['changes'][0]['value']['messages']:
+            if message['type'] == 'text':
+                self.sent_at[int(message['text']['body'].rsplit('#', 1)[1])] = started
+        response = self.http.post('/webhook', body, content_type='application/json')
+        return response.status_code, (time.perf_counter() - started) * 1000
+
+    def _get(self, path):
+        started = time.perf_counter()
+        response = self.http.get(path)
+        return response.status_code, (time.perf_counter() - started) * 1000
+
+    async def _read(self, communicator):
+        """Record how long each frame took from entering the app to reaching this socket."""
+        while True:
+            data = json.loads(await communicator.receive_from(timeout=3600))
+            received = time.perf_counter()
+            self.frames += 1
+            for frame in data['frames'] if data.get('type') == 'batch' else [data]:
+                text = frame.get('message') or ''
+                if '#' not in text:
+                    continue
+                try:
+                    seq = int(text.rsplit('#', 1)[1])
+                except ValueError:
+                    continue
+                if seq not in self.sent_at:
+                    continue
+                elapsed_ms = (received - self.sent_at[seq]) * 1000
+                if text.startswith('operator reply'):
+                    self.echoes.append(elapsed_ms)
+                else:
+                    self.deliveries.append(elapsed_ms)
+
+    async def _wait_for(self, condition):
+        deadline = time.monotonic() + self.options['timeout']
+        while not condition() and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+
+    async def _wait_for_sync(self, condition):
+        deadline = time.monotonic() + self.options['timeout']
+        while not await sync_to_async(condition)() and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    def _compare(self, report, path, max_regression):
+        with open(path) as f:
+            baseline = json.load(f)
+        regressions = []
+        for phase, key in BASELINE_KEYS.items():
+            before = baseline.get(phase, {}).get(key, {}).get('p95')
+            after = report.get(phase, {}).get(key, {}).get('p95')
+            if before and after and after > before * (1 + max_regression / 100):
+                regressions.append(f"{phase} p95 {before}ms -> {after}ms")
+        if regressions:
+            raise CommandError("Regressed past {}%: {}".format(max_regression, '; '.join(regressions)))
+        self.stderr.write(f"No p95 regression over {max_regression}% against {path}")
@@ -0,0 +1,58 @@
+import json
+import time
+from uuid import uuid4
+
+from django.core.management.base import BaseCommand
+
+from sender_app.benchmarks import isolated_database
+
+
+def build_payload(n_messages, n_senders=1):
+    """A webhook body with n text messages spread over n_senders contacts."""
+    messages = [
+        {
+            'id': f"wamid.bench.{uuid4().hex}",
+            'from': str(15550000000 + i % n_senders),
+            'type': 'text',
+            'text': {'body': f"benchmark message {i}"},
+        }
+        for i in range(n_messages)
+    ]
+    return {'entry': [{'changes': [{'value': {'messages': messages}}]}]}
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark webhook ingestion (process_webhook_payload) for payloads of 1, 10 and 100 "
+        "text messages and report rows/sec. Runs on a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1,10,100', help="Comma separated messages-per-payload.")
+        parser.add_argument('--rows', type=int, default=2000, help="Approximate rows to insert per size.")
+        parser.add_argument('--senders', type=int, default=1, help="Distinct contacts per payload.")
+        parser.add_argument('--layer-latency-ms', type=float, default=1.0, help="Simulated channel layer (Redis) round trip.")
+
+    def handle(self, *args, **options):
+        from sender_app.views import process_webhook_payload
+
+        sizes = [int(s) for s in options['sizes'].split(',') if s.strip()]
+        report = []
+        with isolated_database(layer_latency_ms=options['layer_latency_ms']):
+            process_webhook_payload(build_payload(1))  # warm up connections / caches
+            for size in sizes:
+                payloads = [build_payload(size, options['senders']) for _ in range(max(1, options['rows'] // size))]
+                started = time.perf_counter()
+                for payload in payloads:
+                    process_webhook_payload(payload)
+                elapsed = time.perf_counter() - started
+                rows = size * len(payloads)
+                report.append({
+                    'messages_per_payload': size,
+                    'payloads': len(payloads),
+                    'rows': rows,
+                    'seconds': round(elapsed, 3),
+                    'rows_per_second': round(rows / elapsed, 1),
+                    'ms_per_payload': round(elapsed / len(payloads) * 1000, 2),
+                })
+        self.stdout.write(json.dumps({'layer_latency_ms': options['layer_latency_ms'], 'results': report}, indent=2))
@@ -0,0 +1,29 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from sender_app.outbound import OutboundDispatcher, outbox_depth
+
+
+class Command(BaseCommand):
+    help = "Send queued OutboundMessage rows. Run exactly one (OUTBOUND_DISPATCH_IN_PROCESS=0, the default)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.OUTBOUND_WORKERS)
+        parser.add_argument('--rate', type=float, default=settings.OUTBOUND_RATE_PER_SECOND, help="Messages/second per business phone number (its share of PHONE_NUMBER_RATE_PER_SECOND).")
+        parser.add_argument('--poll-interval', type=float, default=0.5, help="Seconds between outbox polls when idle (new operator messages wait up to this long).")
+        parser.add_argument('--stats', action='store_true', help="Print outbox depth and exit.")
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.stdout.write(json.dumps(outbox_depth()))
+            return
+
+        dispatcher = OutboundDispatcher(workers=options['workers'], rate=options['rate'], poll_interval=options['poll_interval'])
+        self.stdout.write(f"Dispatching outbox with {dispatcher.workers} workers at {dispatcher.rate} msg/s: {outbox_depth()}")
+        try:
+            dispatcher.run_forever()
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping, waiting for in-flight sends...")
+            dispatcher.stop()
@@ -0,0 +1,157 @@
+import os
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from sender_app.archive import read_archive
+from sender_app.media import BLOB_NAME_RE, blob_sha_for_url
+from sender_app.models import ChatMessage, MediaBlob, MessageArchive
+
+MEDIA_PREFIX = '/media/'
+
+
+def iter_files(root):
+    """Yield (relative_path, DirEntry) for every file under root, one directory at a time."""
+    stack = ['']
+    while stack:
+        relative_dir = stack.pop()
+        try:
+            entries = os.scandir(os.path.join(root, relative_dir))
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                relative = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(relative)
+                elif entry.is_file(follow_symlinks=False):
+                    yield relative, entry
+
+
+class Command(BaseCommand):
+    help = (
+        "Garbage-collect MEDIA_ROOT: index every media_url/thumbnail_url referenced by messages "
+        "(live and archived), walk the media directory and delete files nothing references. "
+        "Content-addressed blobs also need ref_count 0. Run with --dry-run first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be deleted.")
+        parser.add_argument('--min-age-hours', type=float, default=24.0,
+                            help="Keep files modified more recently (downloads whose message isn't committed yet, reused blobs).")
+        parser.add_argument('--fix-refcounts', action='store_true',
+                            help="Also set blob ref_count to the number of references found. Run while webhooks are paused.")
+        parser.add_argument('--verbose-list', action='store_true', help="Print every orphaned file.")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        root = settings.MEDIA_ROOT
+
+        # --- index of referenced paths (relative to MEDIA_ROOT) ---
+        media_refs = Counter()
+        thumbnails = set()
+
+        def add(media_url, thumbnail_url):
+            if media_url and media_url.startswith(MEDIA_PREFIX):
+                media_refs[media_url[len(MEDIA_PREFIX):]] += 1
+            if thumbnail_url and thumbnail_url.startswith(MEDIA_PREFIX):
+                thumbnails.add(thumbnail_url[len(MEDIA_PREFIX):])
+
+        refcount_snapshot = dict(MediaBlob.objects.values_list('sha256', 'ref_count'))  # before the index, see --fix-refcounts
+        for media_url, thumbnail_url in ChatMessage.objects.values_list('media_url', 'thumbnail_url').iterator(chunk_size=5000):
+            add(media_url, thumbnail_url)
+        for archive in MessageArchive.objects.order_by('id').iterator():
+            for message in read_archive(archive):
+                add(message['media_url'], message['thumbnail_url'])
+
+        blob_refs = Counter()
+        for path, count in media_refs.items():
+            sha256 = blob_sha_for_url(MEDIA_PREFIX + path)
+            if sha256:
+                blob_refs[sha256] += count
+
+        # --- blob ref_count vs the index ---
+        report = Counter()
+        for sha256, ref_count in refcount_snapshot.items():
+            if ref_count == blob_refs.get(sha256, 0):
+                continue
+            report['refcount_mismatches'] += 1
+            if options['fix_refcounts'] and not dry_run:
+                # conditional: a reference taken since the snapshot keeps the row as it is
+                if MediaBlob.objects.filter(sha256=sha256, ref_count=ref_count).update(ref_count=blob_refs.get(sha256, 0)):
+                    refcount_snapshot[sha256] = blob_refs.get(sha256, 0)
+                    report['refcounts_fixed'] += 1
+
+        live_stems = {os.path.splitext(os.path.basename(path))[0] for path in media_refs}
+        live_stems.update(sha256 for sha256, ref_count in refcount_snapshot.items() if ref_count > 0)
+
+        # --- walk MEDIA_ROOT ---
+        min_mtime = time.time() - options['min_age_hours'] * 3600
+        seen_blobs = set()
+        for relative, entry in iter_files(root):
+            stat = entry.stat(follow_symlinks=False)
+            report['files'] += 1
+            report['bytes'] += stat.st_size
+            blob_match = BLOB_NAME_RE.match(entry.name) if relative.startswith('blobs/') else None
+            if blob_match:
+                seen_blobs.add(blob_match.group(1))
+            if relative in media_refs or relative in thumbnails:
+                continue
+            if relative.startswith('thumbs/'):
+                # a thumbnail is shared by every message of its source file, which may reuse it any time
+                if os.path.basename(relative).rsplit('_', 1)[0] in live_stems:
+                    continue
+            if stat.st_mtime > min_mtime:
+                report['skipped_recent'] += 1
+                continue
+
+            if blob_match and refcount_snapshot.get(blob_match.group(1), 0) > 0:
+                report['unreferenced_blobs_with_refs'] += 1
+                continue
+
+            report['orphans'] += 1
+            report['orphan_bytes'] += stat.st_size
+            if options['verbose_list']:
+                self.stdout.write(f"  orphan: {relative} ({stat.st_size} bytes)")
+            if dry_run:
+                continue
+            if blob_match:
+                with transaction.atomic():
+                    # ref_count may have gone up since the snapshot: then the blob stays
+                    blob_rows = MediaBlob.objects.filter(sha256=blob_match.group(1))
+                    if blob_rows.exclude(ref_count=0).exists():
+                        report['orphans'] -= 1
+                        continue
+                    blob_rows.delete()
+            try:
+                os.remove(entry.path)
+                report['deleted'] += 1
+                report['deleted_bytes'] += stat.st_size
+            except FileNotFoundError:
+                pass
+
+        # --- rows of blobs whose file is gone ---
+        missing = [sha256 for sha256, ref_count in refcount_snapshot.items() if sha256 not in seen_blobs and ref_count == 0]
+        report['blob_rows_without_file'] = len(missing)
+        if missing and not dry_run:
+            MediaBlob.objects.filter(sha256__in=missing, ref_count=0).delete()
+
+        self._report(report, dry_run)
+
+    def _report(self, report, dry_run):
+        mb = 1024 * 1024
+        self.stdout.write(f"Scanned {report['files']} files ({report['bytes'] / mb:.1f} MB) under MEDIA_ROOT")
+        if dry_run:
+            self.stdout.write(f"Would delete {report['orphans']} orphaned files ({report['orphan_bytes'] / mb:.1f} MB) [dry run]")
+        else:
+            self.stdout.write(f"Deleted {report['deleted']} orphaned files ({report['deleted_bytes'] / mb:.1f} MB)")
+        self.stdout.write(f"Skipped {report['skipped_recent']} unreferenced files newer than --min-age-hours")
+        if report['unreferenced_blobs_with_refs']:
+            self.stdout.write(f"Kept {report['unreferenced_blobs_with_refs']} unreferenced blobs whose ref_count is not 0 (see --fix-refcounts)")
+        self.stdout.write(
+            f"Blob ref_count mismatches: {report['refcount_mismatches']} (fixed {report['refcounts_fixed']}); "
+            f"blob rows without a file: {report['blob_rows_without_file']}"
+        )
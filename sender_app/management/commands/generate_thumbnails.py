@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from sender_app.models import ChatMessage
+from sender_app.thumbnails import create_thumbnail, thumbnails_enabled
+
+
+class Command(BaseCommand):
+    help = "Create thumbnails for stored image messages that don't have one yet (backfill)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None, help="Stop after this many messages.")
+
+    def handle(self, *args, **options):
+        if not thumbnails_enabled():
+            raise CommandError("Thumbnails are disabled (Pillow not installed or THUMBNAIL_MAX_SIZE=0).")
+
+        pending = (
+            ChatMessage.objects.filter(message_type='image', thumbnail_url__isnull=True, media_url__startswith='/media/')
+            .order_by('id').values_list('id', 'media_url', 'sender_id')
+        )
+        if options['limit']:
+            pending = pending[:options['limit']]
+        done = failed = 0
+        for message_id, media_url, sender_id in pending.iterator(chunk_size=500):
+            if create_thumbnail(message_id, media_url, sender_id):
+                done += 1
+            else:
+                failed += 1
+        self.stdout.write(f"Thumbnails created/linked: {done}, failed: {failed}")
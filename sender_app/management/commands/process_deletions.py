@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from sender_app.deletion import run_pending
+
+
+class Command(BaseCommand):
+    help = "Run queued chat deletions (use with CHAT_DELETE_IN_PROCESS=0 on the web process)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Run what is pending now and exit.")
+        parser.add_argument('--poll-interval', type=float, default=5.0)
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            count = run_pending()
+            if count:
+                self.stdout.write(f"Ran {count} chat deletions")
+            if options['once']:
+                return
+            try:
+                time.sleep(options['poll_interval'])
+            except KeyboardInterrupt:
+                return
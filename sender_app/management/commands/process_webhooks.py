@@ -0,0 +1,89 @@
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from sender_app import ingest
+from sender_app.views import process_webhook_payload
+
+meta_api_logger = logging.getLogger('meta_api_logger')
+
+
+class Command(BaseCommand):
+    help = "Drain the webhook journal (WEBHOOK_INGEST_MODE=queue) with a pool of worker threads."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.WEBHOOK_QUEUE_WORKERS)
+        parser.add_argument('--batch-size', type=int, default=20)
+        parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds to sleep when the queue is empty.")
+        parser.add_argument('--once', action='store_true', help="Drain what is due and exit.")
+        parser.add_argument('--stats', action='store_true', help="Print queue depth and exit.")
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.stdout.write(json.dumps(ingest.queue_depth()))
+            return
+
+        self.stop = threading.Event()
+        self.once = options['once']
+        self.batch_size = options['batch_size']
+        self.poll_interval = options['poll_interval']
+
+        ingest.requeue_stale(settings.WEBHOOK_QUEUE_LEASE_SECONDS)
+        threads = [
+            threading.Thread(target=self._worker_loop, args=(i,), name=f"webhook-worker-{i}", daemon=True)
+            for i in range(max(1, options['workers']))
+        ]
+        for t in threads:
+            t.start()
+        self.stdout.write(f"Processing webhook queue with {len(threads)} workers: {ingest.queue_depth()}")
+
+        try:
+            while any(t.is_alive() for t in threads):
+                for t in threads:
+                    t.join(timeout=1)
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping, letting workers finish their current event...")
+            self.stop.set()
+            for t in threads:
+                t.join()
+
+    def _worker_loop(self, worker_no):
+        last_housekeeping = 0
+        try:
+            while not self.stop.is_set():
+                close_old_connections()
+
+                # worker 0 also does the periodic housekeeping
+                if worker_no == 0 and time.monotonic() - last_housekeeping > 60:
+                    last_housekeeping = time.monotonic()
+                    ingest.requeue_stale(settings.WEBHOOK_QUEUE_LEASE_SECONDS)
+                    ingest.purge_done(settings.WEBHOOK_QUEUE_RETENTION_HOURS)
+                    meta_api_logger.info(f"Webhook queue depth: {ingest.queue_depth()}")
+
+                events = ingest.claim_events(self.batch_size)
+                if not events:
+                    if self.once:
+                        return
+                    self.stop.wait(self.poll_interval)
+                    continue
+
+                for event in events:
+                    self._process(event)
+        finally:
+            connection.close()
+
+    def _process(self, event):
+        started = time.monotonic()
+        try:
+            process_webhook_payload(json.loads(event.body))
+        except Exception as e:
+            meta_api_logger.exception(f"Error processing webhook event {event.pk}: {e}")
+            ingest.mark_failed(event, e)
+            return
+        ingest.mark_done(event)
+        meta_api_logger.info(f"Webhook event {event.pk} processed in {(time.monotonic() - started) * 1000:.0f}ms")
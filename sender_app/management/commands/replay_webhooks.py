@@ -0,0 +1,122 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from requests.adapters import HTTPAdapter
+
+from sender_app.benchmarks import summarize
+from sender_app.capture import read_capture
+
+
+def fresh_ids(body):
+    """The body with every message id replaced, so a server that already saw the capture doesn't drop it as redelivered."""
+    try:
+        data = json.loads(body)
+        for entry in data.get('entry', []):
+            for change in entry.get('changes', []):
+                for message in change.get('value', {}).get('messages', []):
+                    if 'id' in message:
+                        message['id'] = f"{message['id']}.replay.{uuid4().hex[:12]}"
+        return json.dumps(data)
+    except (ValueError, AttributeError, TypeError):
+        return body  # not a webhook we understand: replay as captured
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a webhook capture (WEBHOOK_CAPTURE_PATH) against a running server, keeping the "
+        "original spacing scaled by --speed (1, 10, ... or 'max'), and report the achieved rate, "
+        "status codes, errors and latency."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('capture', help="JSONL file written by the webhook capture.")
+        parser.add_argument('--url', default='http://127.0.0.1:8000/webhook', help="Webhook URL of the target server.")
+        parser.add_argument('--speed', default='1', help="Time scale: 1 = as captured, 10 = ten times faster, 'max' = no pauses.")
+        parser.add_argument('--concurrency', type=int, default=8, help="Max requests in flight.")
+        parser.add_argument('--limit', type=int, help="Only replay the first N captured requests.")
+        parser.add_argument('--timeout', type=float, default=30.0, help="Per-request timeout in seconds.")
+        parser.add_argument('--fresh-ids', action='store_true', help="Rewrite message ids so the target doesn't deduplicate them.")
+
+    def handle(self, *args, **options):
+        if options['speed'] == 'max':
+            speed = None
+        else:
+            try:
+                speed = float(options['speed'])
+            except ValueError:
+                raise CommandError("--speed must be a number or 'max'.")
+            if speed <= 0:
+                raise CommandError("--speed must be positive.")
+        concurrency = max(1, options['concurrency'])
+
+        try:
+            records = read_capture(options['capture'], options['limit'])
+        except OSError as e:
+            raise CommandError(f"Cannot read capture: {e}")
+        if not records:
+            raise CommandError("Capture is empty.")
+
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_maxsize=concurrency))
+        session.mount('https://', HTTPAdapter(pool_maxsize=concurrency))
+
+        statuses, errors, latencies = {}, {}, []
+        results_lock = threading.Lock()
+        slots = threading.BoundedSemaphore(concurrency)
+
+        def post(body):
+            started = time.perf_counter()
+            try:
+                response = session.post(options['url'], data=body.encode('utf-8'), timeout=options['timeout'],
+                                        headers={'Content-Type': 'application/json'})
+                with results_lock:
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                    latencies.append((time.perf_counter() - started) * 1000)
+            except requests.exceptions.RequestException as e:
+                with results_lock:
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            finally:
+                slots.release()
+
+        first_ts = records[0][0]
+        max_lag = 0.0
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='replay') as executor:
+            for ts, body in records:
+                if speed:
+                    due = started + (ts - first_ts) / speed
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                slots.acquire()
+                if speed:
+                    # behind schedule: the target (or --concurrency) can't keep up with this speed
+                    max_lag = max(max_lag, time.monotonic() - due)
+                executor.submit(post, fresh_ids(body) if options['fresh_ids'] else body)
+        seconds = time.monotonic() - started
+
+        span = records[-1][0] - first_ts
+        ok = sum(count for status, count in statuses.items() if 200 <= status < 300)
+        report = {
+            'capture': options['capture'],
+            'url': options['url'],
+            'speed': options['speed'],
+            'concurrency': concurrency,
+            'requests': len(records),
+            'succeeded': ok,
+            'failed': len(records) - ok,
+            'statuses': {str(status): count for status, count in sorted(statuses.items())},
+            'errors': errors,
+            'seconds': round(seconds, 3),
+            'capture_seconds': round(span, 3),
+            'target_rate_per_second': round(len(records) / span * speed, 1) if speed and span > 0 else None,
+            'achieved_rate_per_second': round(len(records) / seconds, 1) if seconds else None,
+            'max_schedule_lag_ms': round(max_lag * 1000, 1) if speed else None,
+            'latency_ms': summarize(latencies),
+        }
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,34 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from sender_app.campaigns import CampaignRunner, campaign_progress
+from sender_app.models import Campaign
+
+
+class Command(BaseCommand):
+    help = "Send pending template campaign recipients. Safe to restart: unfinished sends are resumed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.CAMPAIGN_WORKERS)
+        parser.add_argument('--rate', type=float, default=settings.CAMPAIGN_RATE_PER_SECOND, help="Messages/second per business phone number (its share of PHONE_NUMBER_RATE_PER_SECOND).")
+        parser.add_argument('--once', action='store_true', help="Exit when nothing is left to send.")
+        parser.add_argument('--stats', action='store_true', help="Print progress of unfinished campaigns and exit.")
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            campaigns = Campaign.objects.exclude(status=Campaign.STATUS_COMPLETED).order_by('id')
+            self.stdout.write(json.dumps([campaign_progress(c) for c in campaigns], indent=2))
+            return
+
+        runner = CampaignRunner(workers=options['workers'], rate=options['rate'])
+        self.stdout.write(f"Running campaigns with {runner.workers} workers at {runner.rate} msg/s")
+        try:
+            if options['once']:
+                runner.run_until_idle()
+            else:
+                runner.run_forever()
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping, waiting for in-flight sends...")
+            runner.stop()
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import threading
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.urls import re_path
+from django.utils.module_loading import import_string
+
+from sender_app.benchmarks import authenticated_scope, isolated_database, summarize
+
+
+class Command(BaseCommand):
+    help = (
+        "In-process WebSocket load test: open N chat sockets against a consumer class, "
+        "send M messages on each and report connections, latency and executor threads. "
+        "Runs on a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=500)
+        parser.add_argument('--messages', type=int, default=5, help="Messages sent per connection.")
+        parser.add_argument('--consumer', default='sender_app.consumers.ChatConsumer', help="Dotted path of the consumer to test.")
+        parser.add_argument('--layer-latency-ms', type=float, default=1.0, help="Simulated channel layer (Redis) round trip.")
+        parser.add_argument('--timeout', type=float, default=60.0, help="Per-operation timeout in seconds.")
+
+    def handle(self, *args, **options):
+        consumer = import_string(options['consumer'])
+        application = authenticated_scope(URLRouter([re_path(r'ws/chat/(?P<phone_number>\d+)/$', consumer.as_asgi())]))
+        with isolated_database(layer_latency_ms=options['layer_latency_ms']):
+            report = asyncio.run(self._run(application, options['connections'], options['messages'], options['timeout']))
+        report['consumer'] = options['consumer']
+        report['layer_latency_ms'] = options['layer_latency_ms']
+        self.stdout.write(json.dumps(report, indent=2))
+
+    async def _run(self, application, n_connections, n_messages, timeout):
+        peak_threads = threading.active_count()
+        sampling = True
+
+        async def sample_threads():
+            nonlocal peak_threads
+            while sampling:
+                peak_threads = max(peak_threads, threading.active_count())
+                await asyncio.sleep(0.02)
+
+        sampler = asyncio.ensure_future(sample_threads())
+        threads_before = threading.active_count()
+
+        # --- connect all ---
+        communicators = [WebsocketCommunicator(application, f"/ws/chat/{1000000 + i}/") for i in range(n_connections)]
+        started = time.perf_counter()
+        results = await asyncio.gather(*(c.connect(timeout=timeout) for c in communicators), return_exceptions=True)
+        connect_seconds = time.perf_counter() - started
+        connected = [c for c, r in zip(communicators, results) if not isinstance(r, BaseException) and r[0]]
+
+        # --- send + wait for the broadcast echo on every socket concurrently ---
+        latencies = []
+        errors = 0
+
+        async def chat(communicator):
+            nonlocal errors
+            for i in range(n_messages):
+                sent = time.perf_counter()
+                try:
+                    await communicator.send_to(text_data=json.dumps({'message': f"load test {i}"}))
+                    await communicator.receive_from(timeout=timeout)
+                except Exception:
+                    errors += 1
+                    return
+                latencies.append((time.perf_counter() - sent) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(chat(c) for c in connected))
+        chat_seconds = time.perf_counter() - started
+
+        await asyncio.gather(*(c.disconnect() for c in connected), return_exceptions=True)
+        sampling = False
+        await sampler
+
+        return {
+            'connections_requested': n_connections,
+            'connections_open': len(connected),
+            'connect_seconds': round(connect_seconds, 3),
+            'connections_per_second': round(len(connected) / connect_seconds, 1) if connect_seconds else 0,
+            'messages': len(latencies),
+            'message_errors': errors,
+            'messages_per_second': round(len(latencies) / chat_seconds, 1) if chat_seconds else 0,
+            'round_trip_ms': summarize(latencies),
+            'threads_before': threads_before,
+            'threads_peak': peak_threads,
+        }
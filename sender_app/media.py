@@ -0,0 +1,433 @@
+import hashlib
+import os
+import logging
+import mimetypes
+import re
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_ISREG
+from uuid import uuid4
+
+import requests
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from . import metrics
+from .graph_api import get_client
+from .logs import truncate_text
+from .models import MediaBlob
+
+meta_api_logger = logging.getLogger('meta_api_logger')
+
+# --- Media fetch subsystem ---
+# Downloads are streamed in chunks into MEDIA_ROOT/.tmp and then os.replace()d
+# into place, so a file under /media/ is always complete and memory use stays
+# at one chunk per download. All downloads (from every webhook being processed
+# in this process) share one bounded thread pool.
+#
+# Storage layout (MEDIA_STORE_MODE):
+#   'uuid'     MEDIA_ROOT/<type>/<uuid>.<ext>, one file per download (the
+#              default; rows keep their URLs when the mode changes).
+#   'content'  MEDIA_ROOT/blobs/ab/cd/<sha256>.<ext>, one file per distinct
+#              content (MediaBlob rows hold size + ref_count); a forwarded
+#              image or sticker is stored once however often it arrives.
+
+CHUNK_SIZE = 64 * 1024
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+AUDIO_EXTENSIONS = ('.mp3', '.ogg', '.amr', '.wav', '.m4a')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+def get_media_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.MEDIA_DOWNLOAD_CONCURRENCY,
+                thread_name_prefix='media-fetch',
+            )
+        return _executor
+
+
+def submit_download(fn, *args, **kwargs):
+    """Schedule a download on the shared pool and return its Future."""
+    return get_media_executor().submit(fn, *args, **kwargs)
+
+
+def save_response_stream(response, file_type, file_extension):
+    """
+    Stream a `requests` response (opened with stream=True) into MEDIA_ROOT.
+    Returns (web_path, file_full_path). Raises MediaTooLarge past MEDIA_MAX_BYTES.
+
+    MEDIA_STORE_MODE='uuid' (default): MEDIA_ROOT/<file_type>/<uuid>.<ext>.
+    'content': the body is hashed while it is written and lands in the sharded
+    blob store; content that is already stored is not written again, it only
+    gains a reference.
+    """
+    max_bytes = settings.MEDIA_MAX_BYTES
+    declared = response.headers.get('Content-Length')
+    if declared and declared.isdigit() and int(declared) > max_bytes:
+        raise MediaTooLarge(f"Content-Length {declared} exceeds limit of {max_bytes} bytes")
+
+    tmp_dir = os.path.join(settings.MEDIA_ROOT, '.tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix='.part')
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > max_bytes:
+                    raise MediaTooLarge(f"Download exceeded limit of {max_bytes} bytes")
+                digest.update(chunk)
+                f.write(chunk)
+
+        metrics.media_downloaded_bytes.inc(size, type=file_type)
+        if settings.MEDIA_STORE_MODE == 'content':
+            blob, created = store_blob(tmp_path, digest.hexdigest(), file_extension, size)
+            if not created:
+                metrics.media_deduplicated.inc()
+            web_path = blob.web_path
+            file_full_path = os.path.join(settings.MEDIA_ROOT, blob.relative_path)
+            meta_api_logger.info(f"{'Stored' if created else 'Deduplicated'} {size} bytes as {web_path} ({blob.ref_count} refs)")
+            return web_path, file_full_path
+
+        media_dir = os.path.join(settings.MEDIA_ROOT, file_type)
+        os.makedirs(media_dir, exist_ok=True)
+        file_name = f"{uuid4()}.{file_extension}"
+        file_full_path = os.path.join(media_dir, file_name)
+        os.replace(tmp_path, file_full_path)
+    finally:
+        # a no-op after os.replace(); removes the partial file on errors and duplicate blobs
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+    web_path = f"/media/{file_type}/{file_name}"
+    meta_api_logger.info(f"Saved {size} bytes to {file_full_path} -> {web_path}")
+    return web_path, file_full_path
+
+
+def store_blob(tmp_path, sha256, file_extension, size):
+    """
+    Move a fully written temp file into the blob store and take a reference.
+    Returns (MediaBlob, created); when the blob already exists the temp file is left for the caller to delete.
+    """
+    blob = MediaBlob.objects.filter(sha256=sha256).first()
+    if blob is None:
+        blob = MediaBlob(sha256=sha256, extension=re.sub(r'\W', '', file_extension)[:16] or 'bin', size=size)
+    full_path = os.path.join(settings.MEDIA_ROOT, blob.relative_path)
+
+    created = not os.path.exists(full_path)
+    if created:
+        # identical bytes from a concurrent writer are harmless: replace is atomic
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        os.replace(tmp_path, full_path)
+    else:
+        try:
+            os.utime(full_path)  # fresh mtime: `manage.py gc_media` leaves recently used blobs alone
+        except OSError:
+            pass
+
+    if blob.pk is None:
+        try:
+            with transaction.atomic():
+                blob.ref_count = 1
+                blob.save(force_insert=True)
+            return blob, created
+        except IntegrityError:
+            # another worker registered the same content first
+            blob = MediaBlob.objects.get(sha256=sha256)
+    MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+    blob.refresh_from_db(fields=['ref_count'])
+    return blob, created
+
+
+def blob_sha_for_url(media_url):
+    """sha256 of a content-addressed /media/blobs/... url, else None."""
+    match = BLOB_NAME_RE.match(os.path.basename(media_url or '')) if (media_url or '').startswith('/media/blobs/') else None
+    return match.group(1) if match else None
+
+
+def release_media(media_urls):
+    """
+    Drop one blob reference per url of deleted (or never stored) messages. Files are not removed
+    here: `manage.py gc_media` deletes them once nothing references them.
+    """
+    counts = Counter(sha for sha in map(blob_sha_for_url, media_urls) if sha)
+    for sha256, count in counts.items():
+        MediaBlob.objects.filter(sha256=sha256).update(ref_count=Greatest(F('ref_count') - count, 0))
+    return sum(counts.values())
+
+
+def process_whatsapp_media(media_id):
+    """
+    Download media from WhatsApp/Meta and store it via save_response_stream (the
+    blob store, or MEDIA_ROOT/<type>/<uuid>.<ext> in 'uuid' mode).
+    Return a web-accessible path under /media/ and the file type (image|audio).
+    In 'content' mode the path holds a blob reference: a caller that does not
+    end up storing it on a ChatMessage must hand it back to release_media().
+    """
+    client = get_client()
+    try:
+        response_get_url = client.get_media_metadata(media_id, timeout=15)
+        if response_get_url.status_code != 200:
+            meta_api_logger.error(f"Failed to get media metadata for ID {media_id}. Response: {truncate_text(response_get_url.text, settings.LOG_PAYLOAD_MAX_CHARS)}")
+            metrics.media_fetches.inc(result='metadata_error')
+            return None, None
+
+        media_data = response_get_url.json()
+        download_url = media_data.get('url') or media_data.get('uri')  # sometimes named differently
+        mime_type = media_data.get('mime_type') or media_data.get('mimetype')
+        if not download_url:
+            meta_api_logger.error(f"No download URL in media data for ID {media_id}: {media_data}")
+            metrics.media_fetches.inc(result='metadata_error')
+            return None, None
+
+        # download the actual file (same auth header), body is streamed below
+        with client.download(download_url, timeout=20) as response_download:
+            if response_download.status_code != 200:
+                meta_api_logger.error(f"Failed to download media from {download_url}. Status: {response_download.status_code}")
+                metrics.media_fetches.inc(result='download_error')
+                return None, None
+
+            # determine extension and type
+            if not mime_type:
+                mime_type = response_download.headers.get('Content-Type', '')
+
+            file_extension = 'bin'
+            if mime_type:
+                guessed_ext = mimetypes.guess_extension(mime_type.split(';')[0].strip())
+                if guessed_ext:
+                    file_extension = guessed_ext.lstrip('.')  # remove leading dot
+
+            file_type = (mime_type.split('/')[0] if mime_type else '').lower()
+            if file_type not in ['image', 'audio']:
+                # fallback: inspect extension from url
+                if any(download_url.lower().endswith(ext) for ext in IMAGE_EXTENSIONS):
+                    file_type = 'image'
+                elif any(download_url.lower().endswith(ext) for ext in AUDIO_EXTENSIONS):
+                    file_type = 'audio'
+                else:
+                    meta_api_logger.warning(f"Unsupported media type: {mime_type} for id {media_id}")
+                    metrics.media_fetches.inc(result='unsupported')
+                    return None, None
+
+            web_path, _ = save_response_stream(response_download, file_type, file_extension)
+        metrics.media_fetches.inc(result='ok')
+        return web_path, file_type
+
+    except MediaTooLarge as e:
+        meta_api_logger.error(f"Media ID {media_id} rejected: {e}")
+        metrics.media_fetches.inc(result='too_large')
+        return None, None
+    except requests.exceptions.RequestException as e:
+        meta_api_logger.error(f"Network error while processing media ID {media_id}: {e}")
+        metrics.media_fetches.inc(result='network_error')
+        return None, None
+    except Exception as e:
+        meta_api_logger.error(f"Unexpected error saving media ID {media_id}: {e}")
+        metrics.media_fetches.inc(result='error')
+        return None, None
+
+
+def download_webhook_url(webhook_url, media_type_str):
+    """Download media from a url included in the webhook itself. Returns web_path or None."""
+    try:
+        with get_client().download(webhook_url, timeout=20, authorize=False) as r:
+            if r.status_code != 200:
+                return None
+            # determine extension from headers or url
+            content_type = r.headers.get('Content-Type', '')
+            ext = content_type.split('/')[-1].split(';')[0] or 'bin'
+            web_path, _ = save_response_stream(r, media_type_str, ext)
+            return web_path
+    except Exception as e:
+        meta_api_logger.warning(f"Failed to download webhook url {webhook_url}: {e}")
+        return None
+
+
+def fetch_incoming_media(message_type, media_id, webhook_url):
+    """
+    Resolve one incoming media item: webhook-provided url first, then the
+    Graph API /{media-id} flow. Returns (web_path, media_type_str); web_path is None on failure.
+    """
+    media_type_str = 'image' if message_type == 'image' else 'audio' if message_type == 'audio' else message_type
+    web_path = None
+
+    # If webhook already included a ready-to-download url, try that first
+    if webhook_url:
+        web_path = download_webhook_url(webhook_url, media_type_str)
+
+    # fallback to the media-id flow (Graph API /{media-id})
+    if not web_path and media_id:
+        web_path, mt = process_whatsapp_media(media_id)
+        media_type_str = mt or media_type_str
+
+    return web_path, media_type_str
+
+
+# --- Media serving (/media/<path>) ---
+# Files under MEDIA_ROOT are written once and never modified (new content gets
+# a new uuid name), so size + mtime make a strong validator and uuid-named files
+# can be cached by the browser for a year (blobs use their sha256 as ETag). MEDIA_SERVE_MODE:
+#   'python'     stream from Django, with 304s and single byte ranges (206)
+#   'x-accel'    hand the file to nginx: X-Accel-Redirect: MEDIA_ACCEL_REDIRECT_PREFIX + path
+#   'x-sendfile' hand the file to Apache/lighttpd: X-Sendfile: <absolute path>
+# In the offload modes the proxy does the byte copy (and Range); Django only
+# checks the path and answers conditional requests.
+
+IMMUTABLE_NAME_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.\w+$')
+BLOB_NAME_RE = re.compile(r'^([0-9a-f]{64})\.\w+$')
+THUMBNAIL_NAME_RE = re.compile(r'^([0-9a-f]{64}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})_\d+\.\w+$')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def resolve_media_path(path):
+    """Absolute path of a regular file inside MEDIA_ROOT and its stat, or (None, None)."""
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError, ValueError):
+        return None, None
+    if not S_ISREG(stat.st_mode):
+        return None, None
+    return full_path, stat
+
+
+def is_immutable_name(file_name):
+    return bool(IMMUTABLE_NAME_RE.match(file_name) or BLOB_NAME_RE.match(file_name) or THUMBNAIL_NAME_RE.match(file_name))
+
+
+def media_etag(full_path, stat):
+    blob = BLOB_NAME_RE.match(os.path.basename(full_path))
+    if blob:
+        return f'"{blob.group(1)}"'
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def parse_range(header, size):
+    """
+    (start, end) inclusive for a single 'bytes=' range, None to serve the whole
+    file (no/malformed/multi range), or 'unsatisfiable'.
+    """
+    match = RANGE_RE.match((header or '').strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return 'unsatisfiable'
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return 'unsatisfiable'
+    return start, end
+
+
+def _iter_file_range(full_path, start, length):
+    with open(full_path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def media_response(request, path):
+    """The response for GET/HEAD /media/<path> (see the section comment above)."""
+    full_path, stat = resolve_media_path(path)
+    if full_path is None:
+        meta_api_logger.warning(f"Media file not found: {path}")
+        raise Http404("Media not found")
+
+    etag = media_etag(full_path, stat)
+    last_modified = int(stat.st_mtime)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': (
+            f"private, max-age={settings.MEDIA_CACHE_MAX_AGE}, immutable"
+            if is_immutable_name(os.path.basename(full_path)) else 'private, no-cache'
+        ),
+    }
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        for header, value in headers.items():
+            not_modified[header] = value
+        return not_modified
+
+    content_type, _ = mimetypes.guess_type(full_path)
+    content_type = content_type or 'application/octet-stream'
+
+    mode = settings.MEDIA_SERVE_MODE
+    if mode in ('x-accel', 'x-sendfile'):
+        response = HttpResponse(content_type=content_type)
+        if mode == 'x-accel':
+            response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + os.path.relpath(full_path, settings.MEDIA_ROOT).replace(os.sep, '/')
+        else:
+            response['X-Sendfile'] = full_path
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    size = stat.st_size
+    byte_range = None
+    if request.method == 'GET' and 'HTTP_RANGE' in request.META:
+        # If-Range: only honour the range if the client's copy is still current
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if not if_range or if_range == etag or if_range == headers['Last-Modified']:
+            byte_range = parse_range(request.META['HTTP_RANGE'], size)
+
+    if byte_range == 'unsatisfiable':
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f"bytes */{size}"
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    if request.method == 'HEAD':
+        response = HttpResponse(content_type=content_type)
+        response['Content-Length'] = str(size)
+    elif byte_range is not None:
+        start, end = byte_range
+        response = StreamingHttpResponse(_iter_file_range(full_path, start, end - start + 1), status=206, content_type=content_type)
+        response['Content-Range'] = f"bytes {start}-{end}/{size}"
+        response['Content-Length'] = str(end - start + 1)
+    else:
+        try:
+            response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+        except OSError as e:
+            meta_api_logger.error(f"Error sending media file {full_path}: {e}")
+            raise Http404("Media read error")
+    for header, value in headers.items():
+        response[header] = value
+    return response
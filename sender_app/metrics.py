@@ -0,0 +1,209 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# --- Prometheus metrics (GET /metrics) ---
+# Small in-process registry rendering the Prometheus text format, so the app
+# needs no extra dependency. Values are per process: scrape each daphne /
+# worker process separately (they are labelled by the scrape target).
+# Counters/histograms are updated where things happen; queue depths and cache
+# stats are read at scrape time by the collectors registered at the bottom.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+_collectors = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['counts'][i] += 1
+                    break
+            entry['sum'] += value
+            entry['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted((key, dict(entry, counts=list(entry['counts']))) for key, entry in self._values.items())
+        for key, entry in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry['counts']):
+                cumulative += count
+                le = 'le="{}"'.format(_format_value(bound))
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [le])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(entry['sum'])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {entry['count']}")
+        return lines
+
+
+def collector(fn):
+    """Register fn() to refresh gauges right before each scrape."""
+    _collectors.append(fn)
+    return fn
+
+
+def render():
+    for fn in _collectors:
+        try:
+            fn()
+        except Exception:
+            # a failing collector (e.g. DB down) must not break the scrape
+            scrape_errors.inc(collector=fn.__name__)
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# --- webhook ---
+webhook_request_seconds = Histogram('webhook_request_duration_seconds', 'Time to answer a webhook POST.', ['mode'])
+webhook_requests = Counter('webhook_requests_total', 'Webhook POSTs by HTTP status.', ['status'])
+webhook_processing_seconds = Histogram('webhook_processing_duration_seconds', 'process_webhook_payload() time (inline or queue worker).')
+webhook_messages = Counter('webhook_messages_total', 'Incoming messages stored, by type.', ['type'])
+webhook_duplicates = Counter('webhook_duplicate_messages_total', 'Redelivered messages dropped by wamid.')
+
+# --- Graph API ---
+graph_api_request_seconds = Histogram('graph_api_request_duration_seconds', 'Graph API call latency per attempt.', ['endpoint'])
+graph_api_responses = Counter('graph_api_responses_total', 'Graph API calls by endpoint and HTTP status ("error" = network error).', ['endpoint', 'status'])
+template_messages = Counter('template_messages_total', 'send_template_message() outcomes.', ['result'])
+
+# --- media ---
+media_downloaded_bytes = Counter('media_downloaded_bytes_total', 'Bytes of incoming media downloaded, by media type.', ['type'])
+media_fetches = Counter('media_fetches_total', 'process_whatsapp_media() outcomes.', ['result'])
+media_deduplicated = Counter('media_deduplicated_total', 'Downloads that matched an existing blob and were not stored again.')
+
+# --- websockets / channel layer ---
+ws_connections = Gauge('ws_connections_open', 'Open websocket connections in this process.', ['consumer'])
+ws_messages_received = Counter('ws_messages_received_total', 'Messages received from operators over websockets.')
+ws_frames_sent = Counter('ws_frames_sent_total', 'Websocket frames sent from the outbox, by kind (single / batch).', ['kind'])
+ws_coalesced_events = Counter('ws_coalesced_events_total', 'Events that shared a frame with others (batched or merged inbox updates).')
+ws_dropped_events = Counter('ws_dropped_events_total', 'Events dropped for websocket clients that fell behind.')
+ws_resync_required = Counter('ws_resync_required_total', 'resync_required frames queued for websocket clients that fell behind, one per chat.')
+ws_subscriptions = Gauge('ws_subscriptions_open', 'Chats subscribed to by inbox websockets in this process.')
+ws_resumes = Counter('ws_resumes_total', 'Websocket resume requests, by outcome (replayed / resync).', ['result'])
+ws_replayed_messages = Counter('ws_replayed_messages_total', 'Messages replayed to resuming websockets.')
+group_send_seconds = Histogram('channel_layer_group_send_duration_seconds', 'channel_layer.group_send() latency.', ['source'])
+
+# --- queues / caches (refreshed at scrape time) ---
+outbound_queue_depth = Gauge('outbound_queue_depth', 'Outbox rows not yet sent, by status.', ['status'])
+webhook_queue_depth = Gauge('webhook_queue_depth', 'Journaled webhook events by status (queue mode).', ['status'])
+webhook_queue_oldest_pending = Gauge('webhook_queue_oldest_pending_seconds', 'Age of the oldest pending webhook event.')
+cache_requests = Gauge('cache_requests', 'Cache lookups since process start.', ['namespace', 'result'])
+log_records_dropped = Gauge('log_records_dropped', 'Log records dropped because the background log queue was full.')
+scrape_errors = Counter('metrics_collector_errors_total', 'Collectors that raised during a scrape.', ['collector'])
+
+
+@collector
+def collect_outbox():
+    from .outbound import outbox_depth
+    for status, count in outbox_depth().items():
+        outbound_queue_depth.set(count, status=status)
+
+
+@collector
+def collect_webhook_queue():
+    from .ingest import queue_depth
+    depth = queue_depth()
+    webhook_queue_oldest_pending.set(depth.pop('oldest_pending_age_seconds'))
+    for status, count in depth.items():
+        webhook_queue_depth.set(count, status=status)
+
+
+@collector
+def collect_cache():
+    from .caching import cache_stats
+    for namespace, values in cache_stats().items():
+        cache_requests.set(values['hits'], namespace=namespace, result='hit')
+        cache_requests.set(values['misses'], namespace=namespace, result='miss')
+
+
+@collector
+def collect_log_drops():
+    import logging
+    dropped = sum(getattr(handler, 'dropped', 0) for handler in logging.getLogger('meta_api_logger').handlers)
+    log_records_dropped.set(dropped)
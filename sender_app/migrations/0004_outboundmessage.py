@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender_app', '0003_webhookevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient', models.CharField(max_length=20)),
+                ('payload', models.JSONField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('next_attempt_at', models.DateTimeField(blank=True, null=True)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('response_message_id', models.CharField(blank=True, max_length=128, null=True)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('chat_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='sender_app.chatmessage')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'id'], name='sender_app__status_3a1d65_idx'), models.Index(fields=['recipient', 'status', 'id'], name='sender_app__recipie_d47df8_idx')],
+            },
+        ),
+    ]
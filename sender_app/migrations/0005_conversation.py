@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:28
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def backfill_conversations(apps, schema_editor):
+    ChatMessage = apps.get_model('sender_app', 'ChatMessage')
+    Conversation = apps.get_model('sender_app', 'Conversation')
+    stats = ChatMessage.objects.values('sender_id').annotate(n=Count('id'), last_at=Max('timestamp'))
+    for row in stats.iterator():
+        last = ChatMessage.objects.filter(sender_id=row['sender_id']).order_by('-timestamp', '-id').first()
+        if last.message_text:
+            preview = str(last.message_text)[:100]
+        elif last.media_url:
+            preview = f"[{last.message_type}]"
+        else:
+            preview = ''
+        Conversation.objects.create(
+            sender_id=row['sender_id'],
+            last_message_at=row['last_at'],
+            last_message_preview=preview,
+            last_message_is_from_user=last.is_from_user,
+            message_count=row['n'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender_app', '0004_outboundmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sender_id', models.CharField(max_length=20, unique=True)),
+                ('last_message_at', models.DateTimeField()),
+                ('last_message_preview', models.CharField(blank=True, default='', max_length=255)),
+                ('last_message_is_from_user', models.BooleanField(default=True)),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-last_message_at', '-id'], name='conversation_activity_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender_app', '0005_conversation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['sender_id', 'id'], name='chatmessage_sender_id_idx'),
+        ),
+    ]
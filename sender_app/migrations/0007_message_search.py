@@ -0,0 +1,64 @@
+# Full-text search support for sender_app.search (hand-written, backend specific).
+
+from django.db import migrations
+
+PG_INDEX = 'chatmessage_text_fts_idx'
+FTS_TABLE = 'sender_app_chatmessage_fts'
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        # expression index, so Postgres keeps it in sync on every insert/update by itself
+        schema_editor.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {PG_INDEX} ON sender_app_chatmessage "
+            f"USING GIN (to_tsvector('simple', coalesce(message_text, '')))"
+        )
+    elif vendor == 'sqlite':
+        try:
+            schema_editor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                f"message_text, content='sender_app_chatmessage', content_rowid='id')"
+            )
+        except Exception:
+            # SQLite built without FTS5: sender_app.search falls back to LIKE
+            return
+        schema_editor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON sender_app_chatmessage BEGIN
+                INSERT INTO {FTS_TABLE}(rowid, message_text) VALUES (new.id, new.message_text);
+            END""")
+        schema_editor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON sender_app_chatmessage BEGIN
+                INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message_text) VALUES ('delete', old.id, old.message_text);
+            END""")
+        schema_editor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF message_text ON sender_app_chatmessage BEGIN
+                INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message_text) VALUES ('delete', old.id, old.message_text);
+                INSERT INTO {FTS_TABLE}(rowid, message_text) VALUES (new.id, new.message_text);
+            END""")
+        # index what is already there
+        schema_editor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {PG_INDEX}")
+    elif vendor == 'sqlite':
+        for suffix in ('ai', 'ad', 'au'):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {FTS_TABLE}_{suffix}")
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('sender_app', '0006_chatmessage_sender_id_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
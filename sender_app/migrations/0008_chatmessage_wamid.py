@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender_app', '0007_message_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='wamid',
+            field=models.CharField(blank=True, max_length=128, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender_app', '0008_chatmessage_wamid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Campaign',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('template_name', models.CharField(max_length=200)),
+                ('language_code', models.CharField(default='ru_RU', max_length=20)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('paused', 'Paused'), ('completed', 'Completed')], default='running', max_length=10)),
+                ('total_recipients', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CampaignRecipient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phone_number', models.CharField(max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(blank=True, null=True)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('response_message_id', models.CharField(blank=True, max_length=128, null=True)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('campaign', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='sender_app.campaign')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['campaign', 'status', 'id'], name='sender_app__campaig_2b7134_idx'), models.Index(fields=['campaign', 'sent_at'], name='sender_app__campaig_7ddcad_idx')],
+                'constraints': [models.UniqueConstraint(fields=('campaign', 'phone_number'), name='campaignrecipient_unique_number')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender_app', '0010_mediablob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='thumbnail_url',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
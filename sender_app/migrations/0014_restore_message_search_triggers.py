@@ -0,0 +1,24 @@
+# On SQLite, 0008 (a unique column) rebuilt sender_app_chatmessage, which drops
+# its triggers: the FTS5 table from 0007 stopped following new messages.
+# Re-create them (everything in 0007 is IF NOT EXISTS) and re-index.
+# Any later migration that rebuilds the table on SQLite needs the same step.
+
+from importlib import import_module
+
+from django.db import migrations
+
+message_search = import_module('sender_app.migrations.0007_message_search')
+
+
+class Migration(migrations.Migration):
+
+    # see 0007: CREATE INDEX CONCURRENTLY on Postgres
+    atomic = False
+
+    dependencies = [
+        ('sender_app', '0013_chatdeletion'),
+    ]
+
+    operations = [
+        migrations.RunPython(message_search.create_search_index, migrations.RunPython.noop),
+    ]
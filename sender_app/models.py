@@ -12,10 +12,260 @@ class ChatMessage(models.Model):
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPE_CHOICES, default='text')
     message_text = models.TextField(blank=True, null=True)
     media_url = models.CharField(max_length=255, blank=True, null=True) # Will store local path like /media/image.jpg
+    thumbnail_url = models.CharField(max_length=255, blank=True, null=True) # small preview of an image, see sender_app.thumbnails
     timestamp = models.DateTimeField(auto_now_add=True)
     is_from_user = models.BooleanField()
+    wamid = models.CharField(max_length=128, blank=True, null=True, unique=True) # WhatsApp message id, incoming only
+
+    class Meta:
+        indexes = [
+            # chat history: WHERE sender_id = ? ORDER BY id DESC LIMIT n (+ id < / > cursor)
+            models.Index(fields=['sender_id', 'id'], name='chatmessage_sender_id_idx'),
+        ]
 
     def __str__(self):
         direction = "IN" if self.is_from_user else "OUT"
         content = self.message_text or self.media_url
         return f"{direction} {self.sender_id}: {content[:30]}"
+
+
+
+class Conversation(models.Model):
+    """
+    One row per contact, kept up to date by sender_app.conversations.record_message()
+    on every write, so the inbox never has to GROUP BY the message table.
+    """
+    sender_id = models.CharField(max_length=20, unique=True)
+    last_message_at = models.DateTimeField()
+    last_message_preview = models.CharField(max_length=255, blank=True, default='')
+    last_message_is_from_user = models.BooleanField(default=True)
+    message_count = models.PositiveIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0) # incoming since the chat was last opened
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-last_message_at', '-id'], name='conversation_activity_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.sender_id} ({self.message_count} msgs, {self.unread_count} unread)"
+
+class WebhookEvent(models.Model):
+    """
+    Raw webhook body journaled by webhook_view in queue mode.
+    Drained by `manage.py process_webhooks` (at-least-once).
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'), # Gave up after WEBHOOK_QUEUE_MAX_ATTEMPTS
+    ]
+
+    body = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    received_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(null=True, blank=True) # retry backoff; NULL = right away
+    locked_at = models.DateTimeField(null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id']),
+        ]
+
+    def __str__(self):
+        return f"WebhookEvent {self.pk} [{self.status}] attempts={self.attempts}"
+
+
+class OutboundMessage(models.Model):
+    """
+    Outbox row for a message to send through the Cloud API.
+    Written by ChatConsumer, sent by sender_app.outbound (in-process or `manage.py dispatch_outbound`).
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    recipient = models.CharField(max_length=20)
+    payload = models.JSONField()
+    chat_message = models.ForeignKey(ChatMessage, null=True, blank=True, on_delete=models.SET_NULL)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(null=True, blank=True) # retry backoff; NULL = right away
+    locked_at = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    response_message_id = models.CharField(max_length=128, blank=True, null=True) # wamid returned by Meta
+    last_error = models.TextField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id']),
+            models.Index(fields=['recipient', 'status', 'id']),
+        ]
+
+    def __str__(self):
+        return f"Outbound {self.pk} to {self.recipient} [{self.status}]"
+
+
+class Campaign(models.Model):
+    """
+    Bulk template send: one template to many numbers (CampaignRecipient rows).
+    Sent by `manage.py run_campaigns` (sender_app.campaigns).
+    """
+    STATUS_RUNNING = 'running'
+    STATUS_PAUSED = 'paused'
+    STATUS_COMPLETED = 'completed'
+    STATUS_CHOICES = [
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_PAUSED, 'Paused'),
+        (STATUS_COMPLETED, 'Completed'),
+    ]
+
+    name = models.CharField(max_length=200)
+    template_name = models.CharField(max_length=200)
+    language_code = models.CharField(max_length=20, default='ru_RU')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_RUNNING)
+    total_recipients = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True) # first send
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Campaign {self.pk} '{self.name}' [{self.status}]"
+
+
+class CampaignRecipient(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE, related_name='recipients')
+    phone_number = models.CharField(max_length=20)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True) # retry backoff; NULL = right away
+    locked_at = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    response_message_id = models.CharField(max_length=128, blank=True, null=True) # wamid returned by Meta
+    last_error = models.TextField(blank=True, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['campaign', 'phone_number'], name='campaignrecipient_unique_number'),
+        ]
+        indexes = [
+            models.Index(fields=['campaign', 'status', 'id']),
+            models.Index(fields=['campaign', 'sent_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.phone_number} in campaign {self.campaign_id} [{self.status}]"
+
+
+class MediaBlob(models.Model):
+    """
+    One stored media file, addressed by its SHA-256 (sender_app.media, MEDIA_STORE_MODE='content').
+    Lives at MEDIA_ROOT/blobs/<sha[:2]>/<sha[2:4]>/<sha>.<ext>; ref_count counts the media
+    references handed out for it (each save of identical content adds one instead of a new file).
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    extension = models.CharField(max_length=16)
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def relative_path(self):
+        return f"blobs/{self.sha256[:2]}/{self.sha256[2:4]}/{self.sha256}.{self.extension}"
+
+    @property
+    def web_path(self):
+        return f"/media/{self.relative_path}"
+
+    def __str__(self):
+        return f"{self.sha256[:12]}.{self.extension} ({self.size} bytes, {self.ref_count} refs)"
+
+
+class MessageArchive(models.Model):
+    """
+    One gzip JSONL file of archived ChatMessage rows of one contact (`manage.py archive_messages`).
+    Files live under MESSAGE_ARCHIVE_ROOT; each covers ids first_id..last_id, which are
+    all lower than any id still in ChatMessage for that contact.
+    """
+    sender_id = models.CharField(max_length=20)
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    path = models.CharField(max_length=255) # relative to MESSAGE_ARCHIVE_ROOT
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # history paging: WHERE sender_id = ? AND last_id > ? / first_id < ?
+            models.Index(fields=['sender_id', 'last_id'], name='messagearchive_sender_idx'),
+        ]
+
+    def __str__(self):
+        return f"Archive {self.sender_id} #{self.first_id}-{self.last_id} ({self.message_count} messages)"
+
+
+class ChatDeletion(models.Model):
+    """
+    Background job deleting a contact's history (DELETE /api/delete_chat/<phone>/).
+    Run in chunks by sender_app.deletion; only messages up to max_message_id go,
+    so anything that arrives after the request is kept.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    sender_id = models.CharField(max_length=20)
+    max_message_id = models.BigIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    deleted_messages = models.PositiveIntegerField(default=0)
+    deleted_archives = models.PositiveIntegerField(default=0)
+    attempts = models.PositiveIntegerField(default=0)
+    requested_at = models.DateTimeField(auto_now_add=True)
+    locked_at = models.DateTimeField(null=True, blank=True) # heartbeat while running
+    finished_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id']),
+        ]
+
+    def __str__(self):
+        return f"Deletion {self.pk} of {self.sender_id} [{self.status}]"
@@ -0,0 +1,373 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Count, Exists, OuterRef
+from django.utils import timezone
+
+from . import metrics
+from .graph_api import get_client, resend_is_safe
+from .logs import truncate_text
+from .models import OutboundMessage
+
+meta_api_logger = logging.getLogger('meta_api_logger')
+
+# --- Outbound dispatch ---
+# Operator messages are written to the OutboundMessage outbox and sent by a
+# dispatcher: one feeder thread claims due rows and hands them to a bounded
+# worker pool. Every send waits on a token bucket per business phone number
+# (WhatsApp Cloud API throughput limit). A recipient only ever has one message
+# in flight, and a message is only claimed when nothing older for the same
+# recipient is still unsent, so per-recipient order survives retries and restarts.
+# A failed send is only retried when it cannot have reached the customer (429,
+# connection never opened); after a read timeout or a 5xx it fails as "outcome
+# unknown" instead of risking a duplicate.
+
+
+def build_text_payload(phone_number, message):
+    return {"messaging_product": "whatsapp", "to": phone_number, "text": {"body": message}}
+
+
+def build_media_payload(phone_number, media_url, media_type):
+    return {
+        "messaging_product": "whatsapp",
+        "to": phone_number,
+        "type": media_type,
+        media_type: {"link": media_url}
+    }
+
+
+def build_template_payload(phone_number, template_name, language_code='ru_RU'):
+    return {"messaging_product": "whatsapp", "to": phone_number, "type": "template", "template": {"name": template_name, "language": {"code": language_code}}}
+
+
+def send_template_message(phone_number, template_name, language_code='ru_RU'):
+    """
+    Send one template message right away (new chats, campaigns).
+    Returns {'success', 'data'} or {'success': False, 'error', 'retryable'};
+    retryable is only True when the template surely wasn't sent (429, connection
+    never opened). After a read timeout or a 5xx it may have been, so it is not.
+    """
+    payload = build_template_payload(phone_number, template_name, language_code)
+    meta_api_logger.info(f"Starting new chat with {phone_number}. Payload: {json.dumps(payload)}")
+    try:
+        response = get_client().send_message(payload, timeout=15)
+        meta_api_logger.info(
+            f"Start Chat Response: Status {response.status_code} ({response.graph_elapsed_ms}ms), Body: {truncate_text(response.text, settings.LOG_PAYLOAD_MAX_CHARS)}",
+            extra={'event': 'graph_response', 'sender': phone_number, 'status': response.status_code, 'latency_ms': response.graph_elapsed_ms},
+        )
+        try:
+            response_data = response.json()
+        except ValueError:
+            response_data = {}
+        if response.status_code == 200:
+            metrics.template_messages.inc(result='sent')
+            return {'success': True, 'data': response_data}
+        else:
+            error_message = response_data.get('error', {}).get('message', 'An unknown error occurred.')
+            error_details = response_data.get('error', {}).get('error_data', {}).get('details', '')
+            retryable = resend_is_safe(status=response.status_code)
+            if response.status_code >= 500:
+                error_message = f"outcome unknown (HTTP {response.status_code}), not resent: {error_message}"
+            if "not a valid WhatsApp user" in error_message or "Recipient phone number not in allowed list" in error_message or "does not exist" in error_details:
+                metrics.template_messages.inc(result='invalid_recipient')
+                return {'success': False, 'error': 'This phone number is not a valid WhatsApp user.', 'retryable': False}
+            metrics.template_messages.inc(result='retryable_error' if retryable else 'error')
+            return {'success': False, 'error': error_message, 'retryable': retryable}
+    except requests.exceptions.RequestException as e:
+        meta_api_logger.error(f"Start Chat Request failed: {e}")
+        metrics.template_messages.inc(result='network_error')
+        if resend_is_safe(error=e):
+            return {'success': False, 'error': 'A network error occurred.', 'retryable': True}
+        return {'success': False, 'error': 'A network error occurred; the template may have been sent, not resent.', 'retryable': False}
+
+
+def enqueue_outbound(recipient, payload, chat_message=None):
+    """Write an outbox row and nudge the in-process dispatcher."""
+    outbound = OutboundMessage.objects.create(recipient=recipient, payload=payload, chat_message=chat_message)
+    if settings.OUTBOUND_DISPATCH_IN_PROCESS:
+        get_dispatcher().wake()
+    return outbound
+
+
+def outbox_depth():
+    counts = {status: 0 for status, _ in OutboundMessage.STATUS_CHOICES}
+    for row in OutboundMessage.objects.exclude(status=OutboundMessage.STATUS_SENT).values('status').annotate(n=Count('id')):
+        counts[row['status']] = row['n']
+    return counts
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens/second, bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SendPool:
+    """
+    Feeder thread + bounded send pool behind a token bucket per business phone
+    number; the shape shared by OutboundDispatcher and campaigns.CampaignRunner.
+    Subclasses implement _claim_and_submit() (claim due rows, acquire a slot in
+    _slots for each, hand it to _executor; return how many) and housekeeping()
+    (run on the first pass and then every housekeeping_interval seconds). Their
+    send function must give its slot back through _release_slot().
+    """
+    label = 'Send pool'
+    thread_prefix = 'send'
+    housekeeping_interval = 60
+
+    def __init__(self, workers, rate, batch_size, poll_interval):
+        self.workers = workers
+        self.rate = rate
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.workers)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._executor = None
+        self._thread = None
+
+    # --- lifecycle ---
+    def start(self):
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'{self.thread_prefix}-send')
+            self._thread = threading.Thread(target=self._feed_loop, name=f'{self.thread_prefix}-feeder', daemon=True)
+            self._thread.start()
+            meta_api_logger.info(f"{self.label} started: {self.workers} workers, {self.rate} msg/s per phone number")
+
+    def stop(self, wait=True):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        if self._executor:
+            self._executor.shutdown(wait=wait)
+
+    def wake(self):
+        self.start()
+        self._wake.set()
+
+    def run_forever(self):
+        self.start()
+        while self._thread.is_alive():
+            self._thread.join(timeout=1)
+
+    # --- feeder ---
+    def _feed_loop(self):
+        last_housekeeping = None
+        while not self._stop.is_set():
+            close_old_connections()
+            try:
+                if last_housekeeping is None or time.monotonic() - last_housekeeping > self.housekeeping_interval:
+                    last_housekeeping = time.monotonic()
+                    self.housekeeping()
+                claimed = self._claim_and_submit()
+            except Exception as e:
+                meta_api_logger.exception(f"{self.label} loop error: {e}")
+                claimed = 0
+            if not claimed:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def housekeeping(self):
+        pass
+
+    def _claim_and_submit(self):
+        raise NotImplementedError
+
+    # --- workers ---
+    def _bucket(self, phone_number_id):
+        with self._buckets_lock:
+            if phone_number_id not in self._buckets:
+                self._buckets[phone_number_id] = TokenBucket(self.rate)
+            return self._buckets[phone_number_id]
+
+    def _release_slot(self):
+        self._slots.release()
+        self._wake.set()
+
+
+class OutboundDispatcher(SendPool):
+    label = 'Outbound dispatcher'
+    thread_prefix = 'outbound'
+
+    def __init__(self, workers=None, rate=None, batch_size=100, poll_interval=2.0):
+        super().__init__(
+            workers or settings.OUTBOUND_WORKERS, rate or settings.OUTBOUND_RATE_PER_SECOND, batch_size, poll_interval,
+        )
+        self.max_attempts = settings.OUTBOUND_MAX_ATTEMPTS
+        self.lease_seconds = settings.OUTBOUND_LEASE_SECONDS
+        self._in_flight = set()  # recipients with a message on a worker
+        self._in_flight_lock = threading.Lock()
+
+    def housekeeping(self):
+        self.requeue_stale()
+
+    def _claim_and_submit(self):
+        now = timezone.now()
+        # keep per-recipient order: only a recipient's oldest unsent row is a candidate,
+        # so a recipient whose head row is backing off blocks nobody but itself
+        older_unsent = OutboundMessage.objects.filter(
+            recipient=OuterRef('recipient'), id__lt=OuterRef('id'),
+            status__in=[OutboundMessage.STATUS_PENDING, OutboundMessage.STATUS_SENDING],
+        )
+        candidates = (
+            OutboundMessage.objects
+            .filter(status=OutboundMessage.STATUS_PENDING)
+            .exclude(next_attempt_at__gt=now)
+            .exclude(Exists(older_unsent))
+            .order_by('id')
+        )
+        claimed = 0
+        after = 0
+        while True:
+            page = list(candidates.filter(id__gt=after).values_list('id', 'recipient')[:self.batch_size])
+            for outbound_id, recipient in page:
+                after = outbound_id
+                with self._in_flight_lock:
+                    if recipient in self._in_flight:
+                        continue
+                if not self._slots.acquire(timeout=self.poll_interval):
+                    return claimed  # pool is busy; pick the rest up on the next pass
+                updated = OutboundMessage.objects.filter(pk=outbound_id, status=OutboundMessage.STATUS_PENDING).update(
+                    status=OutboundMessage.STATUS_SENDING, locked_at=timezone.now(),
+                )
+                if not updated:
+                    self._slots.release()
+                    continue
+                with self._in_flight_lock:
+                    self._in_flight.add(recipient)
+                self._executor.submit(self._send, outbound_id, recipient)
+                claimed += 1
+            if len(page) < self.batch_size:
+                return claimed
+
+    def requeue_stale(self):
+        cutoff = timezone.now() - timedelta(seconds=self.lease_seconds)
+        count = OutboundMessage.objects.filter(
+            status=OutboundMessage.STATUS_SENDING, locked_at__lt=cutoff
+        ).update(status=OutboundMessage.STATUS_PENDING, locked_at=None)
+        if count:
+            meta_api_logger.warning(f"Requeued {count} stale outbound messages (lease > {self.lease_seconds}s)")
+        return count
+
+    # --- workers ---
+    def _send(self, outbound_id, recipient):
+        outbound = None
+        requested = False
+        try:
+            close_old_connections()
+            outbound = OutboundMessage.objects.get(pk=outbound_id)
+            client = get_client()
+            self._bucket(client.phone_number_id).acquire()
+            outbound.attempts += 1
+            requested = True
+            try:
+                response = client.send_message(outbound.payload, timeout=15)
+            except requests.exceptions.RequestException as e:
+                if resend_is_safe(error=e):
+                    self._retry_or_fail(outbound, f"network error: {e}")
+                else:
+                    # the request went out: Meta may have delivered it
+                    self._fail(outbound, f"outcome unknown, not resent: network error: {e}")
+                return
+            meta_api_logger.info(
+                f"--- META API RESPONSE --- outbound {outbound_id} to {recipient}: Status {response.status_code} ({response.graph_elapsed_ms}ms) | Body: {truncate_text(response.text, settings.LOG_PAYLOAD_MAX_CHARS)}",
+                extra={'event': 'graph_response', 'sender': recipient, 'outbound_id': outbound_id, 'status': response.status_code, 'latency_ms': response.graph_elapsed_ms},
+            )
+            if response.status_code == 200:
+                try:
+                    wamid = response.json().get('messages', [{}])[0].get('id')
+                except ValueError:
+                    wamid = None
+                OutboundMessage.objects.filter(pk=outbound_id).update(
+                    status=OutboundMessage.STATUS_SENT, attempts=outbound.attempts, sent_at=timezone.now(),
+                    locked_at=None, response_message_id=wamid, last_error=None,
+                )
+            elif resend_is_safe(status=response.status_code):
+                self._retry_or_fail(outbound, f"HTTP {response.status_code}: {response.text[:500]}")
+            elif response.status_code >= 500:
+                self._fail(outbound, f"outcome unknown, not resent: HTTP {response.status_code}: {response.text[:500]}")
+            else:
+                # 4xx other than 429 won't get better by retrying
+                self._fail(outbound, f"HTTP {response.status_code}: {response.text[:500]}")
+        except Exception as e:
+            meta_api_logger.exception(f"Error sending outbound message {outbound_id} for {recipient}: {e}")
+            self._release_after_error(outbound_id, outbound, requested, e)
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.discard(recipient)
+            self._release_slot()
+
+    def _release_after_error(self, outbound_id, outbound, requested, error):
+        """Don't leave the row 'sending' until its lease expires: retry it, unless the request may have gone out."""
+        try:
+            if outbound is None:
+                OutboundMessage.objects.filter(pk=outbound_id, status=OutboundMessage.STATUS_SENDING).update(
+                    status=OutboundMessage.STATUS_PENDING, locked_at=None,
+                )
+            elif requested:
+                self._fail(outbound, f"outcome unknown, not resent: {error}")
+            else:
+                self._retry_or_fail(outbound, f"error: {error}")
+        except Exception as e:
+            meta_api_logger.error(f"Could not release outbound message {outbound_id} after an error, its lease will: {e}")
+
+    def _retry_or_fail(self, outbound, error):
+        if outbound.attempts >= self.max_attempts:
+            self._fail(outbound, error)
+            return
+        delay = min(2 ** outbound.attempts, 300)
+        meta_api_logger.warning(f"Outbound {outbound.pk} to {outbound.recipient} failed (attempt {outbound.attempts}), retry in {delay}s: {error}")
+        OutboundMessage.objects.filter(pk=outbound.pk).update(
+            status=OutboundMessage.STATUS_PENDING, attempts=outbound.attempts, locked_at=None,
+            next_attempt_at=timezone.now() + timedelta(seconds=delay), last_error=error,
+        )
+
+    def _fail(self, outbound, error):
+        meta_api_logger.error(f"Outbound {outbound.pk} to {outbound.recipient} failed permanently: {error}")
+        OutboundMessage.objects.filter(pk=outbound.pk).update(
+            status=OutboundMessage.STATUS_FAILED, attempts=outbound.attempts, locked_at=None, last_error=error,
+        )
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = OutboundDispatcher()
+        return _dispatcher
@@ -0,0 +1,322 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .archive import HISTORY_FIELDS
+from .caching import count_lookup
+
+try:
+    import redis
+except ImportError:  # only needed for RECENT_MESSAGES_BACKEND='redis'
+    redis = None
+
+meta_api_logger = logging.getLogger('meta_api_logger')
+
+# --- Recent messages per conversation ---
+# A ring buffer of the last RECENT_MESSAGES_PER_CONVERSATION messages of each
+# active contact, so opening (or catching up on) a busy chat needs no query.
+# Every ChatMessage write reaches it through conversations.record_messages()
+# (after commit); get_chat_history_json answers from it when it can and primes
+# it with the page it loaded from the database when it can't.
+#
+# A buffer is an unbroken tail of the conversation: everything newer than its
+# first message is in it. `has_older` says whether anything older exists
+# (None = unknown, for buffers started by a write rather than a history load).
+#
+# 'redis' (the default when REDIS_URL is set): one list per contact in Redis,
+#   shared by all processes, idle keys expire; the overall memory cap is Redis'
+#   own maxmemory policy.
+# 'memory' (opt-in): one LRU per process, capped by conversation count and bytes.
+#   Only exact when every ChatMessage writer is this one process: a single web
+#   worker with inline webhooks, no `process_webhooks` or `run_campaigns`.
+#   Writes from anywhere else never reach it, so a buffer lives at most
+#   RECENT_MESSAGES_IDLE_SECONDS after it was last written or primed (reads
+#   don't extend it); that bounds how long such a message can be missing.
+# 'off' (the default without Redis): always read the database.
+
+
+def serialize_message(message):
+    """History row of a saved ChatMessage, with the timestamp already JSON-encoded."""
+    entry = {field: getattr(message, field) for field in HISTORY_FIELDS}
+    return _encode(entry)
+
+
+def _encode(entry):
+    if entry.get('timestamp') is not None and not isinstance(entry['timestamp'], str):
+        entry = dict(entry, timestamp=DjangoJSONEncoder().default(entry['timestamp']))
+    return entry
+
+
+def _merge(current, new, per_conversation):
+    """Entries of both lists by id (new ones win), oldest first; returns (entries, trimmed)."""
+    by_id = {entry['id']: entry for entry in current}
+    by_id.update((entry['id'], entry) for entry in new)
+    entries = [by_id[message_id] for message_id in sorted(by_id)]
+    trimmed = len(entries) > per_conversation
+    return entries[-per_conversation:], trimmed
+
+
+def page_from_buffer(entries, has_older, limit, before=None, after=None):
+    """(page, has_more) like get_chat_history_json, or None if the buffer can't tell for sure."""
+    if after is not None:
+        if has_older is not False and (not entries or after < entries[0]['id']):
+            return None  # something between `after` and the buffer may be missing
+        page = [entry for entry in entries if entry['id'] > after][:limit + 1]
+        return page[:limit], len(page) > limit
+    candidates = entries if before is None else [entry for entry in entries if entry['id'] < before]
+    if len(candidates) > limit:
+        return candidates[-limit:], True
+    if has_older is False:
+        return candidates, False
+    return None
+
+
+class MemoryRecentMessages:
+    def __init__(self, per_conversation, max_conversations, max_bytes, idle_seconds):
+        self.per_conversation = per_conversation
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self._buffers = OrderedDict()  # sender_id -> [entries, has_older, size, written_at], least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def append(self, sender_id, entries):
+        with self._lock:
+            buffer = self._buffers.get(sender_id)
+            current, has_older = (buffer[0], buffer[1]) if buffer else ([], None)
+            merged, trimmed = _merge(current, entries, self.per_conversation)
+            self._store(sender_id, merged, True if trimmed else has_older)
+
+    def prime(self, sender_id, entries, has_older):
+        with self._lock:
+            buffer = self._buffers.get(sender_id)
+            # keep what was appended while the page was being loaded
+            merged, trimmed = _merge(buffer[0] if buffer else [], entries, self.per_conversation)
+            self._store(sender_id, merged, True if trimmed else has_older)
+
+    def update(self, sender_id, message_id, **fields):
+        with self._lock:
+            buffer = self._buffers.get(sender_id)
+            if buffer is None:
+                return
+            index = bisect_left([entry['id'] for entry in buffer[0]], message_id)
+            if index < len(buffer[0]) and buffer[0][index]['id'] == message_id:
+                buffer[0][index] = dict(buffer[0][index], **fields)
+
+    def page(self, sender_id, limit, before=None, after=None):
+        with self._lock:
+            buffer = self._buffers.get(sender_id)
+            if buffer is None:
+                return None
+            if time.monotonic() - buffer[3] > self.idle_seconds:
+                self._drop(sender_id)
+                return None
+            self._buffers.move_to_end(sender_id)
+            return page_from_buffer(buffer[0], buffer[1], limit, before, after)
+
+    def forget(self, sender_id):
+        with self._lock:
+            self._drop(sender_id)
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'conversations': len(self._buffers), 'bytes': self._bytes}
+
+    def _store(self, sender_id, entries, has_older):
+        self._drop(sender_id)
+        size = sum(len(json.dumps(entry, default=str)) for entry in entries)
+        self._buffers[sender_id] = [entries, has_older, size, time.monotonic()]
+        self._bytes += size
+        self._evict()
+
+    def _drop(self, sender_id):
+        buffer = self._buffers.pop(sender_id, None)
+        if buffer is not None:
+            self._bytes -= buffer[2]
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._buffers:
+            sender_id, buffer = next(iter(self._buffers.items()))
+            if len(self._buffers) > self.max_conversations or self._bytes > self.max_bytes or now - buffer[3] > self.idle_seconds:
+                self._drop(sender_id)
+            else:
+                break
+
+
+class RedisRecentMessages:
+    """Same interface as MemoryRecentMessages; one Redis list (+ has_older flag) per contact."""
+
+    def __init__(self, url, per_conversation, idle_seconds, prefix='whatsapp_sender:recent:'):
+        self.client = redis.Redis.from_url(url)
+        self.per_conversation = per_conversation
+        self.idle_seconds = idle_seconds
+        self.prefix = prefix
+
+    def _keys(self, sender_id):
+        return f"{self.prefix}{sender_id}", f"{self.prefix}{sender_id}:older"
+
+    def append(self, sender_id, entries):
+        key, older_key = self._keys(sender_id)
+        pipe = self.client.pipeline()
+        pipe.rpush(key, *[json.dumps(entry) for entry in entries])
+        pipe.ltrim(key, -self.per_conversation, -1)
+        pipe.expire(key, self.idle_seconds)
+        pipe.expire(older_key, self.idle_seconds)
+        length = pipe.execute()[0]
+        if length > self.per_conversation:
+            self.client.set(older_key, '1', ex=self.idle_seconds)
+
+    def prime(self, sender_id, entries, has_older):
+        key, older_key = self._keys(sender_id)
+        for _ in range(3):
+            with self.client.pipeline() as pipe:
+                try:
+                    # optimistic: retry if a write appended in the meantime
+                    pipe.watch(key)
+                    current = [json.loads(raw) for raw in pipe.lrange(key, 0, -1)]
+                    merged, trimmed = _merge(current, entries, self.per_conversation)
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.rpush(key, *[json.dumps(entry) for entry in merged])
+                    pipe.expire(key, self.idle_seconds)
+                    if trimmed or has_older:
+                        pipe.set(older_key, '1', ex=self.idle_seconds)
+                    elif has_older is False:
+                        pipe.set(older_key, '0', ex=self.idle_seconds)
+                    pipe.execute()
+                    return
+                except redis.WatchError:
+                    continue
+
+    def update(self, sender_id, message_id, **fields):
+        key, _ = self._keys(sender_id)
+        for _ in range(3):
+            with self.client.pipeline() as pipe:
+                try:
+                    # same optimistic retry as prime(): an append + ltrim shifts the indexes
+                    pipe.watch(key)
+                    for index, raw in enumerate(pipe.lrange(key, 0, -1)):
+                        entry = json.loads(raw)
+                        if entry['id'] == message_id:
+                            pipe.multi()
+                            pipe.lset(key, index, json.dumps(dict(entry, **fields)))
+                            pipe.execute()
+                            return
+                    return
+                except redis.WatchError:
+                    continue
+
+    def page(self, sender_id, limit, before=None, after=None):
+        key, older_key = self._keys(sender_id)
+        pipe = self.client.pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.get(older_key)
+        pipe.expire(key, self.idle_seconds)
+        pipe.expire(older_key, self.idle_seconds)
+        raw_entries, older = pipe.execute()[:2]
+        if not raw_entries:
+            return None
+        # writers in different processes may append slightly out of order
+        entries, _ = _merge([], [json.loads(raw) for raw in raw_entries], self.per_conversation)
+        has_older = None if older is None else older == b'1'
+        return page_from_buffer(entries, has_older, limit, before, after)
+
+    def forget(self, sender_id):
+        self.client.delete(*self._keys(sender_id))
+
+    def stats(self):
+        return {'backend': 'redis'}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """The configured store, or None when RECENT_MESSAGES_BACKEND is 'off'."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            backend = settings.RECENT_MESSAGES_BACKEND
+            if backend == 'redis' and redis is not None and settings.RECENT_MESSAGES_REDIS_URL:
+                _store = RedisRecentMessages(settings.RECENT_MESSAGES_REDIS_URL, settings.RECENT_MESSAGES_PER_CONVERSATION,
+                                             settings.RECENT_MESSAGES_IDLE_SECONDS)
+            elif backend in ('memory', 'redis'):
+                if backend == 'redis':
+                    meta_api_logger.warning("RECENT_MESSAGES_BACKEND=redis needs the redis package and REDIS_URL; using memory")
+                _store = MemoryRecentMessages(settings.RECENT_MESSAGES_PER_CONVERSATION, settings.RECENT_MESSAGES_MAX_CONVERSATIONS,
+                                              settings.RECENT_MESSAGES_MAX_BYTES, settings.RECENT_MESSAGES_IDLE_SECONDS)
+            else:
+                _store = False
+        return _store or None
+
+
+# --- entry points (never raise: the database stays the source of truth) ---
+
+def append_messages(messages):
+    store = get_store()
+    if store is None:
+        return
+    by_sender = {}
+    for message in messages:
+        if message.pk:
+            by_sender.setdefault(message.sender_id, []).append(serialize_message(message))
+    for sender_id, entries in by_sender.items():
+        try:
+            store.append(sender_id, entries)
+        except Exception as e:
+            meta_api_logger.warning(f"Recent messages append failed for {sender_id}: {e}")
+            forget(sender_id)
+
+
+def prime(sender_id, entries, has_older):
+    store = get_store()
+    if store is None or not entries:
+        return
+    try:
+        store.prime(sender_id, [_encode(entry) for entry in entries], has_older)
+    except Exception as e:
+        meta_api_logger.warning(f"Recent messages prime failed for {sender_id}: {e}")
+
+
+def recent_page(sender_id, limit, before=None, after=None):
+    """(messages, has_more) from the buffer, or None to read the database."""
+    store = get_store()
+    if store is None:
+        return None
+    try:
+        result = store.page(sender_id, limit, before, after)
+    except Exception as e:
+        meta_api_logger.warning(f"Recent messages read failed for {sender_id}: {e}")
+        result = None
+    count_lookup('recent_messages', result is not None)
+    return result
+
+
+def update_message(sender_id, message_id, **fields):
+    store = get_store()
+    if store is None:
+        return
+    try:
+        store.update(sender_id, message_id, **fields)
+    except Exception as e:
+        meta_api_logger.warning(f"Recent messages update failed for {sender_id}: {e}")
+        forget(sender_id)
+
+
+def forget(sender_id):
+    store = get_store()
+    if store is None:
+        return
+    try:
+        store.forget(sender_id)
+    except Exception as e:
+        meta_api_logger.warning(f"Recent messages forget failed for {sender_id}: {e}")
@@ -4,4 +4,6 @@ from . import consumers
 websocket_urlpatterns = [
     # This regex matches a phone number for the chat room
     re_path(r'ws/chat/(?P<phone_number>\d+)/$', consumers.ChatConsumer.as_asgi()),
+    # One multiplexed socket per agent: subscribes to many chats, plus inbox updates
+    re_path(r'ws/inbox/$', consumers.InboxConsumer.as_asgi()),
 ]
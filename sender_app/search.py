@@ -0,0 +1,148 @@
+import logging
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Max, Q
+
+from .models import ChatMessage, Conversation
+
+meta_api_logger = logging.getLogger('meta_api_logger')
+
+# --- Message search backends ---
+# PostgreSQL: GIN index on to_tsvector('simple', message_text) (see migration 0007),
+#   ranked with ts_rank, snippets from ts_headline.
+# SQLite: FTS5 table sender_app_chatmessage_fts kept in sync by triggers,
+#   ranked with bm25(), snippets from snippet().
+# Anything else (or SQLite without FTS5): the old icontains scan, limited.
+# Every token is matched as a prefix so results update while typing.
+# Only the newest SEARCH_CANDIDATE_LIMIT matching messages (by id, straight off
+# the index) are ranked, so a common word costs the same as a rare one.
+
+FTS_TABLE = 'sender_app_chatmessage_fts'
+SNIPPET_START = '['
+SNIPPET_STOP = ']'
+
+_fts5_available = None
+
+
+def tokenize(query):
+    return re.findall(r'\w+', query.lower())[:8]
+
+
+def search_conversations(query, limit=50):
+    """
+    Conversations whose number or messages match `query`, best first.
+    Returns [{'sender_id', 'snippet', 'rank'}]; number matches come first with an empty snippet.
+    """
+    query = query.strip()
+    if not query:
+        return []
+
+    results = []
+    seen = set()
+    # numbers: Conversation has one row per contact, so a contains-scan there is cheap
+    for sender_id in Conversation.objects.filter(sender_id__contains=query).order_by('-last_message_at').values_list('sender_id', flat=True)[:limit]:
+        results.append({'sender_id': sender_id, 'snippet': '', 'rank': None})
+        seen.add(sender_id)
+
+    tokens = tokenize(query)
+    if tokens and len(results) < limit:
+        for row in _search_messages(query, tokens, limit):
+            if row['sender_id'] not in seen:
+                results.append(row)
+                seen.add(row['sender_id'])
+    return results[:limit]
+
+
+def _search_messages(query, tokens, limit):
+    if connection.vendor == 'postgresql':
+        return _search_postgres(tokens, limit)
+    if connection.vendor == 'sqlite' and _has_fts5_table():
+        return _search_sqlite_fts5(tokens, limit)
+    return _search_fallback(query, limit)
+
+
+def _search_postgres(tokens, limit):
+    tsquery = ' & '.join(f"{token}:*" for token in tokens)
+    sql = f"""
+        WITH q AS (SELECT to_tsquery('simple', %s) AS query),
+        candidates AS (
+            SELECT m.id, m.sender_id, m.message_text, m.timestamp
+            FROM sender_app_chatmessage m, q
+            WHERE to_tsvector('simple', coalesce(m.message_text, '')) @@ q.query
+            ORDER BY m.id DESC
+            LIMIT %s
+        ),
+        best AS (
+            SELECT DISTINCT ON (c.sender_id)
+                   c.sender_id, c.message_text, c.timestamp,
+                   ts_rank(to_tsvector('simple', coalesce(c.message_text, '')), q.query) AS rank
+            FROM candidates c, q
+            ORDER BY c.sender_id, rank DESC, c.id DESC
+        )
+        SELECT best.sender_id,
+               ts_headline('simple', best.message_text, q.query,
+                           'StartSel={SNIPPET_START}, StopSel={SNIPPET_STOP}, MaxWords=16, MinWords=6'),
+               best.rank
+        FROM best, q
+        ORDER BY best.rank DESC, best.timestamp DESC
+        LIMIT %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [tsquery, settings.SEARCH_CANDIDATE_LIMIT, limit])
+        return [{'sender_id': r[0], 'snippet': r[1], 'rank': float(r[2])} for r in cursor.fetchall()]
+
+
+def _search_sqlite_fts5(tokens, limit):
+    match = ' '.join('"' + token.replace('"', '""') + '"*' for token in tokens)
+    # snippet() can't be used under a window function, so rank first and fetch snippets for the winners
+    best_sql = f"""
+        SELECT sender_id, message_id, rank FROM (
+            SELECT m.sender_id AS sender_id, m.id AS message_id, hits.rank AS rank,
+                   ROW_NUMBER() OVER (PARTITION BY m.sender_id ORDER BY hits.rank, m.id DESC) AS rn
+            FROM (
+                SELECT rowid, bm25({FTS_TABLE}) AS rank FROM {FTS_TABLE}
+                WHERE {FTS_TABLE} MATCH %s ORDER BY rowid DESC LIMIT %s
+            ) hits
+            JOIN sender_app_chatmessage m ON m.id = hits.rowid
+        )
+        WHERE rn = 1
+        ORDER BY rank
+        LIMIT %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(best_sql, [match, settings.SEARCH_CANDIDATE_LIMIT, limit])
+        best = cursor.fetchall()
+        if not best:
+            return []
+        ids = [row[1] for row in best]
+        placeholders = ', '.join(['%s'] * len(ids))
+        cursor.execute(
+            f"SELECT rowid, snippet({FTS_TABLE}, 0, %s, %s, '…', 12) FROM {FTS_TABLE} "
+            f"WHERE {FTS_TABLE} MATCH %s AND rowid IN ({placeholders})",
+            [SNIPPET_START, SNIPPET_STOP, match, *ids],
+        )
+        snippets = dict(cursor.fetchall())
+    # bm25 is "lower is better"; flip it so rank is "higher is better" like ts_rank
+    return [{'sender_id': sender_id, 'snippet': snippets.get(message_id, ''), 'rank': -float(rank)} for sender_id, message_id, rank in best]
+
+
+def _search_fallback(query, limit):
+    rows = (
+        ChatMessage.objects.filter(Q(message_text__icontains=query))
+        .values('sender_id').annotate(latest_message=Max('timestamp'))
+        .order_by('-latest_message').values_list('sender_id', flat=True)[:limit]
+    )
+    return [{'sender_id': sender_id, 'snippet': '', 'rank': None} for sender_id in rows]
+
+
+def _has_fts5_table():
+    global _fts5_available
+    if _fts5_available is None:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+            _fts5_available = cursor.fetchone() is not None
+        if not _fts5_available:
+            meta_api_logger.warning("SQLite FTS5 search table missing, falling back to LIKE search")
+    return _fts5_available
@@ -1,3 +1,1006 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+from concurrent.futures import Future
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import requests
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import archive, caching, deletion, ingest, outbound, search
+from .campaigns import CampaignRunner, create_campaign, set_campaign_status
+from .conversations import INBOX_GROUP, record_message
+from .dedup import DuplicateInFlight, RecentIdSet
+from .management.commands.process_webhooks import Command as ProcessWebhooksCommand
+from .media import parse_range, store_blob
+from .models import Campaign, CampaignRecipient, ChatDeletion, ChatMessage, MediaBlob, MessageArchive, OutboundMessage, WebhookEvent
+from .routing import websocket_urlpatterns
+from .views import process_webhook_payload
+
+
+def text_payload(*wamids, sender='15550001111'):
+    messages = [{'id': wamid, 'from': sender, 'type': 'text', 'text': {'body': f'hi {wamid}'}} for wamid in wamids]
+    return {'entry': [{'changes': [{'value': {'messages': messages}}]}]}
+
+
+class WebhookQueueTests(TestCase):
+    def test_claimed_events_are_not_claimed_again(self):
+        events = [ingest.enqueue_webhook('{}') for _ in range(3)]
+
+        first = ingest.claim_events(2)
+        second = ingest.claim_events(10)
+
+        self.assertEqual([e.pk for e in first], [events[0].pk, events[1].pk])
+        self.assertEqual([e.pk for e in second], [events[2].pk])
+        self.assertEqual(ingest.claim_events(10), [])
+        for event in first + second:
+            self.assertEqual(event.status, WebhookEvent.STATUS_PROCESSING)
+            self.assertEqual(event.attempts, 1)
+
+    def test_claim_skips_events_taken_since_they_were_listed(self):
+        event = ingest.enqueue_webhook('{}')
+        # another worker claims it between our candidate SELECT and our UPDATE
+        WebhookEvent.objects.filter(pk=event.pk).update(status=WebhookEvent.STATUS_PROCESSING, locked_at=timezone.now())
+
+        self.assertEqual(ingest.claim_events(10), [])
+        event.refresh_from_db()
+        self.assertEqual(event.attempts, 0)
+
+    def test_claim_waits_for_backoff(self):
+        event = ingest.enqueue_webhook('{}')
+        WebhookEvent.objects.filter(pk=event.pk).update(available_at=timezone.now() + timedelta(minutes=1))
+
+        self.assertEqual(ingest.claim_events(10), [])
+
+    def test_stale_lease_is_requeued(self):
+        stale, fresh = ingest.enqueue_webhook('{}'), ingest.enqueue_webhook('{}')
+        ingest.claim_events(10)
+        WebhookEvent.objects.filter(pk=stale.pk).update(locked_at=timezone.now() - timedelta(seconds=600))
+
+        self.assertEqual(ingest.requeue_stale(lease_seconds=300), 1)
+
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual(stale.status, WebhookEvent.STATUS_PENDING)
+        self.assertIsNone(stale.locked_at)
+        self.assertEqual(fresh.status, WebhookEvent.STATUS_PROCESSING)
+        self.assertEqual([e.pk for e in ingest.claim_events(10)], [stale.pk])
+
+    @override_settings(WEBHOOK_QUEUE_MAX_ATTEMPTS=3)
+    def test_failed_event_goes_back_to_pending(self):
+        ingest.enqueue_webhook('not json')
+        [event] = ingest.claim_events(10)
+
+        ProcessWebhooksCommand()._process(event)
+
+        event.refresh_from_db()
+        self.assertEqual(event.status, WebhookEvent.STATUS_PENDING)
+        self.assertGreater(event.available_at, timezone.now())
+        self.assertIsNone(event.locked_at)
+        self.assertTrue(event.last_error)
+        self.assertEqual(ingest.claim_events(10), [])  # backing off
+
+    @override_settings(WEBHOOK_QUEUE_MAX_ATTEMPTS=1)
+    def test_event_is_parked_after_max_attempts(self):
+        ingest.enqueue_webhook('not json')
+        [event] = ingest.claim_events(10)
+
+        ProcessWebhooksCommand()._process(event)
+
+        event.refresh_from_db()
+        self.assertEqual(event.status, WebhookEvent.STATUS_FAILED)
+
+
+class FakeResponse:
+    graph_elapsed_ms = 1.0
+
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body if body is not None else {}
+        self.text = str(self.body)
+
+    def json(self):
+        return self.body
+
+
+class OutboundDispatcherTests(TestCase):
+    def setUp(self):
+        self.client_stub = mock.Mock(phone_number_id='100')
+        self.client_stub.send_message.return_value = FakeResponse(200, {'messages': [{'id': 'wamid.1'}]})
+        for patcher in (
+            mock.patch('sender_app.outbound.get_client', return_value=self.client_stub),
+            mock.patch('sender_app.outbound.close_old_connections'),  # keep the test transaction's connection
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.dispatcher = outbound.OutboundDispatcher(workers=4, rate=1000, batch_size=2, poll_interval=0.01)
+        self.dispatcher._executor = mock.Mock()
+
+    def enqueue(self, recipient, **fields):
+        return OutboundMessage.objects.create(recipient=recipient, payload={'to': recipient}, **fields)
+
+    def claimed(self):
+        ids = [call.args[1] for call in self.dispatcher._executor.submit.call_args_list]  # submit(_send, id, recipient)
+        self.dispatcher._executor.submit.reset_mock()
+        return ids
+
+    def send(self, row):
+        self.dispatcher._slots.acquire()  # _send gives its slot back
+        OutboundMessage.objects.filter(pk=row.pk).update(status=OutboundMessage.STATUS_SENDING, locked_at=timezone.now())
+        self.dispatcher._send(row.pk, row.recipient)
+        row.refresh_from_db()
+        return row
+
+    def test_claims_only_the_oldest_unsent_row_per_recipient(self):
+        a1, a2, b1 = self.enqueue('a'), self.enqueue('a'), self.enqueue('b')
+
+        self.dispatcher._claim_and_submit()
+
+        self.assertEqual(self.claimed(), [a1.pk, b1.pk])
+        a2.refresh_from_db()
+        self.assertEqual(a2.status, OutboundMessage.STATUS_PENDING)
+
+    def test_backing_off_recipient_blocks_only_itself(self):
+        self.enqueue('a', next_attempt_at=timezone.now() + timedelta(minutes=5))
+        for _ in range(5):  # more than one page of the blocked recipient
+            self.enqueue('a')
+        b1 = self.enqueue('b')
+
+        self.dispatcher._claim_and_submit()
+
+        self.assertEqual(self.claimed(), [b1.pk])
+
+    def test_success_marks_sent(self):
+        row = self.send(self.enqueue('a'))
+
+        self.assertEqual(row.status, OutboundMessage.STATUS_SENT)
+        self.assertEqual(row.response_message_id, 'wamid.1')
+        self.assertEqual(row.attempts, 1)
+        self.assertIsNone(row.locked_at)
+
+    def test_rate_limited_send_is_retried_later(self):
+        self.client_stub.send_message.return_value = FakeResponse(429)
+
+        row = self.send(self.enqueue('a'))
+
+        self.assertEqual(row.status, OutboundMessage.STATUS_PENDING)
+        self.assertGreater(row.next_attempt_at, timezone.now())
+        self.assertEqual(row.attempts, 1)
+
+    def test_connection_never_opened_is_retried(self):
+        self.client_stub.send_message.side_effect = requests.exceptions.ConnectTimeout('connect timeout')
+
+        row = self.send(self.enqueue('a'))
+
+        self.assertEqual(row.status, OutboundMessage.STATUS_PENDING)
+
+    def test_send_that_may_have_been_delivered_is_not_resent(self):
+        for outcome in (FakeResponse(500), requests.exceptions.ReadTimeout('read timeout')):
+            with self.subTest(outcome=outcome):
+                self.client_stub.send_message.side_effect = outcome if isinstance(outcome, Exception) else None
+                self.client_stub.send_message.return_value = outcome
+
+                row = self.send(self.enqueue('a'))
+
+                self.assertEqual(row.status, OutboundMessage.STATUS_FAILED)
+                self.assertIn('outcome unknown', row.last_error)
+
+    def test_client_error_fails_permanently(self):
+        self.client_stub.send_message.return_value = FakeResponse(400, {'error': {'message': 'bad'}})
+
+        row = self.send(self.enqueue('a'))
+
+        self.assertEqual(row.status, OutboundMessage.STATUS_FAILED)
+
+    @override_settings(OUTBOUND_MAX_ATTEMPTS=2)
+    def test_retries_stop_at_max_attempts(self):
+        self.dispatcher = outbound.OutboundDispatcher(workers=1, rate=1000)
+        self.client_stub.send_message.return_value = FakeResponse(429)
+
+        row = self.send(self.enqueue('a', attempts=1))
+
+        self.assertEqual(row.status, OutboundMessage.STATUS_FAILED)
+        self.assertEqual(row.attempts, 2)
+
+    def test_unexpected_error_before_sending_releases_the_row(self):
+        with mock.patch.object(self.dispatcher, '_bucket', side_effect=RuntimeError('boom')):
+            row = self.send(self.enqueue('a'))
+
+        self.assertEqual(row.status, OutboundMessage.STATUS_PENDING)
+        self.client_stub.send_message.assert_not_called()
+
+    def test_stale_sending_rows_are_requeued(self):
+        stale = self.enqueue('a', status=OutboundMessage.STATUS_SENDING, locked_at=timezone.now() - timedelta(hours=1))
+        fresh = self.enqueue('b', status=OutboundMessage.STATUS_SENDING, locked_at=timezone.now())
+
+        self.assertEqual(self.dispatcher.requeue_stale(), 1)
+
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual(stale.status, OutboundMessage.STATUS_PENDING)
+        self.assertEqual(fresh.status, OutboundMessage.STATUS_SENDING)
+
+
+class CampaignRunnerTests(TestCase):
+    def setUp(self):
+        self.client_stub = mock.Mock(phone_number_id='100')
+        self.client_stub.send_message.return_value = FakeResponse(200, {'messages': [{'id': 'wamid.1'}]})
+        for patcher in (
+            mock.patch('sender_app.outbound.get_client', return_value=self.client_stub),
+            mock.patch('sender_app.campaigns.get_client', return_value=self.client_stub),
+            mock.patch('sender_app.campaigns.close_old_connections'),  # keep the test transaction's connection
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.runner = CampaignRunner(workers=4, rate=1000, batch_size=10, poll_interval=0.01)
+        self.runner._executor = mock.Mock()
+        self.campaign = create_campaign('spring', 'hello_world', ['15550001111', '15550002222'])
+
+    def claimed(self):
+        ids = [call.args[1] for call in self.runner._executor.submit.call_args_list]  # submit(_send, id)
+        self.runner._executor.submit.reset_mock()
+        return ids
+
+    def send(self, recipient):
+        self.runner._slots.acquire()  # _send gives its slot back
+        CampaignRecipient.objects.filter(pk=recipient.pk).update(status=CampaignRecipient.STATUS_SENDING, locked_at=timezone.now())
+        self.runner._send(recipient.pk)
+        recipient.refresh_from_db()
+        return recipient
+
+    def test_claims_due_rows_of_running_campaigns_only(self):
+        paused = create_campaign('paused', 'hello_world', ['15550003333'])
+        set_campaign_status(paused, Campaign.STATUS_PAUSED)
+        first, backing_off = self.campaign.recipients.order_by('id')
+        CampaignRecipient.objects.filter(pk=backing_off.pk).update(next_attempt_at=timezone.now() + timedelta(minutes=5))
+
+        self.runner._claim_and_submit()
+
+        self.assertEqual(self.claimed(), [first.pk])
+        first.refresh_from_db()
+        self.assertEqual(first.status, CampaignRecipient.STATUS_SENDING)
+        self.campaign.refresh_from_db()
+        self.assertIsNotNone(self.campaign.started_at)
+        self.assertEqual(paused.recipients.get().status, CampaignRecipient.STATUS_PENDING)
+
+    def test_success_marks_sent_and_records_the_chat(self):
+        recipient = self.send(self.campaign.recipients.first())
+
+        self.assertEqual(recipient.status, CampaignRecipient.STATUS_SENT)
+        self.assertEqual(recipient.response_message_id, 'wamid.1')
+        self.assertTrue(ChatMessage.objects.filter(sender_id=recipient.phone_number, message_type='system').exists())
+
+    def test_rate_limited_send_is_retried_later(self):
+        self.client_stub.send_message.return_value = FakeResponse(429)
+
+        recipient = self.send(self.campaign.recipients.first())
+
+        self.assertEqual(recipient.status, CampaignRecipient.STATUS_PENDING)
+        self.assertGreater(recipient.next_attempt_at, timezone.now())
+        self.assertEqual(recipient.attempts, 1)
+
+    def test_rejected_or_possibly_delivered_send_fails(self):
+        for response in (FakeResponse(400, {'error': {'message': 'invalid user'}}), FakeResponse(500)):
+            with self.subTest(status=response.status_code):
+                self.client_stub.send_message.return_value = response
+                CampaignRecipient.objects.filter(campaign=self.campaign).update(status=CampaignRecipient.STATUS_PENDING, attempts=0)
+
+                recipient = self.send(self.campaign.recipients.first())
+
+                self.assertEqual(recipient.status, CampaignRecipient.STATUS_FAILED)
+                self.assertEqual(recipient.attempts, 1)
+
+    def test_finished_campaign_is_completed(self):
+        self.campaign.recipients.update(status=CampaignRecipient.STATUS_SENT)
+
+        self.runner.complete_finished()
+
+        self.campaign.refresh_from_db()
+        self.assertEqual(self.campaign.status, Campaign.STATUS_COMPLETED)
+        self.assertIsNotNone(self.campaign.finished_at)
+
+
+class TokenBucketTests(TestCase):
+    def test_burst_then_rate(self):
+        bucket = outbound.TokenBucket(rate=20, capacity=2)
+
+        started = time.monotonic()
+        bucket.acquire()
+        bucket.acquire()
+        burst = time.monotonic() - started
+        bucket.acquire()
+        total = time.monotonic() - started
+
+        self.assertLess(burst, 0.04)
+        self.assertGreaterEqual(total, 0.04)  # one token every 50ms once the burst is spent
+
+
+class RecentIdSetTests(TestCase):
+    def test_reserve_commit_release(self):
+        recent = RecentIdSet(capacity=10)
+
+        self.assertTrue(recent.reserve('a'))
+        self.assertFalse(recent.reserve('a'))  # in flight
+        self.assertTrue(recent.in_flight('a'))
+
+        recent.release('a')  # failed attempt: a retry must get through
+        self.assertNotIn('a', recent)
+        self.assertTrue(recent.reserve('a'))
+
+        recent.commit('a')
+        self.assertFalse(recent.in_flight('a'))
+        self.assertFalse(recent.reserve('a'))  # stored: a real duplicate
+        self.assertEqual(len(recent), 1)
+
+    def test_capacity_evicts_oldest(self):
+        recent = RecentIdSet(capacity=2)
+        for wamid in 'abc':
+            recent.reserve(wamid)
+            recent.commit(wamid)
+
+        self.assertEqual(len(recent), 2)
+        self.assertTrue(recent.reserve('a'))
+        self.assertFalse(recent.reserve('c'))
+
+
+@mock.patch('sender_app.views.async_to_sync', lambda fn: lambda *args, **kwargs: None)
+class WebhookDedupTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch('sender_app.views.recent_ids', return_value=RecentIdSet(capacity=100))
+        self.recent = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    def test_redelivery_is_stored_once(self):
+        process_webhook_payload(text_payload('w1', 'w2'))
+        process_webhook_payload(text_payload('w1', 'w2'))
+
+        self.assertEqual(ChatMessage.objects.filter(wamid__in=['w1', 'w2']).count(), 2)
+        self.assertFalse(self.recent.in_flight('w1'))
+
+    def test_in_flight_duplicate_is_not_dropped(self):
+        self.recent.reserve('w1')  # another worker is processing it
+
+        with self.assertRaises(DuplicateInFlight):
+            process_webhook_payload(text_payload('w1', 'w2'))
+
+        self.assertFalse(ChatMessage.objects.exists())
+        self.assertFalse(self.recent.in_flight('w2'))
+
+        self.recent.release('w1')  # that attempt failed: the redelivery is processed
+        process_webhook_payload(text_payload('w1', 'w2'))
+        self.assertEqual(ChatMessage.objects.filter(wamid__in=['w1', 'w2']).count(), 2)
+
+    def test_wamid_repeated_within_a_payload_is_stored_once(self):
+        process_webhook_payload(text_payload('w1', 'w1', 'w2'))
+
+        self.assertEqual(ChatMessage.objects.filter(wamid='w1').count(), 1)
+        self.assertTrue(ChatMessage.objects.filter(wamid='w2').exists())
+        self.assertFalse(self.recent.in_flight('w1'))
+
+    @override_settings(WEBHOOK_INGEST_MODE='inline')
+    def test_webhook_asks_for_redelivery_of_in_flight_duplicate(self):
+        self.recent.reserve('w1')
+
+        response = self.client.post(reverse('webhook'), text_payload('w1'), content_type='application/json')
+
+        self.assertEqual(response.status_code, 503)
+        self.recent.release('w1')
+        response = self.client.post(reverse('webhook'), text_payload('w1'), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(ChatMessage.objects.filter(wamid='w1').exists())
+
+
+class CacheVersionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_row_loaded_before_a_write_is_not_served_after_it(self):
+        def load_then_write():
+            row = {'unread_count': 1}  # read before the writer committed
+            caching.invalidate_conversation('155')  # the writer's on_commit
+            return row
+
+        caching.get_or_set('conversation', caching.conversation_key('155'), load_then_write)
+        fresh = caching.get_or_set('conversation', caching.conversation_key('155'), lambda: {'unread_count': 2})
+
+        self.assertEqual(fresh, {'unread_count': 2})
+
+    def test_culled_version_does_not_revive_old_pages(self):
+        old_key = caching.inbox_key(50, None)
+        cache.set(old_key, ['stale page'])
+        caching.invalidate_inbox()
+        cache.delete(caching.INBOX_VERSION_KEY)  # evicted
+
+        self.assertNotEqual(caching.inbox_key(50, None), old_key)
+
+
+def image_message(wamid, sender='15550001111'):
+    return {'id': wamid, 'from': sender, 'type': 'image', 'image': {'id': f'media-{wamid}'}}
+
+
+@mock.patch('sender_app.views.async_to_sync', lambda fn: lambda *args, **kwargs: None)
+class WebhookMediaReferenceTests(TestCase):
+    """Each download takes a blob reference; only stored rows may keep it."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, MEDIA_STORE_MODE='content')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        for patcher in (
+            mock.patch('sender_app.views.recent_ids', return_value=RecentIdSet(capacity=100)),
+            mock.patch('sender_app.views.submit_download', side_effect=self.download),
+            mock.patch('sender_app.views.schedule_thumbnails'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def download(self, fn, message_type, media_id, webhook_url):
+        # what fetch_incoming_media does, minus the HTTP: store the bytes as a blob
+        path = os.path.join(self.media_root, f'{media_id}.part')
+        with open(path, 'wb') as f:
+            f.write(b'same picture')
+        blob, _ = store_blob(path, 'ab' * 32, 'jpg', 12)
+        future = Future()
+        future.set_result((blob.web_path, 'image'))
+        return future
+
+    def ref_count(self):
+        return MediaBlob.objects.get().ref_count
+
+    def payload(self, *messages):
+        return {'entry': [{'changes': [{'value': {'messages': list(messages)}}]}]}
+
+    def test_stored_rows_keep_their_references(self):
+        process_webhook_payload(self.payload(image_message('w1'), image_message('w2')))
+
+        self.assertEqual(self.ref_count(), 2)
+
+    def test_skipped_duplicate_row_releases_its_reference(self):
+        with mock.patch('sender_app.views._save_incoming', return_value=[]):
+            process_webhook_payload(self.payload(image_message('w1')))
+
+        self.assertEqual(self.ref_count(), 0)
+
+    def test_failed_save_releases_references(self):
+        with mock.patch('sender_app.views._save_incoming', side_effect=RuntimeError('db down')):
+            with self.assertRaises(RuntimeError):
+                process_webhook_payload(self.payload(image_message('w1')))
+
+        self.assertEqual(self.ref_count(), 0)
+
+    def test_error_after_save_keeps_references(self):
+        with mock.patch('sender_app.views.schedule_thumbnails', side_effect=RuntimeError('no pool')):
+            with self.assertRaises(RuntimeError):
+                process_webhook_payload(self.payload(image_message('w1')))
+
+        self.assertEqual(self.ref_count(), 1)
+        self.assertTrue(ChatMessage.objects.filter(wamid='w1').exists())
+
+    def test_uncollected_download_releases_its_reference(self):
+        broken = {'id': 'w0', 'from': '15550001111', 'type': 'text', 'text': 'not an object'}
+
+        with self.assertRaises(AttributeError):
+            process_webhook_payload(self.payload(broken, image_message('w1')))
+
+        self.assertEqual(self.ref_count(), 0)
+
+
+@override_settings(CHAT_DELETE_IN_PROCESS=False, CHAT_DELETE_CHUNK_SIZE=2, CHAT_DELETE_PAUSE_SECONDS=0)
+class ChatDeletionTests(TestCase):
+    def setUp(self):
+        self.blob = MediaBlob.objects.create(sha256='cd' * 32, extension='jpg', size=12, ref_count=0)
+
+    def message(self, sender_id='15550001111', media=False):
+        if media:
+            MediaBlob.objects.filter(pk=self.blob.pk).update(ref_count=F('ref_count') + 1)
+        return ChatMessage.objects.create(
+            sender_id=sender_id, is_from_user=True, message_type='image' if media else 'text',
+            media_url=self.blob.web_path if media else None,
+        )
+
+    def test_chunked_deletion_releases_media_references(self):
+        for media in (True, False, True, True, False):
+            self.message(media=media)
+        other = self.message(sender_id='15550002222', media=True)
+        job = deletion.request_deletion('15550001111')
+        later = self.message()  # arrived after the request
+
+        self.assertTrue(deletion.run_deletion(job.pk))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ChatDeletion.STATUS_DONE)
+        self.assertEqual(job.deleted_messages, 5)
+        self.assertEqual(list(ChatMessage.objects.order_by('id').values_list('id', flat=True)), [other.pk, later.pk])
+        self.blob.refresh_from_db()
+        self.assertEqual(self.blob.ref_count, 1)  # the other contact's message
+
+    def test_second_request_extends_the_pending_job(self):
+        self.message()
+        first = deletion.request_deletion('15550001111')
+        newer = self.message()
+
+        second = deletion.request_deletion('15550001111')
+
+        self.assertEqual(second.pk, first.pk)
+        self.assertEqual(second.max_message_id, newer.pk)
+        self.assertEqual(ChatDeletion.objects.count(), 1)
+
+    def test_nothing_to_delete(self):
+        self.assertIsNone(deletion.request_deletion('15550001111'))
+
+
+class GcMediaTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.referenced = self.blob('aa', ref_count=1)
+        ChatMessage.objects.create(sender_id='15550001111', is_from_user=True, message_type='image', media_url=self.referenced.web_path)
+        self.orphan = self.blob('bb', ref_count=0)
+        self.still_counted = self.blob('cc', ref_count=1)  # a download whose message isn't committed yet
+        self.old_upload = self.file('image/old.jpg')
+        self.new_upload = self.file('image/new.jpg', age_hours=1)
+
+    def file(self, relative, age_hours=48):
+        path = os.path.join(self.media_root, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'picture')
+        mtime = time.time() - age_hours * 3600
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def blob(self, prefix, ref_count):
+        blob = MediaBlob.objects.create(sha256=prefix * 32, extension='jpg', size=7, ref_count=ref_count)
+        blob.full_path = self.file(blob.relative_path)
+        return blob
+
+    def gc(self, **options):
+        out = StringIO()
+        call_command('gc_media', stdout=out, **options)
+        return out.getvalue()
+
+    def test_dry_run_deletes_nothing(self):
+        output = self.gc(dry_run=True)
+
+        self.assertIn('Would delete 2 orphaned files', output)
+        for path in (self.orphan.full_path, self.old_upload, self.new_upload):
+            self.assertTrue(os.path.exists(path))
+        self.assertTrue(MediaBlob.objects.filter(pk=self.orphan.pk).exists())
+
+    def test_deletes_unreferenced_files_older_than_min_age(self):
+        output = self.gc()
+
+        self.assertIn('Deleted 2 orphaned files', output)
+        self.assertFalse(os.path.exists(self.orphan.full_path))
+        self.assertFalse(MediaBlob.objects.filter(pk=self.orphan.pk).exists())
+        self.assertFalse(os.path.exists(self.old_upload))
+        for path in (self.referenced.full_path, self.still_counted.full_path, self.new_upload):
+            self.assertTrue(os.path.exists(path))
+
+    def test_min_age_hours(self):
+        self.gc(min_age_hours=0)
+
+        self.assertFalse(os.path.exists(self.new_upload))
+        self.assertTrue(os.path.exists(self.still_counted.full_path))  # ref_count > 0 still wins
+
+
+class MessageArchiveTests(TestCase):
+    def setUp(self):
+        archive_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_root, ignore_errors=True)
+        settings_override = override_settings(MESSAGE_ARCHIVE_ROOT=archive_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        for patcher in (
+            mock.patch.object(archive, '_cache', OrderedDict()),
+            mock.patch.object(archive, '_cache_bytes', 0),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        session = self.client.session
+        session['is_authenticated'] = True
+        session.save()
+
+    def messages(self, count, sender_id='15550001111'):
+        return [
+            ChatMessage.objects.create(sender_id=sender_id, is_from_user=True, message_text=f'm{i}').pk
+            for i in range(count)
+        ]
+
+    def history(self, **params):
+        response = self.client.get(reverse('get_chat_history', args=['15550001111']), params)
+        body = response.json()
+        return [message['id'] for message in body['messages']], body['has_more']
+
+    def test_chunk_moves_the_oldest_rows_into_one_file_per_contact(self):
+        a = self.messages(3)
+        b = self.messages(2, sender_id='15550002222')
+
+        self.assertEqual(archive.archive_chunk(b[-1], chunk_size=4), 4)
+
+        self.assertEqual(list(ChatMessage.objects.values_list('id', flat=True)), [b[1]])
+        archives = {row.sender_id: row for row in MessageArchive.objects.all()}
+        self.assertEqual((archives['15550001111'].first_id, archives['15550001111'].last_id), (a[0], a[-1]))
+        self.assertEqual([m['id'] for m in archive.read_archive(archives['15550001111'])], a)
+        self.assertEqual([m['message_text'] for m in archive.read_archive(archives['15550002222'])], ['m0'])
+
+    def test_history_pages_continue_into_the_archive(self):
+        ids = self.messages(5)
+        archive.archive_chunk(ids[2])
+
+        self.assertEqual(self.history(limit=4), (ids[1:], True))
+        self.assertEqual(self.history(limit=4, before=ids[1]), ([ids[0]], False))
+        self.assertEqual(self.history(limit=3, after=ids[0]), (ids[1:4], True))
+
+    def test_cache_stays_within_its_byte_budget(self):
+        ids = self.messages(4)
+        archive.archive_chunk(ids[1])
+        archive.archive_chunk(ids[3])
+        older, newer = MessageArchive.objects.order_by('id')
+        archive.read_archive(older)
+        one_file = archive._cache_bytes
+
+        with override_settings(MESSAGE_ARCHIVE_CACHE_BYTES=one_file * 3 // 2):
+            archive.read_archive(newer)
+
+        self.assertEqual(len(archive._cache), 1)  # the older file was evicted
+        self.assertLessEqual(archive._cache_bytes, one_file * 3 // 2)
+        self.assertEqual([m['id'] for m in archive.read_archive(older)], ids[:2])  # still readable, from disk
+
+
+def websocket(path, authenticated=True):
+    communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+    communicator.scope['session'] = {'is_authenticated': authenticated}
+    return communicator
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ChatConsumerTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch('channels.db.close_old_connections')  # keep the test transaction's connection
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_unauthenticated_socket_is_closed(self):
+        communicator = websocket('/ws/chat/155/', authenticated=False)
+
+        connected, _ = await communicator.connect()
+
+        self.assertFalse(connected)
+
+    async def test_operator_message_is_stored_queued_and_echoed(self):
+        communicator = websocket('/ws/chat/155/')
+        await communicator.connect()
+
+        await communicator.send_json_to({'message': 'hello'})
+        frame = await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        message = await sync_to_async(ChatMessage.objects.get)(sender_id='155')
+        self.assertEqual(frame, {'id': message.pk, 'message': 'hello', 'is_from_user': False, 'sender_id': '155'})
+        self.assertTrue(await sync_to_async(OutboundMessage.objects.filter(chat_message=message).exists)())
+
+    async def chat_with_messages(self, count):
+        ids = []
+        for i in range(count):
+            message = await sync_to_async(ChatMessage.objects.create)(sender_id='155', is_from_user=True, message_text=f'm{i}')
+            ids.append(message.pk)
+        communicator = websocket('/ws/chat/155/')
+        await communicator.connect()
+        return communicator, ids
+
+    async def test_resume_replays_messages_after_last_id(self):
+        communicator, ids = await self.chat_with_messages(3)
+
+        await communicator.send_json_to({'action': 'resume', 'last_id': ids[0]})
+        frame = await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        self.assertEqual(frame['type'], 'batch')
+        self.assertEqual([f['id'] for f in frame['frames'][:-1]], ids[1:])
+        self.assertEqual(frame['frames'][-1], {'type': 'resumed', 'sender_id': '155', 'last_id': ids[2], 'replayed': 2})
+
+    async def test_replayed_message_is_not_sent_again_live(self):
+        communicator, ids = await self.chat_with_messages(2)
+        await communicator.send_json_to({'action': 'resume', 'last_id': ids[0]})
+        await communicator.receive_json_from()
+
+        for message_id in (ids[1], ids[1] + 1):
+            await get_channel_layer().group_send('chat_155', {
+                'type': 'chat_message', 'id': message_id, 'message': 'live', 'is_from_user': True, 'sender_id': '155',
+            })
+        frame = await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        self.assertEqual(frame['id'], ids[1] + 1)
+
+    @override_settings(WS_RESUME_MAX_MESSAGES=1)
+    async def test_resume_too_far_behind_asks_for_resync(self):
+        communicator, ids = await self.chat_with_messages(3)
+
+        await communicator.send_json_to({'action': 'resume', 'last_id': ids[0]})
+        frame = await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        self.assertEqual(frame, {'type': 'resync_required', 'sender_id': '155'})
+
+    async def test_resume_into_the_archive_asks_for_resync(self):
+        communicator, ids = await self.chat_with_messages(2)
+        await sync_to_async(ChatMessage.objects.filter(pk=ids[0]).delete)()  # archived
+        await sync_to_async(MessageArchive.objects.create)(
+            sender_id='155', first_id=ids[0], last_id=ids[0], first_timestamp=timezone.now(),
+            last_timestamp=timezone.now(), message_count=1, path='archived.jsonl.gz',
+        )
+
+        await communicator.send_json_to({'action': 'resume', 'last_id': 0})
+        frame = await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        self.assertEqual(frame, {'type': 'resync_required', 'sender_id': '155'})
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class InboxConsumerTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch('channels.db.close_old_connections')  # keep the test transaction's connection
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def chat_event(self, sender_id, message_id):
+        await get_channel_layer().group_send(f'chat_{sender_id}', {
+            'type': 'chat_message', 'id': message_id, 'message': 'hi', 'is_from_user': True, 'sender_id': sender_id,
+        })
+
+    async def test_chat_events_follow_subscriptions(self):
+        communicator = websocket('/ws/inbox/')
+        await communicator.connect()
+
+        await communicator.send_json_to({'action': 'subscribe', 'sender_id': '155', 'last_id': 0})
+        await communicator.receive_json_from()  # resumed: the subscription is in place
+        await self.chat_event('155', 1)
+        await self.chat_event('166', 2)
+        subscribed = await communicator.receive_json_from()
+        await communicator.send_json_to({'action': 'unsubscribe', 'sender_id': '155'})
+        await communicator.send_json_to({'action': 'resume', 'sender_id': '155', 'last_id': 0})
+        await communicator.receive_json_from()  # not subscribed: the unsubscribe went through
+        await self.chat_event('155', 3)
+        nothing_after_unsubscribe = await communicator.receive_nothing(timeout=0.1)
+        await communicator.disconnect()
+
+        self.assertEqual((subscribed['sender_id'], subscribed['id']), ('155', 1))
+        self.assertTrue(nothing_after_unsubscribe)
+
+    async def test_inbox_updates_reach_every_inbox_socket(self):
+        communicator = websocket('/ws/inbox/')
+        await communicator.connect()
+
+        await get_channel_layer().group_send(INBOX_GROUP, {
+            'type': 'inbox_update', 'conversations': [{'sender_id': '155', 'unread_count': 1}], 'deleted': [],
+        })
+        frame = await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        self.assertEqual(frame, {'type': 'inbox', 'conversations': [{'sender_id': '155', 'unread_count': 1}], 'deleted': []})
+
+    @override_settings(WS_MAX_SUBSCRIPTIONS=1)
+    async def test_rejected_actions(self):
+        communicator = websocket('/ws/inbox/')
+        await communicator.connect()
+
+        errors = []
+        for action in (
+            {'action': 'subscribe', 'sender_id': 'chat_*'},
+            {'action': 'resume', 'sender_id': '155', 'last_id': 1},
+            {'action': 'subscribe', 'sender_id': '155'},
+            {'action': 'subscribe', 'sender_id': '166'},
+        ):
+            await communicator.send_json_to(action)
+        for _ in range(3):
+            errors.append((await communicator.receive_json_from())['error'])
+        await communicator.disconnect()
+
+        self.assertEqual(errors, ['invalid sender_id', 'not subscribed', 'too many subscriptions'])
+
+    async def subscribed_socket(self):
+        communicator = websocket('/ws/inbox/')
+        await communicator.connect()
+        await communicator.send_json_to({'action': 'subscribe', 'sender_id': '155', 'last_id': 0})
+        await communicator.receive_json_from()  # resumed
+        return communicator
+
+    async def inbox_event(self, *sender_ids):
+        await get_channel_layer().group_send(INBOX_GROUP, {
+            'type': 'inbox_update', 'conversations': [{'sender_id': sender_id} for sender_id in sender_ids], 'deleted': [],
+        })
+
+    @override_settings(WS_COALESCE_WINDOW_MS=200)
+    async def test_burst_is_coalesced_into_one_batch(self):
+        communicator = await self.subscribed_socket()
+
+        await self.chat_event('155', 1)
+        first = await communicator.receive_json_from()
+        await self.chat_event('155', 2)
+        await self.inbox_event('155')
+        await self.chat_event('155', 3)
+        await self.inbox_event('166')
+        batch = await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        self.assertEqual(first['id'], 1)  # first event after a quiet period goes out right away
+        self.assertEqual(batch['type'], 'batch')
+        self.assertEqual([frame.get('id') for frame in batch['frames']], [2, None, 3])
+        self.assertEqual(batch['frames'][1]['conversations'], [{'sender_id': '155'}, {'sender_id': '166'}])
+
+    @override_settings(WS_COALESCE_WINDOW_MS=200, WS_SEND_BUFFER_FRAMES=3)
+    async def test_client_too_far_behind_is_told_to_resync(self):
+        communicator = await self.subscribed_socket()
+
+        await self.chat_event('155', 1)
+        await communicator.receive_json_from()
+        for message_id in range(2, 8):
+            await self.chat_event('155', message_id)
+        await self.inbox_event('155')
+        batch = await communicator.receive_json_from()
+        nothing_else = await communicator.receive_nothing(timeout=0.3)
+        await communicator.disconnect()
+
+        self.assertEqual(batch, {'type': 'batch', 'frames': [
+            {'type': 'resync_required', 'sender_id': '155'},
+            {'type': 'inbox', 'conversations': [{'sender_id': '155'}], 'deleted': []},
+        ]})
+        self.assertTrue(nothing_else)
+
+
+class SearchTests(TestCase):
+    def message(self, sender_id, text):
+        chat_message = ChatMessage.objects.create(sender_id=sender_id, is_from_user=True, message_text=text)
+        record_message(chat_message)
+        return chat_message
+
+    def setUp(self):
+        self.message('15550001111', 'Your invoice is attached')
+        self.message('15550001111', 'second invoice, overdue')
+        self.message('15550002222', 'no match here')
+        self.message('15550003333', 'the invoice was paid')
+
+    def senders(self, query):
+        return [result['sender_id'] for result in search.search_conversations(query)]
+
+    def test_prefix_match_one_result_per_contact(self):
+        results = search.search_conversations('invo')
+
+        self.assertEqual(sorted(r['sender_id'] for r in results), ['15550001111', '15550003333'])
+        if connection.vendor in ('postgresql', 'sqlite'):
+            self.assertTrue(all('[invoice]' in r['snippet'] for r in results), results)
+
+    def test_all_tokens_must_match(self):
+        self.assertEqual(self.senders('invoice overdue'), ['15550001111'])
+
+    def test_number_matches_come_first(self):
+        self.assertEqual(self.senders('3333'), ['15550003333'])
+
+    @skipUnless(connection.vendor in ('postgresql', 'sqlite'), 'full-text search backends only')
+    @override_settings(SEARCH_CANDIDATE_LIMIT=1)
+    def test_only_the_newest_matches_are_ranked(self):
+        self.assertEqual(self.senders('invoice'), ['15550003333'])
+
+    def test_fallback_scan(self):
+        with mock.patch('sender_app.search._has_fts5_table', return_value=False):
+            results = search._search_messages('INVOICE', ['invoice'], 10)
+
+        self.assertEqual([r['sender_id'] for r in results], ['15550003333', '15550001111'])
+
+
+class ParseRangeTests(TestCase):
+    def test_ranges(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=900-5000', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-5000', 1000), (0, 999))
+        self.assertEqual(parse_range('bytes=1000-', 1000), 'unsatisfiable')
+        self.assertEqual(parse_range('bytes=-0', 1000), 'unsatisfiable')
+        self.assertEqual(parse_range('bytes=5-4', 1000), 'unsatisfiable')
+        self.assertIsNone(parse_range('bytes=0-1,5-6', 1000))
+        self.assertIsNone(parse_range('bytes=-', 1000))
+        self.assertIsNone(parse_range('items=0-1', 1000))
+
+
+class MediaRangeRequestTests(TestCase):
+    body = bytes(range(256)) * 4  # 1024 bytes
+    path = 'image/0f8fad5b-d9cb-469f-a165-70867728950e.jpg'
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root, MEDIA_SERVE_MODE='python')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        os.makedirs(os.path.join(media_root, 'image'))
+        with open(os.path.join(media_root, self.path), 'wb') as f:
+            f.write(self.body)
+        self.url = reverse('serve_media', args=[self.path])
+
+    def get(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, content
+
+    def test_single_range(self):
+        response, content = self.get(range='bytes=10-19')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(content, self.body[10:20])
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/1024')
+        self.assertEqual(response['Content-Length'], '10')
+
+    def test_suffix_range(self):
+        response, content = self.get(range='bytes=-100')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(content, self.body[-100:])
+        self.assertEqual(response['Content-Range'], 'bytes 924-1023/1024')
+
+    def test_suffix_longer_than_file_is_whole_file(self):
+        response, content = self.get(range='bytes=-5000')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(content, self.body)
+        self.assertEqual(response['Content-Range'], 'bytes 0-1023/1024')
+
+    def test_unsatisfiable_range(self):
+        for header in ('bytes=1024-', 'bytes=-0'):
+            with self.subTest(range=header):
+                response, content = self.get(range=header)
+                self.assertEqual(response.status_code, 416)
+                self.assertEqual(response['Content-Range'], 'bytes */1024')
+                self.assertEqual(content, b'')
+
+    def test_multi_range_falls_back_to_whole_file(self):
+        response, content = self.get(range='bytes=0-1,5-6')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(content, self.body)
+
+    def test_if_range(self):
+        etag = self.get()[0]['ETag']
+
+        response, content = self.get(range='bytes=0-9', if_range=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(content, self.body[:10])
+
+        # the client's copy is stale: send the whole (current) file
+        response, content = self.get(range='bytes=0-9', if_range='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(content, self.body)
+        response, content = self.get(range='bytes=0-9', if_range='Thu, 01 Jan 1970 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+
+    def test_conditional_get(self):
+        etag = self.get()[0]['ETag']
+
+        response, content = self.get(if_none_match=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(content, b'')
+        self.assertEqual(response['ETag'], etag)
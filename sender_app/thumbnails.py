@@ -0,0 +1,121 @@
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .models import ChatMessage
+from .recent import update_message
+
+try:
+    from PIL import Image, ImageOps, features as pil_features
+except ImportError:  # Pillow is optional: without it the history just serves originals
+    Image = None
+
+meta_api_logger = logging.getLogger('meta_api_logger')
+
+# --- Image thumbnails ---
+# After an incoming image is stored, a small preview is rendered on a
+# background pool (THUMBNAIL_WORKERS) and saved on the message as
+# thumbnail_url; the chat history shows it and loads the original on click.
+# Thumbnails are named after the original file, so a deduplicated blob
+# (sender_app.media) gets one thumbnail no matter how many messages use it.
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def thumbnails_enabled():
+    return Image is not None and settings.THUMBNAIL_MAX_SIZE > 0
+
+
+def get_thumbnail_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS, thread_name_prefix='thumbnail')
+        return _executor
+
+
+def thumbnail_format():
+    if settings.THUMBNAIL_FORMAT == 'webp' and pil_features.check('webp'):
+        return 'webp'
+    return 'jpeg'
+
+
+def thumbnail_path_for(media_url):
+    """(web_path, full_path) of the thumbnail for a /media/ url: MEDIA_ROOT/thumbs/<ab>/<name>_<size>.<ext>."""
+    stem = os.path.splitext(os.path.basename(media_url))[0]
+    ext = 'webp' if thumbnail_format() == 'webp' else 'jpg'
+    relative = f"thumbs/{stem[:2]}/{stem}_{settings.THUMBNAIL_MAX_SIZE}.{ext}"
+    return f"/media/{relative}", os.path.join(settings.MEDIA_ROOT, relative)
+
+
+def render_thumbnail(source_path, target_path):
+    """Write a thumbnail of source_path to target_path (atomically). Returns False if the image can't be read."""
+    size = settings.THUMBNAIL_MAX_SIZE
+    try:
+        with Image.open(source_path) as image:
+            image.draft('RGB', (size, size))  # JPEG: decode at reduced scale
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size))
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+            fmt = thumbnail_format()
+            if fmt == 'jpeg' and image.mode == 'RGBA':
+                image = image.convert('RGB')
+
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target_path), suffix='.part')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    image.save(f, format=fmt.upper(), quality=settings.THUMBNAIL_QUALITY)
+                os.replace(tmp_path, target_path)
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+        return True
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        meta_api_logger.warning(f"Could not create thumbnail for {source_path}: {e}")
+        return False
+
+
+def create_thumbnail(message_id, media_url, sender_id=None):
+    """Render (or reuse) the thumbnail for one image message and store its url on the row."""
+    try:
+        source_path = os.path.join(settings.MEDIA_ROOT, media_url[len('/media/'):])
+        web_path, full_path = thumbnail_path_for(media_url)
+        if not os.path.exists(full_path) and not render_thumbnail(source_path, full_path):
+            return None
+        ChatMessage.objects.filter(pk=message_id).update(thumbnail_url=web_path)
+        if sender_id:
+            update_message(sender_id, message_id, thumbnail_url=web_path)
+        return web_path
+    except Exception as e:
+        meta_api_logger.exception(f"Thumbnail job failed for message {message_id}: {e}")
+        return None
+
+
+def _thumbnail_job(message_id, media_url, sender_id):
+    close_old_connections()
+    try:
+        return create_thumbnail(message_id, media_url, sender_id)
+    finally:
+        close_old_connections()
+
+
+def schedule_thumbnails(messages):
+    """Queue thumbnail jobs for the stored image messages in `messages`; returns the Futures."""
+    if not thumbnails_enabled():
+        return []
+    futures = []
+    for message in messages:
+        if message.pk and message.message_type == 'image' and (message.media_url or '').startswith('/media/'):
+            futures.append(get_thumbnail_executor().submit(_thumbnail_job, message.pk, message.media_url, message.sender_id))
+    return futures
@@ -16,15 +16,24 @@ urlpatterns = [
     path('api/chat/<str:phone_number>/', views.get_chat_history_json, name='get_chat_history'),
     path('api/start_chat/', views.start_new_chat_view, name='start_new_chat'),
     path('api/search_chats/', views.search_chats_json, name='search_chats'),
+    path('api/inbox/', views.inbox_json, name='inbox'),
+    path('api/conversation/<str:phone_number>/', views.conversation_json, name='conversation'),
+    path('api/cache_stats/', views.cache_stats_json, name='cache_stats'),
+    path('api/campaigns/', views.campaigns_json, name='campaigns'),
+    path('api/campaigns/<int:campaign_id>/', views.campaign_json, name='campaign'),
     
     # --- ADD THIS NEW LINE FOR DELETING CHATS ---
     path('api/delete_chat/<str:phone_number>/', views.delete_chat_view, name='delete_chat'),
+    path('api/deletions/<int:job_id>/', views.deletion_status_json, name='deletion_status'),
 
     # --- Webhook for Meta ---
     path('webhook', views.webhook_view, name='webhook'),
+    path('api/webhook_queue/', views.webhook_queue_status_view, name='webhook_queue_status'),
     path('media/<path:path>', views.serve_media, name='serve_media'),
     # --- Health Check for Render ---
     path('health/', views.health_check_view, name='health_check'),
+    # --- Prometheus metrics ---
+    path('metrics', views.metrics_view, name='metrics'),
 ]
 
 if settings.DEBUG:
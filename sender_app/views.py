@@ -3,131 +3,59 @@ import os
 import requests
 import random
 import logging
+import time
 from django.conf import settings
 from django.shortcuts import render, redirect
 from django.urls import reverse
 from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.db import IntegrityError, transaction
+from django.utils.crypto import constant_time_compare
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
-from .models import ChatMessage
-from django.db.models import Max, Q
-from uuid import uuid4
-import mimetypes
-from django.http import FileResponse, Http404
+from .models import Campaign, ChatDeletion, ChatMessage
+from .campaigns import campaign_progress, create_campaign, parse_numbers, set_campaign_status
+from .archive import archived_messages_after, archived_messages_before
+from .caching import cache_stats
+from .capture import capture_enabled, capture_webhook
+from .conversations import cached_conversation, cached_inbox_page, mark_read, record_message, record_messages
+from .dedup import DuplicateInFlight, recent_ids
+from .deletion import deletion_status, request_deletion
+from .graph_api import get_client
+from .outbound import send_template_message
+from .ingest import enqueue_webhook, queue_depth
+from .recent import prime as prime_recent, recent_page
+from .search import search_conversations
+from .thumbnails import schedule_thumbnails
+from .logs import LazyJson, truncate_text
+from . import metrics
+from .media import fetch_incoming_media, media_response, release_media, submit_download
 
 meta_api_logger = logging.getLogger('meta_api_logger')
 
-# --- NEW HELPER: Downloads and saves media from WhatsApp ---
-def process_whatsapp_media(media_id):
-    """
-    Download media from WhatsApp/Meta, save into MEDIA_ROOT/<type>/<uuid>.<ext>
-    Return a web-accessible path: /media/<type>/<filename> and the file type (image|audio).
-    """
-    access_token = os.environ.get('WHATSAPP_ACCESS_TOKEN')
-    version = os.environ.get('WHATSAPP_API_VERSION', 'v20.0')
-
-    url_get_media = f"https://graph.facebook.com/{version}/{media_id}"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    try:
-        response_get_url = requests.get(url_get_media, headers=headers, timeout=15)
-        if response_get_url.status_code != 200:
-            meta_api_logger.error(f"Failed to get media metadata for ID {media_id}. Response: {response_get_url.text}")
-            return None, None
-
-        media_data = response_get_url.json()
-        download_url = media_data.get('url') or media_data.get('uri')  # sometimes named differently
-        mime_type = media_data.get('mime_type') or media_data.get('mimetype')
-        if not download_url:
-            meta_api_logger.error(f"No download URL in media data for ID {media_id}: {media_data}")
-            return None, None
-
-        # download the actual file (use same auth header)
-        response_download = requests.get(download_url, headers=headers, timeout=20)
-        if response_download.status_code != 200:
-            meta_api_logger.error(f"Failed to download media from {download_url}. Status: {response_download.status_code}")
-            return None, None
-
-        # determine extension and type
-        if not mime_type:
-            mime_type = response_download.headers.get('Content-Type', '')
-
-        file_extension = 'bin'
-        if mime_type:
-            guessed_ext = mimetypes.guess_extension(mime_type.split(';')[0].strip())
-            if guessed_ext:
-                file_extension = guessed_ext.lstrip('.')  # remove leading dot
-
-        file_type = (mime_type.split('/')[0] if mime_type else '').lower()
-        if file_type not in ['image', 'audio']:
-            # fallback: inspect extension from url
-            if any(download_url.lower().endswith(ext) for ext in ('.jpg','.jpeg','.png','.gif','.webp')):
-                file_type = 'image'
-            elif any(download_url.lower().endswith(ext) for ext in ('.mp3','.ogg','.amr','.wav','.m4a')):
-                file_type = 'audio'
-            else:
-                meta_api_logger.warning(f"Unsupported media type: {mime_type} for id {media_id}")
-                return None, None
-
-        # secure filename
-        file_name = f"{uuid4()}.{file_extension}"
-        # save into MEDIA_ROOT/<file_type>/<file_name>
-        media_dir = os.path.join(settings.MEDIA_ROOT, file_type)
-        os.makedirs(media_dir, exist_ok=True)
-        file_full_path = os.path.join(media_dir, file_name)
-        with open(file_full_path, 'wb') as f:
-            f.write(response_download.content)
-
-        # log the real disk path + public path
-        web_path = f"/media/{file_type}/{file_name}"
-        meta_api_logger.info(f"Saved media for {media_id} to {file_full_path} -> {web_path}")
-        return web_path, file_type
-
-
-    except requests.exceptions.RequestException as e:
-        meta_api_logger.error(f"Network error while processing media ID {media_id}: {e}")
-        return None, None
-    except Exception as e:
-        meta_api_logger.error(f"Unexpected error saving media ID {media_id}: {e}")
-        return None, None
-    
-
-
 def serve_media(request, path):
     """
     Serve files from MEDIA_ROOT for /media/<path> requests.
     Temporary solution for Render until you move to object storage.
+    ETag/Last-Modified, 304s, byte ranges and X-Accel-Redirect/X-Sendfile: see media.media_response.
     """
-    full_path = os.path.join(settings.MEDIA_ROOT, path)
-    if not os.path.exists(full_path):
-        meta_api_logger.warning(f"Media file not found: {full_path}")
-        raise Http404("Media not found")
-    content_type, _ = mimetypes.guess_type(full_path)
-    try:
-        return FileResponse(open(full_path, 'rb'), content_type=content_type or 'application/octet-stream')
-    except Exception as e:
-        meta_api_logger.error(f"Error sending media file {full_path}: {e}")
-        raise Http404("Media read error")
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponse(status=405)
+    return media_response(request, path)
 
 
 # --- Your existing helper ---
 def send_otp_to_admin(code):
-    # This function is unchanged
     admin_number = settings.ADMIN_PHONE_NUMBER
     if not admin_number:
         meta_api_logger.critical("ADMIN_PHONE_NUMBER is not set in environment variables!")
         return False
-    access_token = os.environ.get('WHATSAPP_ACCESS_TOKEN')
-    phone_number_id = os.environ.get('WHATSAPP_PHONE_NUMBER_ID')
-    version = os.environ.get('WHATSAPP_API_VERSION', 'v20.0')
-    url = f"https://graph.facebook.com/{version}/{phone_number_id}/messages"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
     message_body = f"Your login verification code is: {code}"
     payload = {"messaging_product": "whatsapp", "to": admin_number, "type": "text", "text": {"body": message_body}}
     meta_api_logger.info(f"Sending OTP to ADMIN. Payload: {json.dumps(payload)}")
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=15)
-        meta_api_logger.info(f"OTP Send Response to ADMIN: Status {response.status_code}, Body: {response.text}")
+        response = get_client().send_message(payload, timeout=15)
+        meta_api_logger.info(f"OTP Send Response to ADMIN: Status {response.status_code} ({response.graph_elapsed_ms}ms), Body: {response.text}")
         return response.status_code == 200
     except requests.exceptions.RequestException as e:
         meta_api_logger.error(f"OTP Send Request failed for ADMIN: {e}")
@@ -176,60 +104,105 @@ def custom_login_required(view_func):
 # --- Main Application Views (chat_history UPGRADED) ---
 @custom_login_required
 def chat_interface_view(request):
-    contacts = ChatMessage.objects.values('sender_id').annotate(
-        latest_message=Max('timestamp')
-    ).order_by('-latest_message').values_list('sender_id', flat=True)
-    return render(request, 'sender_app/chat_interface.html', {'contacts': contacts})
+    conversations, next_cursor = cached_inbox_page(settings.INBOX_PAGE_SIZE)
+    contacts = [conversation['sender_id'] for conversation in conversations]
+    return render(request, 'sender_app/chat_interface.html', {'contacts': contacts, 'inbox_next_cursor': next_cursor or ''})
 
 @custom_login_required
 def get_chat_history_json(request, phone_number):
-    messages = ChatMessage.objects.filter(sender_id=phone_number).order_by('timestamp')
-    # UPGRADED: Now returns media_url as well for displaying old media
-    message_list = list(messages.values('message_text', 'media_url', 'is_from_user'))
-    return JsonResponse({'messages': message_list})
+    """
+    Latest `limit` messages, oldest first. Page with the ids of the returned messages:
+      ?before=<id>  older messages (scrolling up)
+      ?after=<id>   newer messages (catching up)
+    """
+    try:
+        limit = max(1, min(int(request.GET.get('limit', settings.CHAT_HISTORY_PAGE_SIZE)), 200))
+        before = int(request.GET['before']) if request.GET.get('before') else None
+        after = int(request.GET['after']) if request.GET.get('after') else None
+    except ValueError:
+        return JsonResponse({'error': 'limit, before and after must be integers.'}, status=400)
+
+    if after is None and before is None:
+        conversation = cached_conversation(phone_number)
+        if conversation and conversation['unread_count']:
+            mark_read(phone_number)
+
+    # Active chats: answered from the recent-messages buffer (sender_app.recent) without a query
+    cached = recent_page(phone_number, limit, before, after)
+    if cached is not None:
+        message_list, has_more = cached
+        return JsonResponse({
+            'messages': message_list,
+            'has_more': has_more,
+            'before': message_list[0]['id'] if message_list else before,
+            'after': message_list[-1]['id'] if message_list else after,
+        })
+
+    messages = ChatMessage.objects.filter(sender_id=phone_number)
+    # UPGRADED: Now returns media_url as well for displaying old media (and thumbnail_url for images)
+    fields = ('id', 'timestamp', 'message_type', 'message_text', 'media_url', 'thumbnail_url', 'is_from_user')
+    # Archived messages (sender_app.archive) all have lower ids than the live ones,
+    # so a page that runs past either end of the table continues in the archive.
+    if after is not None:
+        page = archived_messages_after(phone_number, after, limit + 1)
+        page += list(messages.filter(id__gt=after).order_by('id').values(*fields)[:limit + 1 - len(page)])
+        has_more = len(page) > limit
+        message_list = page[:limit]
+    else:
+        if before is not None:
+            messages = messages.filter(id__lt=before)
+        page = list(messages.order_by('-id').values(*fields)[:limit + 1])
+        if len(page) <= limit:
+            page += archived_messages_before(phone_number, page[-1]['id'] if page else before, limit + 1 - len(page))
+        has_more = len(page) > limit
+        message_list = page[:limit][::-1]
+        if before is None:
+            # the latest page is the tail of the conversation: start its buffer with it
+            prime_recent(phone_number, message_list, has_more)
+
+    return JsonResponse({
+        'messages': message_list,
+        'has_more': has_more,
+        'before': message_list[0]['id'] if message_list else before,
+        'after': message_list[-1]['id'] if message_list else after,
+    })
 
 @custom_login_required
 def search_chats_json(request):
     query = request.GET.get('q', '')
     if not query:
-        contacts = ChatMessage.objects.values('sender_id').annotate(
-            latest_message=Max('timestamp')
-        ).order_by('-latest_message').values_list('sender_id', flat=True)
-    else:
-        matching_contacts = ChatMessage.objects.filter(
-            Q(message_text__icontains=query) | Q(sender_id__icontains=query)
-        ).values('sender_id').annotate(
-            latest_message=Max('timestamp')
-        ).order_by('-latest_message').values_list('sender_id', flat=True)
-        contacts = list(matching_contacts)
-    return JsonResponse({'contacts': contacts})
+        conversations, next_cursor = cached_inbox_page(settings.INBOX_PAGE_SIZE)
+        contacts = [conversation['sender_id'] for conversation in conversations]
+        return JsonResponse({'contacts': contacts, 'next_cursor': next_cursor})
+    results = search_conversations(query, limit=settings.SEARCH_RESULTS_LIMIT)
+    return JsonResponse({'contacts': [r['sender_id'] for r in results], 'results': results})
 
 
-# --- send_template_message (UPGRADED for number validation) ---
-def send_template_message(phone_number, template_name):
-    access_token = os.environ.get('WHATSAPP_ACCESS_TOKEN')
-    phone_number_id = os.environ.get('WHATSAPP_PHONE_NUMBER_ID')
-    version = os.environ.get('WHATSAPP_API_VERSION', 'v20.0')
-    url = f"https://graph.facebook.com/{version}/{phone_number_id}/messages"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    payload = {"messaging_product": "whatsapp", "to": phone_number, "type": "template", "template": {"name": template_name, "language": {"code": "ru_RU"}}}
-    meta_api_logger.info(f"Starting new chat with {phone_number}. Payload: {json.dumps(payload)}")
+@custom_login_required
+def inbox_json(request):
+    """Keyset-paginated contact list: ?limit=<n>&cursor=<next_cursor from the previous page>."""
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=15)
-        response_data = response.json()
-        meta_api_logger.info(f"Start Chat Response: Status {response.status_code}, Body: {response.text}")
-        if response.status_code == 200:
-            return {'success': True, 'data': response_data}
-        else:
-            error_message = response_data.get('error', {}).get('message', 'An unknown error occurred.')
-            error_details = response_data.get('error', {}).get('error_data', {}).get('details', '')
-            if "not a valid WhatsApp user" in error_message or "Recipient phone number not in allowed list" in error_message or "does not exist" in error_details:
-                return {'success': False, 'error': 'This phone number is not a valid WhatsApp user.'}
-            return {'success': False, 'error': error_message}
-    except requests.exceptions.RequestException as e:
-        meta_api_logger.error(f"Start Chat Request failed: {e}")
-        return {'success': False, 'error': 'A network error occurred.'}
+        limit = min(int(request.GET.get('limit', settings.INBOX_PAGE_SIZE)), 200)
+        conversations, next_cursor = cached_inbox_page(max(limit, 1), request.GET.get('cursor') or None)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'conversations': conversations, 'next_cursor': next_cursor})
 
+
+@custom_login_required
+def conversation_json(request, phone_number):
+    conversation = cached_conversation(phone_number)
+    if conversation is None:
+        return JsonResponse({'error': 'No chat history found for this number.'}, status=404)
+    return JsonResponse({'conversation': conversation})
+
+
+@custom_login_required
+def cache_stats_json(request):
+    return JsonResponse({'cache': cache_stats()})
+
+
+# --- send_template_message (UPGRADED for number validation) ---
 @custom_login_required
 def start_new_chat_view(request):
     if request.method == 'POST':
@@ -240,98 +213,320 @@ def start_new_chat_view(request):
             return JsonResponse({'success': False, 'error': 'Phone number and template name are required.'}, status=400)
         result = send_template_message(phone_number, template_name)
         if result['success']:
-            ChatMessage.objects.create(
+            chat_message = ChatMessage.objects.create(
                 sender_id=phone_number,
                 message_text=f"Started chat with template: '{template_name}'",
                 is_from_user=False
             )
+            record_message(chat_message)
             return JsonResponse({'success': True, 'phone_number': phone_number})
         else:
             return JsonResponse({'success': False, 'error': result['error']}, status=400)
     return JsonResponse({'error': 'Invalid request method'}, status=405)
 
-# --- Webhook (UPGRADED for media) ---
+# --- Template campaigns (sent by `manage.py run_campaigns`) ---
 
-@csrf_exempt
-def webhook_view(request):
-    if request.method == "POST":
+@custom_login_required
+def campaigns_json(request):
+    """
+    GET: progress of the latest campaigns.
+    POST: create one. JSON {name, template_name, language_code?, numbers: [...] or "one per line"},
+    or a form with the same fields and the numbers as an uploaded file `numbers_file` (one per line / CSV).
+    """
+    if request.method == 'GET':
+        campaigns = Campaign.objects.order_by('-id')[:50]
+        return JsonResponse({'campaigns': [campaign_progress(c) for c in campaigns]})
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+    if request.content_type == 'application/json':
         try:
             data = json.loads(request.body)
-        except Exception as e:
-            meta_api_logger.error(f"Webhook payload JSON parse error: {e} - raw: {request.body}")
-            return HttpResponse(status=400)
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'Invalid JSON.'}, status=400)
+        raw_numbers = data.get('numbers') or ''
+        if isinstance(raw_numbers, list):
+            raw_numbers = '\n'.join(str(n) for n in raw_numbers)
+    else:
+        data = request.POST
+        upload = request.FILES.get('numbers_file')
+        raw_numbers = upload.read().decode('utf-8', errors='replace') if upload else data.get('numbers', '')
+
+    name = (data.get('name') or '').strip()
+    template_name = (data.get('template_name') or '').strip()
+    language_code = (data.get('language_code') or 'ru_RU').strip()
+    if not name or not template_name:
+        return JsonResponse({'success': False, 'error': 'Campaign name and template name are required.'}, status=400)
+    numbers, invalid = parse_numbers(raw_numbers)
+    if not numbers:
+        return JsonResponse({'success': False, 'error': 'No valid phone numbers found.', 'invalid': invalid[:100]}, status=400)
+    if len(numbers) > settings.CAMPAIGN_MAX_RECIPIENTS:
+        return JsonResponse({'success': False, 'error': f'At most {settings.CAMPAIGN_MAX_RECIPIENTS} numbers per campaign.'}, status=400)
+
+    campaign = create_campaign(name, template_name, numbers, language_code)
+    return JsonResponse({'success': True, 'campaign': campaign_progress(campaign), 'invalid': invalid[:100], 'invalid_count': len(invalid)}, status=201)
 
-        meta_api_logger.info(f"Webhook received: {json.dumps(data)[:8000]}")  # avoid logging giant payloads fully
 
+@custom_login_required
+def campaign_json(request, campaign_id):
+    """GET: progress and throughput. POST {"action": "pause" | "resume"}."""
+    try:
+        campaign = Campaign.objects.get(pk=campaign_id)
+    except Campaign.DoesNotExist:
+        return JsonResponse({'error': 'Campaign not found.'}, status=404)
+    if request.method == 'POST':
         try:
-            entries = data.get('entry', [])
-            for entry in entries:
-                changes = entry.get('changes', [])
-                for change in changes:
-                    value = change.get('value', {})
-                    messages = value.get('messages') or []
-                    for message_data in messages:
-                        sender_id = message_data.get('from')
-                        message_type = message_data.get('type')
-                        content_for_broadcast = None
-
-                        if message_type == 'text':
-                            message_text = message_data.get('text', {}).get('body')
-                            if message_text:
-                                ChatMessage.objects.create(sender_id=sender_id, message_text=message_text, is_from_user=True, message_type='text')
-                                content_for_broadcast = message_text
-
-                        elif message_type in ['image', 'audio', 'video', 'document']:
-                            # prefer the webhook-provided url if available (some webhooks include it)
-                            media_obj = message_data.get(message_type, {})
-                            media_id = media_obj.get('id')
-                            webhook_url = media_obj.get('url') or media_obj.get('link')
-                            meta_api_logger.info(f"Incoming media: type={message_type} id={media_id} url={webhook_url}")
-
-                            web_path = None
-                            media_type_str = 'image' if message_type == 'image' else 'audio' if message_type == 'audio' else message_type
-
-                            # If webhook already included a ready-to-download url, try that first
-                            if webhook_url:
-                                try:
-                                    r = requests.get(webhook_url, timeout=20)
-                                    if r.status_code == 200:
-                                        # determine extension from headers or url
-                                        content_type = r.headers.get('Content-Type', '')
-                                        ext = content_type.split('/')[-1].split(';')[0] or 'bin'
-                                        file_name = f"{uuid4()}.{ext}"
-                                        media_dir = os.path.join(settings.MEDIA_ROOT, media_type_str)
-                                        os.makedirs(media_dir, exist_ok=True)
-                                        file_full_path = os.path.join(media_dir, file_name)
-                                        with open(file_full_path, 'wb') as f:
-                                            f.write(r.content)
-                                        web_path = f"/media/{media_type_str}/{file_name}"
-                                        meta_api_logger.info(f"Saved webhook-provided media to {file_full_path} -> {web_path}")
-                                except Exception as e:
-                                    meta_api_logger.warning(f"Failed to download webhook url {webhook_url}: {e}")
-
-                            # fallback to the media-id flow (Graph API /{media-id})
-                            if not web_path and media_id:
-                                web_path, mt = process_whatsapp_media(media_id)
-                                media_type_str = mt or media_type_str
-
-                            if web_path:
-                                ChatMessage.objects.create(sender_id=sender_id, media_url=web_path, is_from_user=True, message_type=media_type_str)
-                                content_for_broadcast = web_path
-                            else:
-                                meta_api_logger.error(f"Could not obtain media for id {media_id} from webhook for sender {sender_id}")
-
-                        # Broadcast if we have content
-                        if content_for_broadcast:
-                            channel_layer = get_channel_layer()
-                            async_to_sync(channel_layer.group_send)(
-                                f'chat_{sender_id}',
-                                {'type': 'chat_message', 'message': content_for_broadcast, 'is_from_user': True, 'sender_id': sender_id}
-                            )
+            action = json.loads(request.body).get('action')
+        except ValueError:
+            action = None
+        if action not in ('pause', 'resume'):
+            return JsonResponse({'error': 'action must be "pause" or "resume".'}, status=400)
+        campaign = set_campaign_status(campaign, Campaign.STATUS_PAUSED if action == 'pause' else Campaign.STATUS_RUNNING)
+    elif request.method != 'GET':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    return JsonResponse({'campaign': campaign_progress(campaign)})
+
+# --- Webhook (UPGRADED for media) ---
+
+def _save_incoming(chat_messages):
+    """
+    Insert one payload's messages in a single transaction: one bulk INSERT,
+    then one Conversation update per sender. If a wamid collides (a redelivery
+    raced us between the lookup and the insert) the batch is retried row by
+    row, each in its own savepoint, so the rest still lands. Returns the saved rows.
+    """
+    try:
+        with transaction.atomic():
+            saved = ChatMessage.objects.bulk_create(chat_messages)
+            record_messages(saved)
+            return saved
+    except IntegrityError:
+        meta_api_logger.info(f"Duplicate wamid in a batch of {len(chat_messages)} webhook messages, inserting one by one")
+
+    with transaction.atomic():
+        saved = []
+        for chat_message in chat_messages:
+            chat_message.pk = None
+            chat_message._state.adding = True
+            try:
+                with transaction.atomic():
+                    chat_message.save(force_insert=True)
+                saved.append(chat_message)
+            except IntegrityError:
+                meta_api_logger.info(f"Duplicate webhook message {chat_message.wamid} already stored, skipping")
+        record_messages(saved)
+    return saved
+
+
+def _release_download(future):
+    """Done-callback for a media download no message was built from: drop the blob reference it took."""
+    try:
+        web_path, _ = future.result()
+    except Exception:
+        return
+    if web_path:
+        release_media([web_path])
+
+
+@metrics.webhook_processing_seconds.time()
+def process_webhook_payload(data):
+    """
+    Persist + broadcast every message in a parsed webhook payload.
+    Called inline by webhook_view, or by `manage.py process_webhooks` in queue mode.
+    Exceptions propagate so the queue worker can retry the event.
+
+    Redelivered messages (same wamid) are dropped before any download or insert:
+    first by the in-process recent-id set, then by one lookup on the wamid index.
+    If another worker is still processing one of the wamids, nothing is done and
+    DuplicateInFlight is raised, so the delivery is retried instead of dropped.
+    Media items are downloaded concurrently on the shared media pool, then the
+    whole payload is written in one transaction (_save_incoming) and fanned out
+    with one group_send per sender, in payload order. Each download took a blob
+    reference; the ones whose row was skipped as a duplicate, or never written
+    because of an exception, are released again.
+    """
+    recent = recent_ids()
+    incoming = []
+    in_flight = []
+    seen = set()  # wamids earlier in this payload: a repeat is a duplicate, not another worker's
+    unclaimed_media = []  # downloaded media urls not (yet) referenced by a stored row
+    pending = []  # (message_data, media Future or None)
+    collected = set()  # futures whose result was taken (and tracked in unclaimed_media)
+    entries = data.get('entry', [])
+    for entry in entries:
+        changes = entry.get('changes', [])
+        for change in changes:
+            value = change.get('value', {})
+            messages = value.get('messages') or []
+            for message_data in messages:
+                wamid = message_data.get('id')
+                if wamid in seen:
+                    meta_api_logger.info(f"Dropping webhook message {wamid} repeated within one payload")
+                    metrics.webhook_duplicates.inc()
+                    continue
+                if wamid:
+                    seen.add(wamid)
+                if wamid and not recent.reserve(wamid):
+                    if recent.in_flight(wamid):
+                        in_flight.append(wamid)
+                        continue
+                    meta_api_logger.info(f"Dropping duplicate webhook message {wamid}")
+                    metrics.webhook_duplicates.inc()
+                    continue
+                incoming.append(message_data)
+
+    reserved = [m['id'] for m in incoming if m.get('id')]
+    if in_flight:
+        for wamid in reserved:
+            recent.release(wamid)
+        raise DuplicateInFlight(in_flight)
+    try:
+        if reserved:
+            # redeliveries this process hasn't seen (restart, other worker)
+            stored = set(ChatMessage.objects.filter(wamid__in=reserved).values_list('wamid', flat=True))
+            for wamid in stored:
+                recent.commit(wamid)
+            if stored:
+                meta_api_logger.info(f"Dropping {len(stored)} already stored webhook messages")
+                metrics.webhook_duplicates.inc(len(stored))
+                incoming = [m for m in incoming if m.get('id') not in stored]
+
+        for message_data in incoming:
+            message_type = message_data.get('type')
+            future = None
+            if message_type in ['image', 'audio', 'video', 'document']:
+                # prefer the webhook-provided url if available (some webhooks include it)
+                media_obj = message_data.get(message_type, {})
+                media_id = media_obj.get('id')
+                webhook_url = media_obj.get('url') or media_obj.get('link')
+                meta_api_logger.info(f"Incoming media: type={message_type} id={media_id} url={webhook_url}")
+                future = submit_download(fetch_incoming_media, message_type, media_id, webhook_url)
+            pending.append((message_data, future))
+
+        chat_messages = []
+        broadcasts = {}  # sender_id -> [(ChatMessage, content)], insertion ordered
+        for message_data, future in pending:
+            wamid = message_data.get('id')
+            sender_id = message_data.get('from')
+            message_type = message_data.get('type')
+            chat_message = None
+            content_for_broadcast = None
+
+            if message_type == 'text':
+                message_text = message_data.get('text', {}).get('body')
+                if message_text:
+                    chat_message = ChatMessage(sender_id=sender_id, message_text=message_text, is_from_user=True, message_type='text', wamid=wamid)
+                    content_for_broadcast = message_text
+
+            elif future is not None:
+                web_path, media_type_str = future.result()
+                collected.add(future)
+                if web_path:
+                    unclaimed_media.append(web_path)
+                    chat_message = ChatMessage(sender_id=sender_id, media_url=web_path, is_from_user=True, message_type=media_type_str, wamid=wamid)
+                    content_for_broadcast = web_path
+                else:
+                    media_id = message_data.get(message_type, {}).get('id')
+                    meta_api_logger.error(f"Could not obtain media for id {media_id} from webhook for sender {sender_id}")
+
+            if chat_message is not None:
+                chat_messages.append(chat_message)
+                broadcasts.setdefault(sender_id, []).append((chat_message, content_for_broadcast))
+
+        if not chat_messages:
+            return
+        stored = _save_incoming(chat_messages)
+        saved = {m.wamid for m in stored}
+        # from here on the stored rows own their media references
+        unclaimed_media = [m.media_url for m in chat_messages if m.media_url and m.wamid is not None and m.wamid not in saved]
+        meta_api_logger.info(
+            f"Stored {len(stored)} webhook messages",
+            extra={'event': 'webhook_stored', 'count': len(stored), 'senders': list(broadcasts), 'wamids': [m.wamid for m in stored][:20]},
+        )
+        for chat_message in stored:
+            metrics.webhook_messages.inc(type=chat_message.message_type)
+        metrics.webhook_duplicates.inc(len(chat_messages) - len(stored))
+        schedule_thumbnails(stored)
+        for chat_message in chat_messages:
+            if chat_message.wamid:
+                # stored now, or stored by whoever beat us to it
+                recent.commit(chat_message.wamid)
+
+        # Broadcast: one channel layer round trip per sender, not per message
+        channel_layer = get_channel_layer()
+        for sender_id, events in broadcasts.items():
+            # the id lets reconnecting clients resume from the last message they saw
+            events = [
+                {'id': chat_message.pk, 'message': content, 'is_from_user': True, 'sender_id': sender_id}
+                for chat_message, content in events if chat_message.wamid is None or chat_message.wamid in saved
+            ]
+            if not events:
+                continue
+            event = {'type': 'chat_message', **events[0]} if len(events) == 1 else {'type': 'chat_message_batch', 'messages': events}
+            with metrics.group_send_seconds.time(source='webhook'):
+                async_to_sync(channel_layer.group_send)(f'chat_{sender_id}', event)
+    finally:
+        if unclaimed_media:
+            release_media(unclaimed_media)
+        for _, future in pending:
+            if future is not None and future not in collected:
+                # an exception came before this download was used: drop its reference once it finishes
+                future.add_done_callback(_release_download)
+        # anything not committed (failed download, exception) may be retried by a redelivery
+        for wamid in reserved:
+            recent.release(wamid)
+
+
+def _receive_webhook(request):
+    try:
+        data = json.loads(request.body)
+    except Exception as e:
+        meta_api_logger.error(
+            f"Webhook payload JSON parse error: {e} - raw: {truncate_text(request.body, settings.LOG_PAYLOAD_MAX_CHARS)}",
+            extra={'event': 'webhook_invalid', 'bytes': len(request.body)},
+        )
+        return HttpResponse(status=400)
+
+    # Queue mode: journal the raw body and ack right away, a worker does the rest
+    if settings.WEBHOOK_INGEST_MODE == 'queue':
+        try:
+            event = enqueue_webhook(request.body)
         except Exception as e:
-            meta_api_logger.exception(f"Unhandled exception processing webhook: {e} - Data: {json.dumps(data)[:8000]}")
+            # not persisted -> let Meta redeliver
+            meta_api_logger.exception(f"Failed to journal webhook: {e}")
+            return HttpResponse(status=500)
+        meta_api_logger.info(f"Webhook queued as event {event.pk} ({len(request.body)} bytes)", extra={'event': 'webhook_queued', 'event_id': event.pk, 'bytes': len(request.body)})
         return HttpResponse(status=200)
 
+    # LazyJson: serialized (and cut at LOG_PAYLOAD_MAX_CHARS) only if the record is kept
+    meta_api_logger.info("Webhook received: %s", LazyJson(data), extra={'event': 'webhook_received', 'bytes': len(request.body)})
+
+    started = time.monotonic()
+    try:
+        process_webhook_payload(data)
+    except DuplicateInFlight as e:
+        # not acked: if the attempt in progress fails, Meta's retry is the only copy left
+        meta_api_logger.info(f"Webhook deferred: {e}", extra={'event': 'webhook_deferred'})
+        return HttpResponse(status=503)
+    except Exception as e:
+        meta_api_logger.exception("Unhandled exception processing webhook: %s - Data: %s", e, LazyJson(data), extra={'event': 'webhook_failed'})
+    else:
+        latency_ms = round((time.monotonic() - started) * 1000, 1)
+        meta_api_logger.info(f"Webhook processed in {latency_ms}ms", extra={'event': 'webhook_processed', 'latency_ms': latency_ms, 'status': 200})
+    return HttpResponse(status=200)
+
+
+@csrf_exempt
+def webhook_view(request):
+    if request.method == "POST":
+        started = time.monotonic()
+        if capture_enabled():
+            capture_webhook(request.body)
+        response = _receive_webhook(request)
+        metrics.webhook_request_seconds.observe(time.monotonic() - started, mode=settings.WEBHOOK_INGEST_MODE)
+        metrics.webhook_requests.inc(status=response.status_code)
+        return response
+
     if request.method == "GET":
         verify_token = os.environ.get('WHATSAPP_WEBHOOK_VERIFY_TOKEN')
         if request.GET.get("hub.verify_token") == verify_token:
@@ -342,16 +537,47 @@ def webhook_view(request):
     return HttpResponse(status=405)
 
 
+@custom_login_required
+def webhook_queue_status_view(request):
+    return JsonResponse({'mode': settings.WEBHOOK_INGEST_MODE, 'queue': queue_depth()})
+
+
 @custom_login_required
 def delete_chat_view(request, phone_number):
+    """Queue a background deletion (sender_app.deletion) and answer 202; poll /api/deletions/<job_id>/ for progress."""
     if request.method == 'DELETE':
-        # Find all messages associated with the phone number and delete them
-        deleted_count, _ = ChatMessage.objects.filter(sender_id=phone_number).delete()
-        if deleted_count > 0:
-            return JsonResponse({'success': True, 'message': f'Chat history with {phone_number} deleted.'})
-        else:
+        job = request_deletion(phone_number)
+        if job is None:
             return JsonResponse({'success': False, 'error': 'No chat history found for this number.'}, status=404)
+        return JsonResponse({
+            'success': True,
+            'message': f'Chat history with {phone_number} is being deleted.',
+            'job': deletion_status(job),
+        }, status=202)
     return JsonResponse({'error': 'Invalid request method'}, status=405)
 
+
+@custom_login_required
+def deletion_status_json(request, job_id):
+    try:
+        job = ChatDeletion.objects.get(pk=job_id)
+    except ChatDeletion.DoesNotExist:
+        return JsonResponse({'error': 'Deletion job not found.'}, status=404)
+    return JsonResponse(deletion_status(job))
+
 def health_check_view(request):
     return JsonResponse({"status": "ok"})
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint. With METRICS_TOKEN set, send it as
+    `Authorization: Bearer <token>`; otherwise an operator session is required.
+    """
+    token = settings.METRICS_TOKEN
+    if token:
+        if not constant_time_compare(request.headers.get('Authorization', ''), f"Bearer {token}"):
+            return HttpResponse(status=401)
+    elif not request.session.get('is_authenticated'):
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -14,6 +14,7 @@ django.setup()
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 import sender_app.routing
+from sender_app.apps import start_background_workers
 
 # The rest of your ASGI configuration remains the same.
 application = ProtocolTypeRouter({
@@ -24,3 +25,6 @@ application = ProtocolTypeRouter({
         )
     ),
 })
+
+# In-process outbox dispatcher / chat deletion watch, when enabled in settings
+start_background_workers()
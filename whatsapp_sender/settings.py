@@ -133,6 +133,50 @@ CHANNEL_LAYERS = {
         },
     },
 }
+# --- CACHE (inbox list / conversation metadata, see sender_app/caching.py) ---
+# Local memory per process by default; set REDIS_URL so all workers share one cache
+# (and see each other's invalidations).
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ.get('REDIS_URL'),
+            "KEY_PREFIX": "whatsapp_sender",
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+# Upper bound on staleness if an invalidation is ever missed (seconds)
+INBOX_CACHE_TTL = int(os.environ.get('INBOX_CACHE_TTL', '300'))
+
+# --- RECENT MESSAGES (last N messages per active chat, see sender_app/recent.py) ---
+# 'redis': shared by all processes (REDIS_URL); 'off': always read the database;
+# 'memory': per process, opt-in, exact only while one web process is the only message writer
+# (no queue-mode webhook worker, no run_campaigns, no second web worker).
+RECENT_MESSAGES_BACKEND = os.environ.get('RECENT_MESSAGES_BACKEND', 'redis' if os.environ.get('REDIS_URL') else 'off')
+RECENT_MESSAGES_REDIS_URL = os.environ.get('REDIS_URL', '')
+RECENT_MESSAGES_PER_CONVERSATION = int(os.environ.get('RECENT_MESSAGES_PER_CONVERSATION', '100'))
+RECENT_MESSAGES_MAX_CONVERSATIONS = int(os.environ.get('RECENT_MESSAGES_MAX_CONVERSATIONS', '2000'))  # memory backend
+RECENT_MESSAGES_MAX_BYTES = int(os.environ.get('RECENT_MESSAGES_MAX_BYTES', str(64 * 1024 * 1024)))  # memory backend
+RECENT_MESSAGES_IDLE_SECONDS = int(os.environ.get('RECENT_MESSAGES_IDLE_SECONDS', '1800'))
+
+# --- WEBSOCKETS (sender_app/consumers.py) ---
+# A reconnecting chat socket sends {"action": "resume", "last_id": <id>} and gets the
+# messages it missed replayed; past this many it is told to reload the history instead.
+WS_RESUME_MAX_MESSAGES = int(os.environ.get('WS_RESUME_MAX_MESSAGES', '500'))
+# ws/inbox/ (InboxConsumer): chats one socket may subscribe to, and whether conversation
+# changes are pushed to inbox sockets (one group_send per committed write batch)
+WS_MAX_SUBSCRIPTIONS = int(os.environ.get('WS_MAX_SUBSCRIPTIONS', '50'))
+WS_INBOX_EVENTS = os.environ.get('WS_INBOX_EVENTS', '1') == '1'
+# Outgoing events within this window of the previous send go out as one batch frame;
+# a client more than WS_SEND_BUFFER_FRAMES frames behind is told to resync instead
+WS_COALESCE_WINDOW_MS = int(os.environ.get('WS_COALESCE_WINDOW_MS', '25'))
+WS_SEND_BUFFER_FRAMES = int(os.environ.get('WS_SEND_BUFFER_FRAMES', '200'))
+
 # --- STATIC FILES ---
 
 
@@ -152,11 +196,84 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # --- WHATSAPP CLOUD API SETTINGS ---
 # We now get all these values from Environment Variables.
-WHATSAPP_API_VERSION = os.environ.get('WHATSAPP_API_VERSION')
+WHATSAPP_API_VERSION = os.environ.get('WHATSAPP_API_VERSION', 'v20.0')
 WHATSAPP_PHONE_NUMBER_ID = os.environ.get('WHATSAPP_PHONE_NUMBER_ID')
 WHATSAPP_ACCESS_TOKEN = os.environ.get('WHATSAPP_ACCESS_TOKEN')
 WHATSAPP_WEBHOOK_VERIFY_TOKEN = os.environ.get('WHATSAPP_WEBHOOK_VERIFY_TOKEN')
 ADMIN_PHONE_NUMBER = os.environ.get('ADMIN_PHONE_NUMBER')
+# Bearer token for Prometheus to scrape /metrics; without it /metrics needs a logged-in session
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# --- GRAPH API CLIENT (sender_app/graph_api.py) ---
+GRAPH_API_BASE_URL = os.environ.get('GRAPH_API_BASE_URL', 'https://graph.facebook.com')
+GRAPH_API_TIMEOUT = float(os.environ.get('GRAPH_API_TIMEOUT', '15'))
+GRAPH_API_MAX_RETRIES = int(os.environ.get('GRAPH_API_MAX_RETRIES', '2'))  # on 429/5xx/network errors (sends: 429/connect errors only)
+GRAPH_API_POOL_SIZE = int(os.environ.get('GRAPH_API_POOL_SIZE', '20'))  # keep-alive connections per process
+
+# Contacts per page in the sidebar / /api/inbox/
+INBOX_PAGE_SIZE = int(os.environ.get('INBOX_PAGE_SIZE', '50'))
+# Messages per page in the chat pane / /api/chat/<phone>/
+CHAT_HISTORY_PAGE_SIZE = int(os.environ.get('CHAT_HISTORY_PAGE_SIZE', '50'))
+# Max conversations returned by /api/search_chats/
+SEARCH_RESULTS_LIMIT = int(os.environ.get('SEARCH_RESULTS_LIMIT', '50'))
+# Newest matching messages ranked per search (sender_app/search.py); older matches only count when they're among these
+SEARCH_CANDIDATE_LIMIT = int(os.environ.get('SEARCH_CANDIDATE_LIMIT', '2000'))
+
+# --- OUTBOUND DISPATCH (sender_app/outbound.py) ---
+# Cloud API default throughput is 80 msg/s per business phone number; raise if Meta upgraded yours.
+PHONE_NUMBER_RATE_PER_SECOND = float(os.environ.get('PHONE_NUMBER_RATE_PER_SECOND', '80'))
+# Campaigns (`manage.py run_campaigns`, its own process and token bucket) take CAMPAIGN_RATE_PER_SECOND
+# of that budget and live chat sends get the rest, so together they never exceed the phone number's limit.
+CAMPAIGN_RATE_PER_SECOND = float(os.environ.get('CAMPAIGN_RATE_PER_SECOND', '40'))
+OUTBOUND_RATE_PER_SECOND = float(os.environ.get('OUTBOUND_RATE_PER_SECOND', max(PHONE_NUMBER_RATE_PER_SECOND - CAMPAIGN_RATE_PER_SECOND, 1)))
+OUTBOUND_WORKERS = int(os.environ.get('OUTBOUND_WORKERS', '8'))
+OUTBOUND_MAX_ATTEMPTS = int(os.environ.get('OUTBOUND_MAX_ATTEMPTS', '6'))
+OUTBOUND_LEASE_SECONDS = int(os.environ.get('OUTBOUND_LEASE_SECONDS', '120'))
+# The token bucket lives in the dispatcher's process, so the outbox is sent by exactly one
+# `manage.py dispatch_outbound` process by default. 1 runs the dispatcher inside the web process
+# instead: only safe with a single web worker, or the per-number rate is multiplied by their count.
+OUTBOUND_DISPATCH_IN_PROCESS = os.environ.get('OUTBOUND_DISPATCH_IN_PROCESS', '0') == '1'
+
+# --- CAMPAIGNS (sender_app/campaigns.py, `manage.py run_campaigns`) ---
+# CAMPAIGN_RATE_PER_SECOND is set with the outbound rate above: both come out of PHONE_NUMBER_RATE_PER_SECOND.
+CAMPAIGN_WORKERS = int(os.environ.get('CAMPAIGN_WORKERS', '8'))
+CAMPAIGN_MAX_ATTEMPTS = int(os.environ.get('CAMPAIGN_MAX_ATTEMPTS', '5'))
+CAMPAIGN_LEASE_SECONDS = int(os.environ.get('CAMPAIGN_LEASE_SECONDS', '120'))
+# Largest number list accepted by POST /api/campaigns/
+CAMPAIGN_MAX_RECIPIENTS = int(os.environ.get('CAMPAIGN_MAX_RECIPIENTS', '100000'))
+
+# --- WEBHOOK INGESTION ---
+# 'inline': webhook_view processes messages before returning 200 (old behaviour).
+# 'queue': webhook_view only journals the raw body; run `python manage.py process_webhooks`.
+WEBHOOK_INGEST_MODE = os.environ.get('WEBHOOK_INGEST_MODE', 'inline')
+WEBHOOK_QUEUE_WORKERS = int(os.environ.get('WEBHOOK_QUEUE_WORKERS', '4'))
+WEBHOOK_QUEUE_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_QUEUE_MAX_ATTEMPTS', '8'))
+WEBHOOK_QUEUE_LEASE_SECONDS = int(os.environ.get('WEBHOOK_QUEUE_LEASE_SECONDS', '300'))
+WEBHOOK_QUEUE_RETENTION_HOURS = int(os.environ.get('WEBHOOK_QUEUE_RETENTION_HOURS', '24'))
+# wamids remembered per process to drop Meta redeliveries before touching the DB
+WEBHOOK_DEDUP_CACHE_SIZE = int(os.environ.get('WEBHOOK_DEDUP_CACHE_SIZE', '50000'))
+# Traffic capture (sender_app/capture.py): append every webhook body with its arrival
+# time to this JSONL file, for `python manage.py replay_webhooks`. Empty = off.
+WEBHOOK_CAPTURE_PATH = os.environ.get('WEBHOOK_CAPTURE_PATH', '')
+WEBHOOK_CAPTURE_MAX_BYTES = int(os.environ.get('WEBHOOK_CAPTURE_MAX_BYTES', str(500 * 1024 * 1024)))  # stop capturing past this size
+
+# --- MESSAGE ARCHIVE (sender_app/archive.py, `manage.py archive_messages`) ---
+# Messages older than MESSAGE_ARCHIVE_AFTER_DAYS move out of ChatMessage into gzip JSONL
+# files here; chat history still pages into them. Use a persistent disk, not the release dir.
+MESSAGE_ARCHIVE_ROOT = os.environ.get('MESSAGE_ARCHIVE_ROOT', os.path.join(BASE_DIR, 'message_archive'))
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.environ.get('MESSAGE_ARCHIVE_AFTER_DAYS', '180'))
+MESSAGE_ARCHIVE_CHUNK_SIZE = int(os.environ.get('MESSAGE_ARCHIVE_CHUNK_SIZE', '5000'))  # rows per transaction
+MESSAGE_ARCHIVE_CACHE_BYTES = int(os.environ.get('MESSAGE_ARCHIVE_CACHE_BYTES', str(32 * 1024 * 1024)))  # parsed archive files kept in memory, per process
+
+# --- CHAT DELETION (sender_app/deletion.py) ---
+# DELETE /api/delete_chat/<phone>/ only queues a job; rows go in chunks of CHAT_DELETE_CHUNK_SIZE.
+CHAT_DELETE_CHUNK_SIZE = int(os.environ.get('CHAT_DELETE_CHUNK_SIZE', '1000'))
+CHAT_DELETE_PAUSE_SECONDS = float(os.environ.get('CHAT_DELETE_PAUSE_SECONDS', '0.05'))  # between chunks
+CHAT_DELETE_LEASE_SECONDS = int(os.environ.get('CHAT_DELETE_LEASE_SECONDS', '300'))
+CHAT_DELETE_MAX_ATTEMPTS = int(os.environ.get('CHAT_DELETE_MAX_ATTEMPTS', '5'))
+# Run jobs on a background thread of the web process (leftover jobs resume when the ASGI/WSGI
+# application loads, see sender_app.apps); set to 0 when running `manage.py process_deletions` instead.
+CHAT_DELETE_IN_PROCESS = os.environ.get('CHAT_DELETE_IN_PROCESS', '1') == '1'
 
 # Session duration: 11 hours in seconds (11 * 60 * 60)
 SESSION_COOKIE_AGE = 39600
@@ -165,9 +282,71 @@ SESSION_COOKIE_AGE = 39600
 MEDIA_ROOT = os.path.join(STATIC_ROOT, 'media')      # will create staticfiles/media
 MEDIA_URL = '/media/'    
 
+# --- MEDIA DOWNLOADS ---
+# Max parallel media downloads per process (shared by all webhooks) and max file size.
+MEDIA_DOWNLOAD_CONCURRENCY = int(os.environ.get('MEDIA_DOWNLOAD_CONCURRENCY', '4'))
+MEDIA_MAX_BYTES = int(os.environ.get('MEDIA_MAX_BYTES', str(100 * 1024 * 1024)))
+# 'uuid' (default): MEDIA_ROOT/<type>/<uuid>.<ext>; 'content': deduplicated blobs under MEDIA_ROOT/blobs/ab/cd/<sha256>.<ext>
+MEDIA_STORE_MODE = os.environ.get('MEDIA_STORE_MODE', 'uuid')
+
+# --- IMAGE THUMBNAILS (sender_app/thumbnails.py, needs Pillow) ---
+# Longest side in px (0 disables), 'webp' or 'jpeg' (webp falls back to jpeg if Pillow lacks it).
+THUMBNAIL_MAX_SIZE = int(os.environ.get('THUMBNAIL_MAX_SIZE', '320'))
+THUMBNAIL_FORMAT = os.environ.get('THUMBNAIL_FORMAT', 'webp')
+THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', '75'))
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', '2'))
+
+# --- MEDIA SERVING (/media/<path>, sender_app/media.py) ---
+# 'python': Django streams the file (with 304s and Range).
+# 'x-accel': nginx serves it; needs an internal location, e.g.
+#     location /protected-media/ { internal; alias <MEDIA_ROOT>/; }
+# 'x-sendfile': Apache mod_xsendfile / lighttpd serve it from the absolute path.
+MEDIA_SERVE_MODE = os.environ.get('MEDIA_SERVE_MODE', 'python')
+MEDIA_ACCEL_REDIRECT_PREFIX = os.environ.get('MEDIA_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+# uuid-named media never changes, so browsers may keep it this long (seconds)
+MEDIA_CACHE_MAX_AGE = int(os.environ.get('MEDIA_CACHE_MAX_AGE', str(365 * 24 * 3600)))
+
 STORAGES = {"staticfiles": {"BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage"}}
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# --- LOGGING (meta_api_logger, see sender_app/logs.py) ---
+# 'file' (default): the synchronous, never-rotated FileHandler.
+# 'background': records go through a bounded queue to a writer thread, the file
+#   rotates by size, and a full queue drops records instead of blocking requests.
+LOG_MODE = os.environ.get('LOG_MODE', 'file')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')  # 'text' (default) or 'json' (one object per line)
+LOG_FILE = os.environ.get('LOG_FILE', os.path.join(BASE_DIR, 'meta_api.log'))
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', str(20 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', '5'))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+# Longest payload/response body written into one log record
+LOG_PAYLOAD_MAX_CHARS = int(os.environ.get('LOG_PAYLOAD_MAX_CHARS', '8000'))
+# Keep only a fraction of chatty events, e.g. "webhook_received=0.1,graph_response=0.5" (warnings are never sampled)
+LOG_SAMPLE_RATES = {
+    name.strip(): float(rate)
+    for name, rate in (item.split('=', 1) for item in os.environ.get('LOG_SAMPLE_RATES', '').split(',') if '=' in item)
+}
+
+if LOG_MODE == 'background':
+    API_LOG_HANDLER = {
+        'level': 'INFO',
+        'class': 'sender_app.logs.BackgroundRotatingFileHandler',
+        'filename': LOG_FILE,
+        'maxBytes': LOG_MAX_BYTES,
+        'backupCount': LOG_BACKUP_COUNT,
+        'queue_size': LOG_QUEUE_SIZE,
+        'formatter': 'json' if LOG_FORMAT == 'json' else 'verbose',
+        'filters': ['sampling'],
+    }
+else:
+    API_LOG_HANDLER = {
+        'level': 'INFO',
+        'class': 'logging.FileHandler',
+        'filename': LOG_FILE, # Creates the log file in the project root
+        'formatter': 'json' if LOG_FORMAT == 'json' else 'verbose',
+        'filters': ['sampling'],
+    }
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -176,15 +355,19 @@ LOGGING = {
             'format': '{levelname} {asctime} {module} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'sender_app.logs.JsonLinesFormatter',
+        },
     },
-    'handlers': {
-        'api_log_file': {
-            'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'filename': os.path.join(BASE_DIR, 'meta_api.log'), # Creates the log file in the project root
-            'formatter': 'verbose',
+    'filters': {
+        'sampling': {
+            '()': 'sender_app.logs.SamplingFilter',
+            'rates': LOG_SAMPLE_RATES,
         },
     },
+    'handlers': {
+        'api_log_file': API_LOG_HANDLER,
+    },
     'loggers': {
         'meta_api_logger': { # Our custom logger
             'handlers': ['api_log_file'],
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'whatsapp_sender.settings')
 
 application = get_wsgi_application()
+
+from sender_app.apps import start_background_workers  # noqa: E402 (needs the app registry)
+
+start_background_workers()